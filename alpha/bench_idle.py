@@ -0,0 +1,147 @@
+import os
+import sys
+import json
+import time
+import socket
+import struct
+import argparse
+import resource
+import tempfile
+import threading
+import subprocess
+from configparser import ConfigParser
+
+SERVER = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'socks5-server.py')
+
+
+def free_port():
+    sock = socket.socket()
+    sock.bind(('127.0.0.1', 0))
+    port = sock.getsockname()[1]
+    sock.close()
+    return port
+
+
+def echo_server():
+    """
+    :return: 回显服务器的地址,同时接受中继模式下的空闲连接
+    """
+    listener = socket.socket()
+    listener.bind(('127.0.0.1', 0))
+    listener.listen(1024)
+    accepted = []
+
+    def handle(conn):
+        while True:
+            data = conn.recv(65536)
+            if not data:
+                break
+            conn.sendall(data)
+        conn.close()
+
+    def loop():
+        while True:
+            conn, address = listener.accept()
+            accepted.append(conn)
+            threading.Thread(target=handle, args=(conn,), daemon=True).start()
+
+    threading.Thread(target=loop, daemon=True).start()
+    return listener.getsockname()
+
+
+def open_connection(port, target=None):
+    """
+    完成协商,target不为空时继续发送CONNECT请求
+    :return: socket
+    """
+    sock = socket.create_connection(('127.0.0.1', port), timeout=10)
+    sock.sendall(b'\x05\x01\x00')
+    assert sock.recv(2) == b'\x05\x00'
+    if target:
+        sock.sendall(b'\x05\x01\x00\x01' + socket.inet_aton(target[0]) + struct.pack('>H', target[1]))
+        assert sock.recv(10)[:2] == b'\x05\x00'
+    return sock
+
+
+def process_stats(pid):
+    """
+    :return: (RSS MB,CPU秒)
+    """
+    with open('/proc/{}/status'.format(pid)) as file:
+        rss = next(int(line.split()[1]) for line in file if line.startswith('VmRSS')) / 1024
+    with open('/proc/{}/stat'.format(pid)) as file:
+        fields = file.read().rsplit(')', 1)[1].split()
+    cpu = (int(fields[11]) + int(fields[12])) / os.sysconf('SC_CLK_TCK')
+    return rss, cpu
+
+
+def main():
+    parser = argparse.ArgumentParser(description="保持大量空闲连接时的内存、CPU和新请求延迟")
+    parser.add_argument('--engine', default='epoll', choices=('epoll', 'thread'))
+    parser.add_argument('--connections', type=int, default=10000, help="空闲连接数量")
+    parser.add_argument('--relay', action='store_true', help="空闲连接完成CONNECT进入中继(服务器每个连接占用两个文件描述符)")
+    parser.add_argument('--requests', type=int, default=200, help="保持空闲连接时测量延迟的请求数量")
+    parser.add_argument('--idle', type=float, default=5, help="测量空闲CPU占用的时间(秒)")
+    parser.add_argument('--json', action='store_true', help="输出JSON")
+    args = parser.parse_args()
+
+    soft, hard = resource.getrlimit(resource.RLIMIT_NOFILE)
+    resource.setrlimit(resource.RLIMIT_NOFILE, (hard, hard))
+    target = echo_server()
+    port = free_port()
+    directory = tempfile.mkdtemp()
+    config = ConfigParser()
+    config.read_dict({'server': {
+        'timeout': '3', 'address': '127.0.0.1', 'port': str(port), 'buffer_size': '4096',
+        'threads': str(args.connections + 64), 'engine': args.engine,
+    }})
+    with open(os.path.join(directory, 'config.ini'), 'w') as file:
+        config.write(file)
+    server = subprocess.Popen([sys.executable, '-W', 'ignore', SERVER], cwd=directory)
+    try:
+        time.sleep(1)
+        rss_before, cpu_before = process_stats(server.pid)
+        start = time.perf_counter()
+        idle = [open_connection(port, target if args.relay else None) for _ in range(args.connections)]
+        open_seconds = time.perf_counter() - start
+
+        rss, cpu = process_stats(server.pid)
+        time.sleep(args.idle)
+        rss, cpu_idle = process_stats(server.pid)
+
+        latencies = []
+        for _ in range(args.requests):
+            start = time.perf_counter()
+            sock = open_connection(port, target)
+            sock.sendall(b'ping')
+            assert sock.recv(4) == b'ping'
+            sock.close()
+            latencies.append(time.perf_counter() - start)
+        latencies.sort()
+        result = {
+            'engine': args.engine,
+            'connections': len(idle),
+            'relay': args.relay,
+            'open_per_s': len(idle) / open_seconds,
+            'rss_mb': rss,
+            'rss_per_connection_kb': (rss - rss_before) * 1024 / len(idle),
+            'idle_cpu_percent': (cpu_idle - cpu) / args.idle * 100,
+            'request_p50_ms': latencies[len(latencies) // 2] * 1000,
+            'request_p99_ms': latencies[int(len(latencies) * 0.99)] * 1000,
+        }
+        for sock in idle:
+            sock.close()
+    finally:
+        server.terminate()
+        server.wait()
+
+    if args.json:
+        json.dump(result, sys.stdout, indent=2)
+        print()
+        return
+    for name, value in result.items():
+        print("{:<24}{}".format(name, round(value, 2) if isinstance(value, float) else value))
+
+
+if __name__ == '__main__':
+    main()
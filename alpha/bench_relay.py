@@ -0,0 +1,98 @@
+import os
+import sys
+import json
+import time
+import socket
+import argparse
+import threading
+import importlib.util
+from configparser import ConfigParser
+
+spec = importlib.util.spec_from_file_location('socks5_server', os.path.join(os.path.dirname(os.path.abspath(__file__)), 'socks5-server.py'))
+socks5_server = importlib.util.module_from_spec(spec)
+spec.loader.exec_module(socks5_server)
+
+
+def connection_pair(listener):
+    """
+    :return: 回环地址上的一对TCP连接
+    """
+    client = socket.create_connection(listener.getsockname())
+    server, address = listener.accept()
+    return client, server
+
+
+def bench(splice, total, chunk_size):
+    """
+    发送端 -> [socket_src 中继 socket_dst] -> 接收端,只统计中继线程的CPU时间
+    :param splice: 是否使用splice
+    :param total: 数据量(字节)
+    :param chunk_size: 发送端每次发送的大小
+    :return: (中继线程CPU秒/GB,MB/s)
+    """
+    config = ConfigParser()
+    config.read_dict({'server': {'timeout': '3', 'buffer_size': '4096', 'splice': str(splice).lower()}})
+    server = socks5_server.Server(config)
+    listener = socket.socket()
+    listener.bind(('127.0.0.1', 0))
+    listener.listen(2)
+    sender, socket_src = connection_pair(listener)
+    socket_dst, receiver = connection_pair(listener)
+    listener.close()
+    result = {}
+
+    def relay():
+        start = time.thread_time()
+        server.relay(socket_src, socket_dst)
+        result['cpu'] = time.thread_time() - start
+        socket_src.close()
+        socket_dst.close()
+
+    def send():
+        chunk = b'\x00' * chunk_size
+        for _ in range(total // chunk_size):
+            sender.sendall(chunk)
+        sender.shutdown(socket.SHUT_WR)
+
+    threads = [threading.Thread(target=relay), threading.Thread(target=send)]
+    start = time.perf_counter()
+    for thread in threads:
+        thread.start()
+    received = 0
+    while True:
+        data = receiver.recv(1 << 20)
+        if not data:
+            break
+        received += len(data)
+    elapsed = time.perf_counter() - start
+    for thread in threads:
+        thread.join()
+    sender.close()
+    receiver.close()
+    assert received == total // chunk_size * chunk_size, received
+    return result['cpu'] / (received / 1e9), received / elapsed / 1e6
+
+
+def main():
+    parser = argparse.ArgumentParser(description="recv/send与splice中继的CPU开销对比")
+    parser.add_argument('--total', type=int, default=1 << 30, help="数据量(字节)")
+    parser.add_argument('--chunk', type=int, default=65536, help="发送端每次发送的大小")
+    parser.add_argument('--json', action='store_true', help="输出JSON")
+    args = parser.parse_args()
+
+    results = []
+    for name, splice in (('recv/send', False), ('splice', True)):
+        cpu, throughput = bench(splice, args.total, args.chunk)
+        results.append({'relay': name, 'cpu_seconds_per_gb': cpu, 'mb_per_s': throughput})
+
+    if args.json:
+        json.dump(results, sys.stdout, indent=2)
+        print()
+        return
+    print("{:<12}{:>14}{:>12}".format('relay', 'CPU s/GB', 'MB/s'))
+    for result in results:
+        print("{relay:<12}{cpu_seconds_per_gb:>14.3f}{mb_per_s:>12.1f}".format(**result))
+
+
+if __name__ == '__main__':
+    main()
@@ -1,6 +1,14 @@
+import os
 import sys
+import errno
+import fcntl
 import socket
 import select
+import selectors
+import resource
+import functools
+import collections
+import concurrent.futures
 import struct
 import threading
 import time
@@ -56,6 +64,14 @@ class Server:
         except socket.error:
             # error
             return b'\xff'
+        return self.parse_method(data)
+
+    def parse_method(self, data):
+        """
+        从协商请求中选择认证方法
+        :param data: 协商请求
+        :return: b'\x00'(无密码) | b'\xff'(没有可用的方法)
+        """
         if b'\x05' != data[0:1]:
             return b'\xff'
         nmethods = data[1]  # 当前支持方法数量
@@ -105,6 +121,14 @@ class Server:
             conn.close()
             # error
             return False
+        return self.parse_dst(data)
+
+    def parse_dst(self, data):
+        """
+        解析请求中的目标地址和端口
+        :param data: 请求
+        :return: (addr, port) | False
+        """
         if data[0:3] != b'\x05\x01\x00':  # 版本号为5,CONNECT请求为0x01,0x00为保留字
             return False
         if data[3:4] == b'\x01':  # ATYP检查,1为ipv4
@@ -154,33 +178,133 @@ class Server:
         if sock:
             sock.close()
 
+    def splice_relay(self, socket_src, socket_dst):
+        """
+        使用os.splice经过管道在内核中转发数据,不复制到用户态,管道容量即每个方向的高水位
+        :param socket_src:
+        :param socket_dst:
+        :return: False(系统不支持splice,尚未转发任何数据,需要回退到recv/send) | None
+        """
+        if not hasattr(os, 'splice'):
+            return False
+        high = self.config.getint('server', 'high_watermark', fallback=self.config.getint('server', 'buffer_size') * 16)
+        peers = {socket_src: socket_dst, socket_dst: socket_src}
+        pipes = {}  # 发送到该socket的数据所在的管道
+        try:
+            for sock in (socket_src, socket_dst):
+                pipes[sock] = os.pipe()
+                try:
+                    fcntl.fcntl(pipes[sock][1], fcntl.F_SETPIPE_SZ, high)
+                except OSError:
+                    pass  # 超过/proc/sys/fs/pipe-max-size时使用默认容量
+        except OSError:
+            for pipe in pipes.values():
+                os.close(pipe[0])
+                os.close(pipe[1])
+            return False
+        capacity = {sock: fcntl.fcntl(pipe[1], fcntl.F_GETPIPE_SZ) for sock, pipe in pipes.items()}
+        pending = {socket_src: 0, socket_dst: 0}  # 管道中等待发送到该socket的字节数
+        flags = os.SPLICE_F_MOVE | os.SPLICE_F_NONBLOCK
+        moved = False
+        closing = False  # 任意一端关闭后停止读取,发送完管道中的数据后结束
+        socket_src.setblocking(False)
+        socket_dst.setblocking(False)
+        try:
+            while True:
+                if closing and not pending[socket_src] and not pending[socket_dst]:
+                    return
+                rlist = [sock for sock in (socket_src, socket_dst) if pending[peers[sock]] < capacity[peers[sock]] and not closing]
+                wlist = [sock for sock in (socket_src, socket_dst) if pending[sock]]
+                try:
+                    rlist, wlist, xlist = select.select(rlist, wlist, [], self.config.getint('server', 'timeout') if closing else None)
+                except select.error as err:
+                    # error
+                    return
+                if closing and not wlist:
+                    return
+                try:
+                    for sock in rlist:
+                        peer = peers[sock]
+                        try:
+                            size = os.splice(sock.fileno(), pipes[peer][1], capacity[peer] - pending[peer], flags=flags)
+                        except BlockingIOError:
+                            continue
+                        if size == 0:
+                            closing = True
+                            break
+                        moved = True
+                        pending[peer] += size
+                    for sock in (socket_src, socket_dst):
+                        if pending[sock]:
+                            try:
+                                pending[sock] -= os.splice(pipes[sock][0], sock.fileno(), pending[sock], flags=flags)
+                            except BlockingIOError:
+                                pass
+                except OSError as err:
+                    if not moved and err.errno in (errno.EINVAL, errno.ENOSYS):
+                        return False
+                    # error
+                    return
+        finally:
+            for pipe in pipes.values():
+                os.close(pipe[0])
+                os.close(pipe[1])
+
     def relay(self, socket_src, socket_dst):
         """
-        中继(relay)阶段
+        中继(relay)阶段,每个方向有一个发送队列,socket不可写时数据留在队列中等待select的wlist,
+        队列超过高水位时停止读取另一端,降到低水位以下后恢复
         :param socket_src:
         :param socket_dst:
         :return:
         """
+        if self.config.getboolean('server', 'splice', fallback=False) and self.splice_relay(socket_src, socket_dst) is not False:
+            return
+        buffer_size = self.config.getint('server', 'buffer_size')
+        high = self.config.getint('server', 'high_watermark', fallback=buffer_size * 16)
+        low = self.config.getint('server', 'low_watermark', fallback=buffer_size * 4)
+        peers = {socket_src: socket_dst, socket_dst: socket_src}
+        queues = {socket_src: bytearray(), socket_dst: bytearray()}  # 等待发送到该socket的数据
+        reading = {socket_src: True, socket_dst: True}
+        closing = False  # 任意一端关闭后停止读取,发送完队列中的数据后结束
+        socket_src.setblocking(False)
+        socket_dst.setblocking(False)
         while True:
+            if closing and not queues[socket_src] and not queues[socket_dst]:
+                return
+            rlist = [sock for sock in (socket_src, socket_dst) if reading[sock] and not closing]
+            wlist = [sock for sock in (socket_src, socket_dst) if queues[sock]]
             try:
-                rlist, wlist, xlist = select.select([socket_src, socket_dst], [], [])
+                rlist, wlist, xlist = select.select(rlist, wlist, [], self.config.getint('server', 'timeout') if closing else None)
             except select.error as err:
                 # error
                 return
-            if not rlist:
-                continue
+            if closing and not wlist:
+                return
             try:
+                for sock in wlist:
+                    sent = sock.send(queues[sock])
+                    del queues[sock][:sent]
                 for sock in rlist:
-                    data = sock.recv(self.config.getint('server', 'buffer_size'))
+                    data = sock.recv(buffer_size)
                     if data == b'':
-                        return
-                    if sock is socket_dst:
-                        socket_src.send(data)
-                    else:
-                        socket_dst.send(data)
+                        closing = True
+                        break
+                    queue = queues[peers[sock]]
+                    if not queue:
+                        try:
+                            data = data[peers[sock].send(data):]  # 队列为空时直接发送,只有未发送的部分进入队列
+                        except BlockingIOError:
+                            pass
+                    queue += data
             except socket.error as err:
                 # error
                 return
+            for sock in (socket_src, socket_dst):
+                if len(queues[peers[sock]]) >= high:
+                    reading[sock] = False
+                elif len(queues[peers[sock]]) <= low:
+                    reading[sock] = True
 
     def run(self):
         sock = self.socket_init()
@@ -205,10 +329,276 @@ class Server:
         sock.close()
 
 
+class Connection:
+    """
+    epoll模式下一个客户端连接的状态,conn为客户端,sock为目标地址
+    """
+    NEGOTIATE = 0  # 等待协商请求
+    REQUEST = 1  # 等待CONNECT请求
+    RESOLVE = 2  # 正在解析域名
+    CONNECT = 3  # 正在连接目标地址
+    RELAY = 4  # 中继
+    CLOSING = 5  # 发送完队列中的数据后关闭
+    CLOSED = 6
+
+    def __init__(self, conn):
+        self.conn = conn
+        self.sock = None
+        self.state = Connection.NEGOTIATE
+        self.queues = {conn: bytearray()}  # 等待发送到该socket的数据
+        self.reading = {conn: True}  # 对端的发送队列超过高水位时暂停读取
+        self.events = {conn: 0}  # 当前在selector中注册的事件
+        self.handler = None  # selector事件的回调
+        self.deadline = None  # 进入关闭状态后,超过该时间仍未发送完队列时直接关闭
+
+    def peer(self, sock):
+        return self.sock if sock is self.conn else self.conn
+
+
+class EpollServer(Server):
+    """
+    单线程事件驱动的服务器,基于selectors(Linux上为epoll),
+    每个连接按协商 -> 请求 -> 中继的状态机处理,连接数量不受线程数量限制,域名在线程池中解析
+    """
+
+    def __init__(self, config):
+        super().__init__(config)
+        self.selector = selectors.DefaultSelector()
+        self.buffer_size = self.config.getint('server', 'buffer_size')
+        self.high = self.config.getint('server', 'high_watermark', fallback=self.buffer_size * 16)
+        self.low = self.config.getint('server', 'low_watermark', fallback=self.buffer_size * 4)
+        self.resolver = concurrent.futures.ThreadPoolExecutor(self.config.getint('server', 'resolver_threads', fallback=4))
+        self.resolved = collections.deque()  # 解析完成的(Connection, future)
+        self.wakeup_r, self.wakeup_w = socket.socketpair()  # 解析线程通知事件循环
+        self.timeout = self.config.getint('server', 'timeout')
+        self.draining = collections.deque()  # 按进入关闭状态的顺序排列的(deadline, Connection)
+        self.listener = None
+        self.accept_resume = None  # 文件描述符耗尽时暂停接受连接,到该时间后恢复
+
+    def accept(self, sock, mask):
+        while True:
+            try:
+                conn, address = sock.accept()
+            except (BlockingIOError, InterruptedError):
+                return
+            except socket.error as err:
+                print("\033[31mFailed to accept: {}\033[0m".format(err), file=sys.stderr)
+                if err.errno in (errno.EMFILE, errno.ENFILE, errno.ENOBUFS, errno.ENOMEM):
+                    # 等待的连接仍在队列中,水平触发的epoll会立即再次通知,暂停监听1秒,避免空转占满CPU
+                    self.selector.unregister(sock)
+                    self.accept_resume = time.monotonic() + 1
+                return
+            conn.setblocking(False)
+            connection = Connection(conn)
+            connection.handler = functools.partial(self.handle, connection)
+            self.update(connection)
+
+    def wakeup(self, sock, mask):
+        try:
+            sock.recv(self.buffer_size)
+        except BlockingIOError:
+            pass
+        while self.resolved:
+            connection, future = self.resolved.popleft()
+            if connection.state != Connection.RESOLVE:
+                continue
+            try:
+                self.connect(connection, future.result())
+            except socket.error:
+                # error
+                self.fail(connection)
+            self.update(connection)
+
+    def resolve(self, connection, dst):
+        def done(future):
+            self.resolved.append((connection, future))
+            try:
+                self.wakeup_w.send(b'\x00')
+            except BlockingIOError:
+                pass
+
+        connection.state = Connection.RESOLVE
+        future = self.resolver.submit(lambda: socket.getaddrinfo(dst[0], dst[1], socket.AF_INET, socket.SOCK_STREAM)[0][4])
+        future.add_done_callback(done)
+
+    def connect(self, connection, dst):
+        """
+        非阻塞连接目标地址,连接完成后socket变为可写
+        """
+        sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        sock.setblocking(False)
+        connection.sock = sock
+        connection.queues[sock] = bytearray()
+        connection.reading[sock] = True
+        connection.events[sock] = 0
+        connection.state = Connection.CONNECT
+        err = sock.connect_ex(dst)
+        if err not in (0, errno.EINPROGRESS):
+            raise socket.error(err, os.strerror(err))
+
+    def fail(self, connection):
+        """
+        回复请求失败并关闭连接
+        """
+        connection.queues[connection.conn] += b'\x05\x01\x00\x01\x00\x00\x00\x00\x00\x00'
+        self.closing(connection)
+
+    def closing(self, connection):
+        """
+        进入关闭状态,与多线程模式的中继一样最多等待timeout秒发送完队列中的数据
+        """
+        connection.state = Connection.CLOSING
+        connection.deadline = time.monotonic() + self.timeout
+        self.draining.append((connection.deadline, connection))
+
+    def expire(self):
+        """
+        关闭超过期限仍未发送完队列的连接,到期后恢复接受连接
+        """
+        now = time.monotonic()
+        while self.draining and self.draining[0][0] <= now:
+            deadline, connection = self.draining.popleft()
+            if connection.state == Connection.CLOSING:
+                self.close(connection)
+        if self.accept_resume is not None and self.accept_resume <= now:
+            self.accept_resume = None
+            self.selector.register(self.listener, selectors.EVENT_READ, self.accept)
+
+    def select_timeout(self):
+        """
+        :return: 距离下一个关闭期限或恢复接受连接的秒数 | None(没有需要等待的期限)
+        """
+        deadlines = [self.draining[0][0]] if self.draining else []
+        if self.accept_resume is not None:
+            deadlines.append(self.accept_resume)
+        if not deadlines:
+            return
+        return max(min(deadlines) - time.monotonic(), 0)
+
+    def handle(self, connection, sock, mask):
+        try:
+            if mask & selectors.EVENT_WRITE:
+                self.writable(connection, sock)
+            if mask & selectors.EVENT_READ and connection.state < Connection.CLOSING:
+                self.readable(connection, sock)
+        except socket.error:
+            # error
+            self.close(connection)
+            return
+        self.update(connection)
+
+    def readable(self, connection, sock):
+        data = sock.recv(self.buffer_size)
+        if data == b'':
+            self.closing(connection)
+            return
+        if connection.state == Connection.NEGOTIATE:
+            if self.parse_method(data) != b'\x00':
+                self.closing(connection)
+                return
+            connection.queues[sock] += b'\x05\x00'
+            connection.state = Connection.REQUEST
+        elif connection.state == Connection.REQUEST:
+            dst = self.parse_dst(data)
+            if not dst:
+                self.fail(connection)
+            elif isinstance(dst[0], bytes):
+                self.resolve(connection, dst)
+            else:
+                self.connect(connection, dst)
+        elif connection.state == Connection.RELAY:
+            self.send(connection, connection.peer(sock), data)
+
+    def writable(self, connection, sock):
+        if connection.state == Connection.CONNECT and sock is connection.sock:
+            err = sock.getsockopt(socket.SOL_SOCKET, socket.SO_ERROR)
+            if err:
+                # error
+                self.fail(connection)
+                return
+            bnd = socket.inet_aton(sock.getsockname()[0])  # 绑定地址
+            bnd += struct.pack(">H", sock.getsockname()[1])  # 绑定端口
+            connection.state = Connection.RELAY
+            self.send(connection, connection.conn, b'\x05\x00\x00\x01' + bnd)
+            return
+        queue = connection.queues[sock]
+        if queue:
+            del queue[:sock.send(queue)]
+
+    def send(self, connection, sock, data):
+        """
+        队列为空时直接发送,只有未发送的部分进入队列
+        """
+        queue = connection.queues[sock]
+        if not queue:
+            try:
+                data = data[sock.send(data):]
+            except BlockingIOError:
+                pass
+        queue += data
+
+    def update(self, connection):
+        """
+        根据连接状态和发送队列更新selector中注册的事件,关闭状态下队列为空时关闭连接
+        """
+        if connection.state == Connection.CLOSED:
+            return
+        if connection.state == Connection.CLOSING and not any(connection.queues.values()):
+            self.close(connection)
+            return
+        for sock in connection.queues:
+            peer_queue = connection.queues.get(connection.peer(sock))
+            if peer_queue is not None:
+                if len(peer_queue) >= self.high:
+                    connection.reading[sock] = False
+                elif len(peer_queue) <= self.low:
+                    connection.reading[sock] = True
+            events = 0
+            if connection.state == Connection.RELAY and connection.reading[sock] or connection.state < Connection.RESOLVE and sock is connection.conn:
+                events |= selectors.EVENT_READ
+            if connection.queues[sock] or connection.state == Connection.CONNECT and sock is connection.sock:
+                events |= selectors.EVENT_WRITE
+            if events == connection.events[sock]:
+                continue
+            if not connection.events[sock]:
+                self.selector.register(sock, events, connection.handler)
+            elif not events:
+                self.selector.unregister(sock)
+            else:
+                self.selector.modify(sock, events, connection.handler)
+            connection.events[sock] = events
+
+    def close(self, connection):
+        connection.state = Connection.CLOSED
+        for sock, events in connection.events.items():
+            if events:
+                self.selector.unregister(sock)
+            sock.close()
+
+    def run(self):
+        soft, hard = resource.getrlimit(resource.RLIMIT_NOFILE)
+        resource.setrlimit(resource.RLIMIT_NOFILE, (hard, hard))  # 每个连接占用两个文件描述符
+        sock = self.socket_init()
+        sock = self.bind_port(sock)
+        sock.setblocking(False)
+        self.wakeup_r.setblocking(False)
+        self.wakeup_w.setblocking(False)
+        self.listener = sock
+        self.selector.register(sock, selectors.EVENT_READ, self.accept)
+        self.selector.register(self.wakeup_r, selectors.EVENT_READ, self.wakeup)
+        while True:
+            for key, mask in self.selector.select(self.select_timeout()):
+                key.data(key.fileobj, mask)
+            self.expire()
+
+
 def main():
     config = ConfigParser()
     config.read('config.ini')
-    server = Server(config)
+    if config.get('server', 'engine', fallback='thread') == 'epoll':
+        server = EpollServer(config)
+    else:
+        server = Server(config)
     server.run()
 
 
@@ -0,0 +1,403 @@
+import os
+import sys
+import json
+import time
+import socket
+import struct
+import argparse
+import platform
+import tempfile
+import threading
+import subprocess
+import multiprocessing
+from configparser import ConfigParser
+
+ROOT = os.path.dirname(os.path.abspath(__file__))
+VARIANTS = {
+    'alpha': [os.path.join(ROOT, 'alpha', 'socks5-server.py')],
+    'beta': [os.path.join(ROOT, 'beta', 'server.py'), os.path.join(ROOT, 'beta', 'local.py')],
+    'final': [os.path.join(ROOT, 'final', 'server.py'), os.path.join(ROOT, 'final', 'local.py')],
+}
+CHUNK = 65536
+
+
+def free_port():
+    sock = socket.socket()
+    sock.bind(('127.0.0.1', 0))
+    port = sock.getsockname()[1]
+    sock.close()
+    return port
+
+
+def recv_exactly(sock, size):
+    data = b''
+    while len(data) < size:
+        chunk = sock.recv(size - len(data))
+        if not chunk:
+            raise ConnectionError('connection closed after {} of {} bytes'.format(len(data), size))
+        data += chunk
+    return data
+
+
+def sink(conn):
+    """
+    接收端:先读取8字节的数据量,读完后回复ok
+    """
+    total = struct.unpack('>Q', recv_exactly(conn, 8))[0]
+    while total > 0:
+        data = conn.recv(min(total, 1 << 20))
+        if not data:
+            return
+        total -= len(data)
+    conn.sendall(b'ok')
+
+
+def echo(conn):
+    while True:
+        data = conn.recv(CHUNK)
+        if not data:
+            return
+        conn.sendall(data)
+
+
+def http(conn):
+    """
+    类HTTP的请求/响应:GET /N 返回N字节的响应体,支持同一连接上的多个请求
+    """
+    body = b'\x00' * CHUNK
+    buffer = b''
+    while True:
+        while b'\r\n\r\n' not in buffer:
+            data = conn.recv(CHUNK)
+            if not data:
+                return
+            buffer += data
+        request, buffer = buffer.split(b'\r\n\r\n', 1)
+        size = int(request.split(b' ')[1][1:])
+        conn.sendall(b'HTTP/1.1 200 OK\r\nContent-Length: ' + str(size).encode() + b'\r\n\r\n')
+        while size > 0:
+            conn.sendall(body[:min(size, CHUNK)])
+            size -= CHUNK
+
+
+def serve_targets(ports):
+    """
+    目标服务器进程,与负载生成器分开,避免共用一个GIL
+    :param ports: multiprocessing.Queue,写入{名称: 端口}
+    """
+    listeners = {}
+    for name, handler in (('sink', sink), ('echo', echo), ('http', http)):
+        listener = socket.socket()
+        listener.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+        listener.bind(('127.0.0.1', 0))
+        listener.listen(1024)
+        listeners[name] = (listener, handler)
+
+    def handle(conn, handler):
+        try:
+            handler(conn)
+        except OSError:
+            pass
+        finally:
+            conn.close()
+
+    def accept(listener, handler):
+        while True:
+            conn, address = listener.accept()
+            conn.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+            threading.Thread(target=handle, args=(conn, handler), daemon=True).start()
+
+    for listener, handler in listeners.values():
+        threading.Thread(target=accept, args=(listener, handler), daemon=True).start()
+    ports.put({name: listener.getsockname()[1] for name, (listener, handler) in listeners.items()})
+    threading.Event().wait()
+
+
+def generate_keys(directory):
+    """
+    final使用的RSA测试密钥
+    """
+    from Crypto.PublicKey import RSA  # pycryptodome,只有final需要
+    key = RSA.generate(2048)
+    with open(os.path.join(directory, 'private.key'), 'wb') as file:
+        file.write(key.export_key())
+    with open(os.path.join(directory, 'public.pem'), 'wb') as file:
+        file.write(key.publickey().export_key())
+
+
+def write_config(variant, directory, overrides):
+    """
+    以各版本自带的config.ini为基础,只监听回环地址并使用空闲端口
+    :param overrides: {'section.key': value}
+    :return: (SOCKS端口,启动完成前需要等待的端口)
+    """
+    config = ConfigParser()
+    config.read(os.path.join(ROOT, variant, 'config.ini'))
+    config.set('server', 'address', '127.0.0.1')
+    config.set('server', 'port', str(free_port()))
+    if config.has_section('local'):
+        config.set('local', 'remote', '127.0.0.1')
+        config.set('local', 'address', '127.0.0.1')
+        config.set('local', 'port', str(free_port()))
+    if config.has_section('log'):
+        config.set('log', 'filename', os.path.join(directory, 'socks.log'))
+    for name, value in overrides.items():
+        section, key = name.split('.', 1)
+        if not config.has_section(section):
+            config.add_section(section)
+        config.set(section, key, value)
+    with open(os.path.join(directory, 'config.ini'), 'w') as file:
+        config.write(file)
+    ports = [config.getint('server', 'port')]
+    if config.has_section('local'):  # 本地客户端先于服务端监听时,第一个请求会因连接不到服务端而失败
+        ports.append(config.getint('local', 'port'))
+    if config.has_section('metrics'):  # 多进程模式下编号为0的工作进程监听配置的端口
+        for key in ('server_port', 'local_port'):
+            if config.getint('metrics', key, fallback=0):
+                ports.append(config.getint('metrics', key))
+    return ports[1] if config.has_section('local') else ports[0], ports
+
+
+def wait_port(port, timeout=10):
+    deadline = time.monotonic() + timeout
+    while True:
+        try:
+            socket.create_connection(('127.0.0.1', port), timeout=1).close()
+            return
+        except OSError:
+            if time.monotonic() > deadline:
+                raise
+            time.sleep(0.05)
+
+
+def process_tree_cpu(pids):
+    """
+    :return: pids及其所有子进程(多进程模式的工作进程)的CPU秒
+    """
+    stats = {}
+    for entry in os.listdir('/proc'):
+        if not entry.isdigit():
+            continue
+        try:
+            with open('/proc/{}/stat'.format(entry)) as file:
+                fields = file.read().rsplit(')', 1)[1].split()
+        except OSError:
+            continue
+        stats[int(entry)] = (int(fields[1]), (int(fields[11]) + int(fields[12])) / os.sysconf('SC_CLK_TCK'))
+    tree = set(pids)
+    changed = True
+    while changed:
+        children = {pid for pid, (ppid, cpu) in stats.items() if ppid in tree} - tree
+        tree |= children
+        changed = bool(children)
+    return sum(stats[pid][1] for pid in tree if pid in stats)
+
+
+def socks_connect(proxy, target):
+    """
+    完成协商并发送CONNECT请求
+    :return: socket
+    """
+    sock = socket.create_connection(('127.0.0.1', proxy), timeout=10)
+    sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+    sock.sendall(b'\x05\x01\x00')
+    assert recv_exactly(sock, 2) == b'\x05\x00'
+    sock.sendall(b'\x05\x01\x00\x01' + socket.inet_aton('127.0.0.1') + struct.pack('>H', target))
+    reply = recv_exactly(sock, 10)
+    assert reply[1] == 0, reply
+    return sock
+
+
+def read_response(sock):
+    """
+    读取类HTTP响应
+    :return: (第一个字节到达的时间,响应体大小)
+    """
+    data = sock.recv(CHUNK)
+    first_byte = time.perf_counter()
+    if not data:
+        raise ConnectionError('empty response')
+    while b'\r\n\r\n' not in data:
+        data += recv_exactly(sock, 1)
+    header, body = data.split(b'\r\n\r\n', 1)
+    size = int(header.split(b'Content-Length: ')[1].split(b'\r\n')[0])
+    remaining = size - len(body)
+    while remaining > 0:
+        chunk = sock.recv(min(remaining, 1 << 20))
+        if not chunk:
+            raise ConnectionError('response truncated')
+        remaining -= len(chunk)
+    return first_byte, size
+
+
+def bulk_upload(proxy, targets, total):
+    """
+    :return: (字节数,秒)
+    """
+    sock = socks_connect(proxy, targets['sink'])
+    chunk = b'\x00' * CHUNK
+    start = time.perf_counter()
+    sock.sendall(struct.pack('>Q', total // CHUNK * CHUNK))
+    for _ in range(total // CHUNK):
+        sock.sendall(chunk)
+    assert recv_exactly(sock, 2) == b'ok'
+    elapsed = time.perf_counter() - start
+    sock.close()
+    return total // CHUNK * CHUNK, elapsed
+
+
+def bulk_download(proxy, targets, total):
+    """
+    :return: (字节数,秒)
+    """
+    sock = socks_connect(proxy, targets['http'])
+    start = time.perf_counter()
+    sock.sendall(b'GET /' + str(total).encode() + b' HTTP/1.1\r\n\r\n')
+    first_byte, size = read_response(sock)
+    elapsed = time.perf_counter() - start
+    sock.close()
+    return size, elapsed
+
+
+def connections(proxy, targets, duration, concurrency):
+    """
+    concurrency个线程循环:CONNECT到回显服务器,发送并收回4字节,关闭
+    :return: (完成的连接数,失败数,秒)
+    """
+    deadline = time.monotonic() + duration
+    counts = [[0, 0] for _ in range(concurrency)]
+
+    def worker(count):
+        while time.monotonic() < deadline:
+            try:
+                sock = socks_connect(proxy, targets['echo'])
+                sock.sendall(b'ping')
+                assert recv_exactly(sock, 4) == b'ping'
+                sock.close()
+                count[0] += 1
+            except (OSError, AssertionError):
+                count[1] += 1
+
+    threads = [threading.Thread(target=worker, args=(count,)) for count in counts]
+    start = time.perf_counter()
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    return sum(count[0] for count in counts), sum(count[1] for count in counts), time.perf_counter() - start
+
+
+def time_to_first_byte(proxy, targets, requests, size):
+    """
+    每个请求新建连接:从开始连接代理到收到响应的第一个字节,包括SOCKS协商、握手和连接目标
+    :return: 排序后的延迟(秒)
+    """
+    latencies = []
+    for _ in range(requests):
+        start = time.perf_counter()
+        sock = socks_connect(proxy, targets['http'])
+        sock.sendall(b'GET /' + str(size).encode() + b' HTTP/1.1\r\n\r\n')
+        first_byte, received = read_response(sock)
+        latencies.append(first_byte - start)
+        sock.close()
+    return sorted(latencies)
+
+
+def percentile(values, fraction):
+    return values[min(int(len(values) * fraction), len(values) - 1)]
+
+
+def bench(variant, targets, args, overrides):
+    """
+    启动一个版本的代理并依次测量
+    :return: 结果
+    """
+    with tempfile.TemporaryDirectory(prefix='bench-{}-'.format(variant)) as directory:  # 进程结束后删除配置、密钥和日志
+        proxy, ports = write_config(variant, directory, overrides)
+        if variant == 'final':
+            generate_keys(directory)
+        processes = [subprocess.Popen([sys.executable, '-W', 'ignore', script], cwd=directory, stdout=subprocess.DEVNULL)
+                     for script in VARIANTS[variant]]
+        pids = [process.pid for process in processes]
+        try:
+            for port in ports:
+                wait_port(port)
+            socks_connect(proxy, targets['echo']).close()  # 预热:final启动时加载密钥,连接池在第一个请求后开始填充
+            total = args.bulk_mb << 20
+            cpu = process_tree_cpu(pids)
+            uploaded, upload_seconds = bulk_upload(proxy, targets, total)
+            downloaded, download_seconds = bulk_download(proxy, targets, total)
+            bulk_cpu = process_tree_cpu(pids) - cpu
+
+            cpu = process_tree_cpu(pids)
+            completed, failed, seconds = connections(proxy, targets, args.duration, args.concurrency)
+            connection_cpu = process_tree_cpu(pids) - cpu
+
+            latencies = time_to_first_byte(proxy, targets, args.requests, args.response_size)
+        finally:
+            for process in processes:
+                process.terminate()
+            for process in processes:
+                process.wait()
+    return {
+        'variant': variant,
+        'options': overrides,
+        'upload_mb_per_s': uploaded / upload_seconds / 1e6,
+        'download_mb_per_s': downloaded / download_seconds / 1e6,
+        'cpu_seconds_per_gb': bulk_cpu / ((uploaded + downloaded) / 1e9),
+        'connections_per_s': completed / seconds,
+        'connection_failures': failed,
+        'cpu_ms_per_connection': connection_cpu / completed * 1000 if completed else None,
+        'ttfb_p50_ms': percentile(latencies, 0.5) * 1000,
+        'ttfb_p90_ms': percentile(latencies, 0.9) * 1000,
+        'ttfb_p99_ms': percentile(latencies, 0.99) * 1000,
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description="回环地址上alpha、beta和final的端到端性能测试")
+    parser.add_argument('--variant', nargs='+', default=list(VARIANTS), choices=list(VARIANTS), help="测试的版本")
+    parser.add_argument('--set', action='append', default=[], metavar='SECTION.KEY=VALUE', help="覆盖config.ini中的配置,可以多次指定")
+    parser.add_argument('--bulk-mb', type=int, default=256, help="上传和下载各自的数据量(MB)")
+    parser.add_argument('--duration', type=float, default=5, help="测量每秒连接数的时间(秒)")
+    parser.add_argument('--concurrency', type=int, default=8, help="测量每秒连接数的并发数")
+    parser.add_argument('--requests', type=int, default=200, help="测量首字节时间的请求数量")
+    parser.add_argument('--response-size', type=int, default=1024, help="测量首字节时间的响应体大小(字节)")
+    parser.add_argument('--json', action='store_true', help="输出JSON")
+    parser.add_argument('--output', help="把结果作为一行JSON追加到该文件,用于跟踪性能变化")
+    args = parser.parse_args()
+    overrides = dict(option.split('=', 1) for option in args.set)
+
+    ports = multiprocessing.Queue()
+    server = multiprocessing.Process(target=serve_targets, args=(ports,), daemon=True)
+    server.start()
+    targets = ports.get(timeout=10)
+    try:
+        results = [bench(variant, targets, args, overrides) for variant in args.variant]
+    finally:
+        server.terminate()
+
+    report = {
+        'time': time.strftime('%Y-%m-%dT%H:%M:%S%z'),
+        'python': platform.python_version(),
+        'machine': platform.machine(),
+        'cpus': os.cpu_count(),
+        'bulk_mb': args.bulk_mb,
+        'concurrency': args.concurrency,
+        'results': results,
+    }
+    if args.output:
+        with open(args.output, 'a') as file:
+            file.write(json.dumps(report) + '\n')
+    if args.json:
+        json.dump(report, sys.stdout, indent=2)
+        print()
+        return
+    columns = ('upload_mb_per_s', 'download_mb_per_s', 'cpu_seconds_per_gb', 'connections_per_s', 'cpu_ms_per_connection', 'ttfb_p50_ms', 'ttfb_p90_ms', 'ttfb_p99_ms')
+    print("{:<24}".format('') + ''.join("{:>10}".format(result['variant']) for result in results))
+    for column in columns:
+        print("{:<24}".format(column) + ''.join("{:>10}".format('-' if result[column] is None else round(result[column], 2)) for result in results))
+
+
+if __name__ == '__main__':
+    main()
@@ -1,4 +1,7 @@
+import os
 import sys
+import errno
+import fcntl
 import socket
 import select
 import struct
@@ -143,33 +146,133 @@ class Server:
         if sock:
             sock.close()
 
+    def splice_relay(self, socket_src, socket_dst):
+        """
+        使用os.splice经过管道在内核中转发数据,不复制到用户态,管道容量即每个方向的高水位
+        :param socket_src:
+        :param socket_dst:
+        :return: False(系统不支持splice,尚未转发任何数据,需要回退到recv/send) | None
+        """
+        if not hasattr(os, 'splice'):
+            return False
+        high = self.config.getint('server', 'high_watermark', fallback=self.config.getint('server', 'buffer_size') * 16)
+        peers = {socket_src: socket_dst, socket_dst: socket_src}
+        pipes = {}  # 发送到该socket的数据所在的管道
+        try:
+            for sock in (socket_src, socket_dst):
+                pipes[sock] = os.pipe()
+                try:
+                    fcntl.fcntl(pipes[sock][1], fcntl.F_SETPIPE_SZ, high)
+                except OSError:
+                    pass  # 超过/proc/sys/fs/pipe-max-size时使用默认容量
+        except OSError:
+            for pipe in pipes.values():
+                os.close(pipe[0])
+                os.close(pipe[1])
+            return False
+        capacity = {sock: fcntl.fcntl(pipe[1], fcntl.F_GETPIPE_SZ) for sock, pipe in pipes.items()}
+        pending = {socket_src: 0, socket_dst: 0}  # 管道中等待发送到该socket的字节数
+        flags = os.SPLICE_F_MOVE | os.SPLICE_F_NONBLOCK
+        moved = False
+        closing = False  # 任意一端关闭后停止读取,发送完管道中的数据后结束
+        socket_src.setblocking(False)
+        socket_dst.setblocking(False)
+        try:
+            while True:
+                if closing and not pending[socket_src] and not pending[socket_dst]:
+                    return
+                rlist = [sock for sock in (socket_src, socket_dst) if pending[peers[sock]] < capacity[peers[sock]] and not closing]
+                wlist = [sock for sock in (socket_src, socket_dst) if pending[sock]]
+                try:
+                    rlist, wlist, xlist = select.select(rlist, wlist, [], self.config.getint('server', 'timeout') if closing else None)
+                except select.error as err:
+                    # error
+                    return
+                if closing and not wlist:
+                    return
+                try:
+                    for sock in rlist:
+                        peer = peers[sock]
+                        try:
+                            size = os.splice(sock.fileno(), pipes[peer][1], capacity[peer] - pending[peer], flags=flags)
+                        except BlockingIOError:
+                            continue
+                        if size == 0:
+                            closing = True
+                            break
+                        moved = True
+                        pending[peer] += size
+                    for sock in (socket_src, socket_dst):
+                        if pending[sock]:
+                            try:
+                                pending[sock] -= os.splice(pipes[sock][0], sock.fileno(), pending[sock], flags=flags)
+                            except BlockingIOError:
+                                pass
+                except OSError as err:
+                    if not moved and err.errno in (errno.EINVAL, errno.ENOSYS):
+                        return False
+                    # error
+                    return
+        finally:
+            for pipe in pipes.values():
+                os.close(pipe[0])
+                os.close(pipe[1])
+
     def relay(self, socket_src, socket_dst):
         """
-        中继(relay)阶段
+        中继(relay)阶段,每个方向有一个发送队列,socket不可写时数据留在队列中等待select的wlist,
+        队列超过高水位时停止读取另一端,降到低水位以下后恢复
         :param socket_src:
         :param socket_dst:
         :return:
         """
+        if self.config.getboolean('server', 'splice', fallback=False) and self.splice_relay(socket_src, socket_dst) is not False:
+            return
+        buffer_size = self.config.getint('server', 'buffer_size')
+        high = self.config.getint('server', 'high_watermark', fallback=buffer_size * 16)
+        low = self.config.getint('server', 'low_watermark', fallback=buffer_size * 4)
+        peers = {socket_src: socket_dst, socket_dst: socket_src}
+        queues = {socket_src: bytearray(), socket_dst: bytearray()}  # 等待发送到该socket的数据
+        reading = {socket_src: True, socket_dst: True}
+        closing = False  # 任意一端关闭后停止读取,发送完队列中的数据后结束
+        socket_src.setblocking(False)
+        socket_dst.setblocking(False)
         while True:
+            if closing and not queues[socket_src] and not queues[socket_dst]:
+                return
+            rlist = [sock for sock in (socket_src, socket_dst) if reading[sock] and not closing]
+            wlist = [sock for sock in (socket_src, socket_dst) if queues[sock]]
             try:
-                rlist, wlist, xlist = select.select([socket_src, socket_dst], [], [])
+                rlist, wlist, xlist = select.select(rlist, wlist, [], self.config.getint('server', 'timeout') if closing else None)
             except select.error as err:
                 # error
                 return
-            if not rlist:
-                continue
+            if closing and not wlist:
+                return
             try:
+                for sock in wlist:
+                    sent = sock.send(queues[sock])
+                    del queues[sock][:sent]
                 for sock in rlist:
-                    data = sock.recv(self.config.getint('server', 'buffer_size'))
+                    data = sock.recv(buffer_size)
                     if data == b'':
-                        return
-                    if sock is socket_dst:
-                        socket_src.send(data)
-                    else:
-                        socket_dst.send(data)
+                        closing = True
+                        break
+                    queue = queues[peers[sock]]
+                    if not queue:
+                        try:
+                            data = data[peers[sock].send(data):]  # 队列为空时直接发送,只有未发送的部分进入队列
+                        except BlockingIOError:
+                            pass
+                    queue += data
             except socket.error as err:
                 # error
                 return
+            for sock in (socket_src, socket_dst):
+                if len(queues[peers[sock]]) >= high:
+                    reading[sock] = False
+                elif len(queues[peers[sock]]) <= low:
+                    reading[sock] = True
 
     def handshake(self, conn):
         """
@@ -0,0 +1,61 @@
+import sys
+import json
+import time
+import argparse
+import crypto
+from Crypto.Util import _cpu_features
+
+SUITES = [
+    ('rc4-v0', {'version': 0, 'suite': crypto.SUITE_RC4}),
+    ('rc4-v1', {'version': 1, 'suite': crypto.SUITE_RC4}),
+    ('aes-128-gcm', {'version': 1, 'suite': crypto.SUITE_AES_128_GCM}),
+    ('chacha20-poly1305', {'version': 1, 'suite': crypto.SUITE_CHACHA20_POLY1305}),
+]
+
+
+def bench(params, frame_size, total):
+    """
+    测量一个加密套件在指定帧大小下加密并解密的吞吐量
+    :param params: 连接参数
+    :param frame_size: 帧大小
+    :param total: 总数据量
+    :return: MB/s
+    """
+    key = b'0123456789abcdef0123456789abcdef'
+    client = crypto.CipherSession(key, params, client=True)
+    server = crypto.CipherSession(key, params, client=False)
+    frame = b'\x00' * frame_size
+    frames = max(total // frame_size, 1)
+    start = time.perf_counter()
+    for _ in range(frames):
+        server.decrypt(client.encrypt(frame))
+    elapsed = time.perf_counter() - start
+    return frames * frame_size / elapsed / 1e6
+
+
+def main():
+    parser = argparse.ArgumentParser(description="加密套件吞吐量对比")
+    parser.add_argument('--sizes', default='64,512,4096,16384,65536', help="帧大小,逗号分隔")
+    parser.add_argument('--total', type=int, default=32 * 1024 * 1024, help="每项测试的数据量(字节)")
+    parser.add_argument('--json', action='store_true', help="输出JSON")
+    args = parser.parse_args()
+    sizes = [int(size) for size in args.sizes.split(',')]
+
+    results = {'aes_ni': bool(_cpu_features.have_aes_ni()), 'clmul': bool(_cpu_features.have_clmul()), 'results': []}
+    for name, params in SUITES:
+        for size in sizes:
+            results['results'].append({'suite': name, 'frame_size': size, 'mb_per_s': bench(params, size, args.total)})
+
+    if args.json:
+        json.dump(results, sys.stdout, indent=2)
+        print()
+        return
+    print("AES-NI: {}  CLMUL: {}".format(results['aes_ni'], results['clmul']))
+    print("{:<20}".format('suite') + ''.join("{:>10}".format(size) for size in sizes) + "  (MB/s, encrypt+decrypt)")
+    for name, params in SUITES:
+        row = [result['mb_per_s'] for result in results['results'] if result['suite'] == name]
+        print("{:<20}".format(name) + ''.join("{:>10.1f}".format(value) for value in row))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,139 @@
+import os
+import sys
+import json
+import time
+import struct
+import socket
+import argparse
+import threading
+import frame
+
+
+class Legacy:
+    """
+    原中继的解析方式:bytes拼接接收到的数据并反复切片[4:],修正了长度前缀跨读取和一次读取包含多个帧的问题,
+    以便与FrameDecoder处理相同的数据
+    """
+
+    def __init__(self):
+        self.data = b''
+        self.copied = 0
+
+    def feed(self, data):
+        self.data += data
+        self.copied += len(self.data)
+        while len(self.data) >= 4:
+            length = struct.unpack(">I", self.data[0:4])[0]
+            self.copied += len(self.data) - 4  # len(self.data[4:])
+            if length > len(self.data[4:]):
+                break
+            self.copied += len(self.data) - 4 + length  # 判断相等时的[4:]和取帧的[4:4 + length]
+            yield self.data[4:4 + length]
+            self.data = self.data[4 + length:]
+            self.copied += len(self.data)
+
+
+def stream(frame_size, total):
+    """
+    :return: 由长度前缀和随机内容组成的帧序列
+    """
+    payload = os.urandom(frame_size)
+    count = max(total // frame_size, 1)
+    return (struct.pack(">I", frame_size) + payload) * count, count
+
+
+def bench(decoder, data, chunk_size):
+    """
+    按chunk_size分块送入解析器,模拟每次recv返回的数据
+    :return: (帧数量,MB/s)
+    """
+    frames = 0
+    view = memoryview(data)
+    start = time.perf_counter()
+    for offset in range(0, len(data), chunk_size):
+        for _ in decoder.feed(view[offset:offset + chunk_size].tobytes()):
+            frames += 1
+    elapsed = time.perf_counter() - start
+    return frames, len(data) / elapsed / 1e6
+
+
+def bench_writer(latency, frame_size, count):
+    """
+    连续发送count个帧,对端线程持续读取
+    :param latency: FrameWriter的latency,None表示原来的拼接后sendall
+    :return: (系统调用次数,MB/s)
+    """
+    src, dst = socket.socketpair()
+
+    def drain():
+        while dst.recv(1 << 20):
+            pass
+
+    thread = threading.Thread(target=drain)
+    thread.start()
+    payload = os.urandom(frame_size)
+    writer = frame.FrameWriter(src, latency)
+    start = time.perf_counter()
+    for _ in range(count):
+        if latency is None:
+            src.sendall(struct.pack(">I", len(payload)) + payload)
+        else:
+            writer.write(payload)
+    writer.flush()
+    elapsed = time.perf_counter() - start
+    src.close()
+    thread.join()
+    dst.close()
+    syscalls = count if latency is None else writer.syscalls
+    return syscalls, count * frame_size / elapsed / 1e6
+
+
+def main():
+    parser = argparse.ArgumentParser(description="帧解析的复制量和吞吐量对比")
+    parser.add_argument('--frames', default='64,4096,65536,1048576', help="帧大小,逗号分隔")
+    parser.add_argument('--chunk', type=int, default=4096, help="每次读取的大小")
+    parser.add_argument('--total', type=int, default=16 * 1024 * 1024, help="每项测试的数据量(字节)")
+    parser.add_argument('--json', action='store_true', help="输出JSON")
+    parser.add_argument('--writer', action='store_true', help="测试发送端的帧合并")
+    parser.add_argument('--latency', type=float, default=1, help="帧合并的最长等待时间(毫秒)")
+    args = parser.parse_args()
+    if args.writer:
+        return main_writer(args)
+
+    results = []
+    for frame_size in [int(size) for size in args.frames.split(',')]:
+        data, count = stream(frame_size, args.total)
+        for name, decoder in (('legacy', Legacy()), ('decoder', frame.FrameDecoder(frame.BufferPool()))):
+            frames, throughput = bench(decoder, data, args.chunk)
+            assert frames == count, (name, frames, count)
+            copied = decoder.copied + (decoder.received if name == 'decoder' else 0)
+            results.append({'decoder': name, 'frame_size': frame_size, 'chunk': args.chunk, 'mb_per_s': throughput, 'copy_ratio': copied / len(data)})
+
+    if args.json:
+        json.dump(results, sys.stdout, indent=2)
+        print()
+        return
+    print("{:<10}{:>10}{:>12}{:>14}".format('decoder', 'frame', 'MB/s', 'copy/byte'))
+    for result in results:
+        print("{decoder:<10}{frame_size:>10}{mb_per_s:>12.1f}{copy_ratio:>14.2f}".format(**result))
+
+
+def main_writer(args):
+    results = []
+    for frame_size in [int(size) for size in args.frames.split(',')]:
+        count = max(args.total // frame_size, 1)
+        for name, latency in (('concat', None), ('immediate', 0), ('coalesce', args.latency / 1000)):
+            syscalls, throughput = bench_writer(latency, frame_size, count)
+            results.append({'writer': name, 'frame_size': frame_size, 'frames': count, 'syscalls': syscalls, 'mb_per_s': throughput})
+
+    if args.json:
+        json.dump(results, sys.stdout, indent=2)
+        print()
+        return
+    print("{:<10}{:>10}{:>10}{:>10}{:>12}".format('writer', 'frame', 'frames', 'syscalls', 'MB/s'))
+    for result in results:
+        print("{writer:<10}{frame_size:>10}{frames:>10}{syscalls:>10}{mb_per_s:>12.1f}".format(**result))
+
+
+if __name__ == '__main__':
+    main()
@@ -1,60 +1,638 @@
 from Crypto.PublicKey import RSA  # pycryptodome
 from Crypto.Cipher import PKCS1_v1_5 as Cipher_pkcs1_v1_5
+from Crypto.Cipher import AES, ChaCha20_Poly1305
 from arc4 import ARC4  # arc4
 from tinyec import registry  # tinyec ECC 曲线库
 from tinyec import ec
+
+try:
+    from cryptography.hazmat.primitives.asymmetric import ec as openssl_ec  # cryptography,可选
+except ImportError:
+    openssl_ec = None
+try:
+    from cryptography.hazmat.primitives.ciphers import aead as openssl_aead  # cryptography,可选
+    from cryptography.exceptions import InvalidTag
+except ImportError:
+    openssl_aead = None
+import os
+import mmap
 import secrets
 import datetime
 import calendar
 import struct
 import hashlib
+import logging
+import hmac
+import time
+import threading
+import collections
+import multiprocessing
 
 
-class ECDH:
+class TinyecBackend:
+    """
+    tinyec密钥交换实现,点乘使用纯Python的double-and-add
+    """
+
     def __init__(self, curve):
         self.curve = registry.get_curve(curve)
-        self.public_key = RSA.importKey(open("public.pem").read())
-        self.private_key = RSA.importKey(open("private.key").read())
-        self.ecc_private_key = secrets.randbelow(self.curve.field.n)
+
+    def generate_private_key(self):
+        return secrets.randbelow(self.curve.field.n)
+
+    def public_key(self, private_key):
+        """
+        :return: (x,y)
+        """
+        point = private_key * self.curve.g
+        return point.x, point.y
+
+    def exchange(self, private_key, x, y):
+        """
+        :return: 共享点(x,y) | None(对方公钥不在曲线上)
+        """
+        if not self.curve.on_curve(x, y):
+            return
+        point = private_key * ec.Point(self.curve, x, y)
+        return point.x, point.y
+
+
+class TableBackend(TinyecBackend):
+    """
+    与tinyec结果一致的快速实现,公钥使用预计算的生成元固定窗口表,共享密钥使用雅可比坐标,每次点乘只需一次模逆
+    """
+    window = 4
+    tables = {}  # 曲线名称 -> 固定窗口表,进程内共享
+    lock = threading.Lock()
+
+    def __init__(self, curve):
+        super().__init__(curve)
+        self.p = self.curve.field.p
+        self.a = self.curve.a
+        with self.lock:
+            if curve not in self.tables:
+                self.tables[curve] = self.build_table()
+        self.table = self.tables[curve]
+
+    def double(self, point):
+        if point is None:
+            return
+        x, y, z = point
+        if y == 0:
+            return
+        p = self.p
+        yy = y * y % p
+        s = 4 * x * yy % p
+        m = (3 * x * x + self.a * pow(z, 4, p)) % p
+        x3 = (m * m - 2 * s) % p
+        y3 = (m * (s - x3) - 8 * yy * yy) % p
+        z3 = 2 * y * z % p
+        return x3, y3, z3
+
+    def add_affine(self, point, affine):
+        """
+        雅可比坐标点与仿射坐标点相加
+        """
+        if affine is None:
+            return point
+        if point is None:
+            return affine[0], affine[1], 1
+        p = self.p
+        x1, y1, z1 = point
+        x2, y2 = affine
+        zz = z1 * z1 % p
+        h = (x2 * zz - x1) % p
+        r = (y2 * zz * z1 - y1) % p
+        if h == 0:
+            if r == 0:
+                return self.double(point)
+            return
+        hh = h * h % p
+        hhh = h * hh % p
+        v = x1 * hh % p
+        x3 = (r * r - hhh - 2 * v) % p
+        y3 = (r * (v - x3) - y1 * hhh) % p
+        z3 = z1 * h % p
+        return x3, y3, z3
+
+    def to_affine(self, point):
+        if point is None:
+            return
+        x, y, z = point
+        z_inv = pow(z, -1, self.p)
+        zz_inv = z_inv * z_inv % self.p
+        return x * zz_inv % self.p, y * zz_inv * z_inv % self.p
+
+    def build_table(self):
+        """
+        预计算 table[i][j] = j * 2^(window*i) * G
+        """
+        table = []
+        base = (self.curve.g.x, self.curve.g.y)
+        for _ in range((self.curve.field.n.bit_length() + self.window - 1) // self.window):
+            row = [None, base]
+            point = (base[0], base[1], 1)
+            for _ in range(2, 1 << self.window):
+                point = self.add_affine(point, base)
+                row.append(self.to_affine(point))
+            table.append(row)
+            point = self.add_affine(point, base)  # 2^window * base
+            base = self.to_affine(point)
+        return table
+
+    def public_key(self, private_key):
+        mask = (1 << self.window) - 1
+        point = None
+        for row in self.table:
+            point = self.add_affine(point, row[private_key & mask])
+            private_key >>= self.window
+        return self.to_affine(point)
+
+    def exchange(self, private_key, x, y):
+        if not self.curve.on_curve(x, y):
+            return
+        point = None
+        for bit in bin(private_key)[2:]:
+            point = self.double(point)
+            if bit == '1':
+                point = self.add_affine(point, (x, y))
+        return self.to_affine(point)
+
+
+class CryptographyBackend(TinyecBackend):
+    """
+    使用cryptography库(OpenSSL)进行密钥交换,OpenSSL只返回共享点的x坐标
+    """
+    curves = {
+        'brainpoolP256r1': 'BrainpoolP256R1',
+        'brainpoolP384r1': 'BrainpoolP384R1',
+        'brainpoolP512r1': 'BrainpoolP512R1',
+        'secp192r1': 'SECP192R1',
+        'secp224r1': 'SECP224R1',
+        'secp256r1': 'SECP256R1',
+        'secp384r1': 'SECP384R1',
+        'secp521r1': 'SECP521R1',
+    }
+
+    def __init__(self, curve):
+        super().__init__(curve)
+        self.ec_curve = getattr(openssl_ec, self.curves[curve])()
+
+    def generate_private_key(self):
+        return openssl_ec.generate_private_key(self.ec_curve)
+
+    def public_key(self, private_key):
+        numbers = private_key.public_key().public_numbers()
+        return numbers.x, numbers.y
+
+    def exchange(self, private_key, x, y):
+        try:
+            public_key = openssl_ec.EllipticCurvePublicNumbers(x, y, self.ec_curve).public_key()
+        except ValueError:
+            return
+        return int.from_bytes(private_key.exchange(openssl_ec.ECDH(), public_key), 'big'), None
+
+
+backends = {}
+
+
+def get_backend(curve, name='tinyec'):
+    """
+    获取密钥交换实现,同一曲线的实现在进程内共享
+    :param curve: 曲线名称
+    :param name: tinyec | table | cryptography
+    """
+    if name == 'cryptography' and (openssl_ec is None or curve not in CryptographyBackend.curves):
+        logging.error("cryptography is not installed or does not support %s, using table backend", curve)
+        name = 'table'
+    if (curve, name) not in backends:
+        backend = {'tinyec': TinyecBackend, 'table': TableBackend, 'cryptography': CryptographyBackend}[name]
+        backends[(curve, name)] = backend(curve)
+    return backends[(curve, name)]
+
+
+Keys = collections.namedtuple('Keys', ['public_key', 'private_key', 'encryptor', 'decryptor'])
+
+
+class KeyStore:
+    """
+    进程内共享的RSA密钥,启动时读取并解析一次,后台线程检查文件修改时间,文件变化后重新加载并整体替换
+    """
+
+    def __init__(self, public_path="public.pem", private_path="private.key", interval=1):
+        self.public_path = public_path
+        self.private_path = private_path
+        self.interval = interval
+        self.load_time = 0.0  # 最近一次加载耗时(秒)
+        self.reload_count = 0
+        self.mtimes = None
+        self.keys = self.load()
+        self.pid = None
+        self.watch()
+
+    def load(self):
+        start = time.perf_counter()
+        mtimes = (os.stat(self.public_path).st_mtime_ns, os.stat(self.private_path).st_mtime_ns)
+        with open(self.public_path) as f:
+            public_key = RSA.importKey(f.read())
+        with open(self.private_path) as f:
+            private_key = RSA.importKey(f.read())
+        keys = Keys(public_key, private_key, Cipher_pkcs1_v1_5.new(public_key), Cipher_pkcs1_v1_5.new(private_key))  # 创建用于执行pkcs1_v1_5加密或解密的密码
+        self.mtimes = mtimes
+        self.load_time = time.perf_counter() - start
+        return keys
+
+    def watch(self):
+        """
+        启动检查文件变化的后台线程,fork之后的子进程需要重新启动
+        """
+        if self.pid == os.getpid():
+            return
+        self.pid = os.getpid()
+        thread = threading.Thread(target=self.poll, daemon=True)
+        thread.start()
+
+    def poll(self):
+        while True:
+            time.sleep(self.interval)
+            try:
+                mtimes = (os.stat(self.public_path).st_mtime_ns, os.stat(self.private_path).st_mtime_ns)
+                if mtimes != self.mtimes:
+                    self.keys = self.load()
+                    self.reload_count += 1
+            except (OSError, ValueError, IndexError, TypeError):
+                logging.exception("Failed to reload keys")  # 保留原有密钥
+
+    def get(self):
+        self.watch()
+        return self.keys
+
+    def stats(self):
+        return {'load_time': self.load_time, 'reload_count': self.reload_count}
+
+
+key_store = None
+key_store_lock = threading.Lock()
+
+
+def get_key_store():
+    """
+    获取进程内共享的KeyStore
+    """
+    global key_store
+    if key_store is None:
+        with key_store_lock:
+            if key_store is None:
+                key_store = KeyStore()
+    return key_store
+
+
+class ECDH:
+    def __init__(self, curve, backend='tinyec'):
+        self.backend = get_backend(curve, backend)
+        self.keys = get_key_store().get()
+        self.public_key = self.keys.public_key
+        self.private_key = self.keys.private_key
+        self.ecc_private_key = self.backend.generate_private_key()
 
     def encrypt(self, plain_text):
-        cipher = Cipher_pkcs1_v1_5.new(self.public_key)  # 创建用于执行pkcs1_v1_5加密或解密的密码
-        cipher_text = cipher.encrypt(plain_text)
+        cipher_text = self.keys.encryptor.encrypt(plain_text)
         return cipher_text
 
     def decrypt(self, cipher_text):
-        cipher = Cipher_pkcs1_v1_5.new(self.private_key)  # 创建用于执行pkcs1_v1_5加密或解密的密码
-        plain_text = cipher.decrypt(cipher_text, 'ERROR')
+        plain_text = self.keys.decryptor.decrypt(cipher_text, 'ERROR')
         return plain_text
 
-    def generate_first_handshake_data(self):
+    @property
+    def handshake_size(self):
+        """
+        握手数据的长度,即RSA密文的长度,双方使用相同的密钥对
+        """
+        return self.keys.public_key.size_in_bytes()
+
+    def generate_first_handshake_data(self, extensions=None):
+        """
+        :param extensions: 握手扩展 {类型: 值},位于公钥和哈希之间,旧版本会忽略
+        """
         timestamp = calendar.timegm(datetime.datetime.utcnow().utctimetuple())
         timestamp_hex = struct.pack('>L', timestamp)
 
-        ecc_public_key = self.ecc_private_key * self.curve.g
-        ecc_public_key_x = bytes(hex(ecc_public_key.x)[2:].zfill(64).encode())
-        ecc_public_key_y = bytes(hex(ecc_public_key.y)[2:].zfill(64).encode())
+        x, y = self.backend.public_key(self.ecc_private_key)
+        ecc_public_key_x = bytes(hex(x)[2:].zfill(64).encode())
+        ecc_public_key_y = bytes(hex(y)[2:].zfill(64).encode())
+        extensions_data = pack_extensions(extensions or {})
 
-        message = timestamp_hex + ecc_public_key_x + ecc_public_key_y + hashlib.sha256(timestamp_hex + ecc_public_key_x + ecc_public_key_y).digest()
+        message = timestamp_hex + ecc_public_key_x + ecc_public_key_y + extensions_data + hashlib.sha256(timestamp_hex + ecc_public_key_x + ecc_public_key_y + extensions_data).digest()
         data = self.encrypt(message)
         return data
 
     def parse_share_key_from_first_handshake_data(self, data):
+        """
+        解析对方的握手数据,对方的握手扩展保存在self.extensions中
+        """
         text = self.decrypt(data)
         timestamp = struct.unpack('>L', text[0:4])[0]
         sha256_hash = text[-32:]
         ecc_public_key_x = int(text[4:68].decode(), 16)
         ecc_public_key_y = int(text[68:132].decode(), 16)
-        ecc_public_key = ec.Point(self.curve, ecc_public_key_x, ecc_public_key_y)
+        self.extensions = parse_extensions(text[132:-32])
 
         if sha256_hash == hashlib.sha256(text[:-32]).digest() and calendar.timegm(datetime.datetime.utcnow().utctimetuple()) - timestamp < 5:  # 哈希校验&时间戳校验
-            share_key = self.ecc_private_key * ecc_public_key
-            share_key = hex(share_key.x) + hex(share_key.y % 2)[2:]
+            share_point = self.backend.exchange(self.ecc_private_key, ecc_public_key_x, ecc_public_key_y)
+            if not share_point:
+                return
+            x, y = share_point
+            share_key = hex(x) + (hex(y % 2)[2:] if y is not None else '0')  # 连接密钥取[10:42],只与x坐标有关
             return share_key
         else:
             return
 
 
+EXTENSION_VERSION = 0x01  # 协议版本
+PROTOCOL_VERSION = 1  # 0: 每帧重新初始化ARC4; 1: 每个方向使用持续推进的ARC4密钥流
+
+
+def pack_extensions(extensions):
+    """
+    握手扩展编码为 类型(1字节) + 长度(1字节) + 值
+    """
+    return b''.join(struct.pack('>BB', extension_type, len(value)) + value for extension_type, value in sorted(extensions.items()))
+
+
+def parse_extensions(data):
+    extensions = {}
+    offset = 0
+    while offset + 2 <= len(data):
+        extension_type, length = struct.unpack('>BB', data[offset:offset + 2])
+        extensions[extension_type] = data[offset + 2:offset + 2 + length]
+        offset += 2 + length
+    return extensions
+
+
+SUITE_RC4 = 0
+SUITE_AES_128_GCM = 1
+SUITE_CHACHA20_POLY1305 = 2
+SUITES = {'rc4': SUITE_RC4, 'aes-128-gcm': SUITE_AES_128_GCM, 'chacha20-poly1305': SUITE_CHACHA20_POLY1305}
+EXTENSION_SUITES = 0x02  # 加密套件,客户端按优先级列出,服务端选择一个
+EXTENSION_MAX_FRAME = 0x03  # 最大帧长度(>I),双方取较小值,没有该扩展时每帧不超过buffer_size
+EXTENSION_EARLY_DATA = 0x04  # 0-RTT请求,客户端为加密套件(1字节)+早期密钥材料,服务端为b'\x01'表示已接受
+EARLY_SECRET_LENGTH = 32
+
+
+def parse_suites(text):
+    """
+    解析配置中的加密套件列表
+    :param text: 逗号分隔的套件名称,按优先级排列
+    :return: (套件编号,...)
+    """
+    return tuple(SUITES[name.strip()] for name in text.split(',') if name.strip())
+
+
+def parse_max_frame(extensions):
+    """
+    :return: 扩展中的最大帧长度 | 0(没有该扩展)
+    """
+    value = extensions.get(EXTENSION_MAX_FRAME, b'')
+    if len(value) != 4:
+        return 0
+    return struct.unpack('>I', value)[0]
+
+
+def client_extensions(suites=(SUITE_RC4,), max_frame=0):
+    """
+    客户端在握手中提供的扩展
+    :param suites: 客户端支持的加密套件,按优先级排列
+    :param max_frame: 客户端的最大帧长度,0表示不协商
+    """
+    extensions = {EXTENSION_VERSION: bytes([PROTOCOL_VERSION]), EXTENSION_SUITES: bytes(suites)}
+    if max_frame:
+        extensions[EXTENSION_MAX_FRAME] = struct.pack('>I', max_frame)
+    return extensions
+
+
+def server_negotiate(extensions, suites=(SUITE_RC4,), max_frame=0):
+    """
+    服务端根据客户端的扩展选择连接参数,加密套件按服务端的优先级选择
+    :param extensions: 客户端的握手扩展
+    :param suites: 服务端支持的加密套件,按优先级排列
+    :param max_frame: 服务端的最大帧长度,0表示不协商
+    :return: (连接参数,服务端的握手扩展) | (None,None)(没有双方都支持的加密套件)
+    """
+    version = min(PROTOCOL_VERSION, extensions.get(EXTENSION_VERSION, b'\x00')[0])
+    offered = extensions.get(EXTENSION_SUITES, bytes([SUITE_RC4]))  # 旧版本客户端只支持RC4
+    for suite in suites:
+        if suite in offered:
+            params = {'version': version, 'suite': suite, 'max_frame': 0}
+            reply = {EXTENSION_VERSION: bytes([version]), EXTENSION_SUITES: bytes([suite])}
+            client_max_frame = parse_max_frame(extensions)
+            if max_frame and client_max_frame:
+                params['max_frame'] = min(max_frame, client_max_frame)
+                reply[EXTENSION_MAX_FRAME] = struct.pack('>I', params['max_frame'])
+            return params, reply
+    return None, None
+
+
+def client_negotiate(extensions, suites=(SUITE_RC4,)):
+    """
+    客户端从服务端的扩展中获取连接参数,旧版本服务端没有扩展
+    :param extensions: 服务端的握手扩展
+    :param suites: 客户端提供的加密套件
+    :return: 连接参数 | None(服务端选择了客户端没有提供的加密套件)
+    """
+    suite = extensions.get(EXTENSION_SUITES, bytes([SUITE_RC4]))[0]
+    if suite not in suites:
+        return
+    return {'version': extensions.get(EXTENSION_VERSION, b'\x00')[0], 'suite': suite, 'max_frame': parse_max_frame(extensions)}
+
+
+class EarlyData:
+    """
+    0-RTT握手。客户端在RSA加密的握手数据中携带随机的早期密钥材料,用其派生的密钥加密请求,与握手数据一起发送;
+    服务端解密握手数据后即可解密请求,不必等待ECDH协商完成。早期数据没有前向安全性,请求之后的数据仍使用ECDH密钥
+    """
+
+    def __init__(self, suite, secret=None):
+        """
+        :param suite: 加密早期数据的加密套件,客户端取优先级最高的套件
+        :param secret: 早期密钥材料,为空时随机生成
+        """
+        self.suite = suite
+        self.secret = secret or secrets.token_bytes(EARLY_SECRET_LENGTH)
+
+    def extension(self):
+        return bytes([self.suite]) + self.secret
+
+    @classmethod
+    def parse(cls, extensions):
+        """
+        :param extensions: 客户端的握手扩展
+        :return: EarlyData | None(客户端没有发送早期数据)
+        """
+        value = extensions.get(EXTENSION_EARLY_DATA, b'')
+        if len(value) != 1 + EARLY_SECRET_LENGTH:
+            return
+        return cls(value[0], value[1:])
+
+    def cipher(self, client):
+        key = hashlib.sha256(b'early data' + self.secret).hexdigest()[:32].encode()
+        return CipherSession(key, {'version': PROTOCOL_VERSION, 'suite': self.suite, 'max_frame': 0}, client)
+
+
+class ReplayCache:
+    """
+    服务端记录最近使用过的早期密钥材料,拒绝被重放的0-RTT请求。握手数据的时间戳只在几秒内有效,
+    窗口取更大的值以容忍双方的时钟偏差
+    """
+
+    def __init__(self, window=60, size=65536):
+        self.window = window
+        self.size = size
+        self.seen = collections.OrderedDict()  # 早期密钥材料: 记录时间
+        self.lock = threading.Lock()
+        self.replays = 0
+
+    def check(self, secret):
+        """
+        :param secret: 早期密钥材料
+        :return: 是否第一次出现
+        """
+        now = time.monotonic()
+        with self.lock:
+            while self.seen and (len(self.seen) >= self.size or now - next(iter(self.seen.values())) >= self.window):
+                self.seen.popitem(last=False)
+            if secret in self.seen:
+                self.replays += 1
+                return False
+            self.seen[secret] = now
+            return True
+
+
+RESUME = b'RSM\x01'  # 会话恢复请求/响应标识
+RESUME_MISS = b'RSM\x00'  # 服务端没有对应的会话,客户端需要在同一连接上进行完整握手
+RESUME_LENGTH = 4 + 16 + 16 + 4 + 32
+RESUME_REPLY_LENGTH = 4 + 16 + 32
+SESSION_SLOT = struct.Struct('>16s32sBBId')  # 会话缓存的槽位:会话编号,会话密钥,协议版本,加密套件,最大帧长度,创建时间
+
+
+class Session:
+    """
+    完整握手得到的会话,保存会话编号和会话密钥,用于之后的连接跳过公钥运算直接派生新的连接密钥
+    """
+
+    def __init__(self, key, params):
+        """
+        :param key: 完整握手得到的连接密钥
+        :param params: 完整握手协商的连接参数,恢复的连接沿用
+        """
+        self.session_id = hashlib.sha256(b'session id' + key).digest()[:16]
+        self.secret = hashlib.sha256(b'session secret' + key).digest()
+        self.params = params
+        self.created = time.monotonic()
+
+    @classmethod
+    def restore(cls, session_id, secret, params, created):
+        """
+        从会话缓存的槽位恢复服务端的会话
+        """
+        session = cls.__new__(cls)
+        session.session_id = session_id
+        session.secret = secret
+        session.params = params
+        session.created = created
+        return session
+
+    def derive_key(self, client_nonce, server_nonce):
+        return hashlib.sha256(self.secret + client_nonce + server_nonce).hexdigest()[:32].encode()
+
+    def generate_resume_data(self):
+        """
+        客户端生成会话恢复请求
+        :return: (请求数据,客户端随机数)
+        """
+        client_nonce = secrets.token_bytes(16)
+        timestamp_hex = struct.pack('>L', calendar.timegm(datetime.datetime.utcnow().utctimetuple()))
+        message = RESUME + self.session_id + client_nonce + timestamp_hex
+        return message + hmac.new(self.secret, message, hashlib.sha256).digest(), client_nonce
+
+    def parse_resume_reply(self, data, client_nonce):
+        """
+        客户端解析会话恢复响应
+        :param data: 服务端响应
+        :param client_nonce: 客户端随机数
+        :return: 连接密钥 | None(服务端没有对应的会话)
+        """
+        if len(data) != RESUME_REPLY_LENGTH or data[0:4] != RESUME:
+            return
+        server_nonce = data[4:20]
+        if not hmac.compare_digest(data[20:], hmac.new(self.secret, b'server' + client_nonce + server_nonce, hashlib.sha256).digest()):
+            return
+        return self.derive_key(client_nonce, server_nonce)
+
+
+class SessionCache:
+    """
+    服务端会话缓存,保存在创建时映射的匿名共享内存中。多进程模式下工作进程从管理进程fork,共用同一个缓存,
+    会话恢复请求被SO_REUSEPORT分配到任意工作进程都能命中。会话编号映射到固定的槽位,冲突时覆盖旧的会话,
+    超过有效期的会话不再使用;命中率按进程统计
+    """
+
+    def __init__(self, size, ttl):
+        self.size = size
+        self.ttl = ttl
+        self.memory = mmap.mmap(-1, size * SESSION_SLOT.size)  # MAP_SHARED,fork之后父子进程读写同一块内存
+        self.lock = multiprocessing.get_context('fork').Lock()  # 跨进程的锁,避免读到写了一半的槽位
+        self.hits = 0
+        self.misses = 0
+
+    def offset(self, session_id):
+        return int.from_bytes(session_id[:4], 'big') % self.size * SESSION_SLOT.size
+
+    def put(self, session):
+        params = session.params
+        with self.lock:
+            SESSION_SLOT.pack_into(self.memory, self.offset(session.session_id), session.session_id, session.secret,
+                                   params['version'], params['suite'], params['max_frame'], session.created)
+
+    def get(self, session_id):
+        """
+        :return: Session | None(没有该会话或已过期,计为未命中)
+        """
+        with self.lock:
+            slot = SESSION_SLOT.unpack_from(self.memory, self.offset(session_id))
+        stored_id, secret, version, suite, max_frame, created = slot
+        if stored_id != session_id or time.monotonic() - created >= self.ttl:  # CLOCK_MONOTONIC在所有进程中一致
+            self.misses += 1
+            return
+        return Session.restore(session_id, secret, {'version': version, 'suite': suite, 'max_frame': max_frame}, created)
+
+    def parse_resume_data(self, data):
+        """
+        服务端解析会话恢复请求,客户端的HMAC和时间戳校验通过后才计为命中,伪造或过期的请求计为未命中
+        :param data: 客户端请求
+        :return: (响应数据,Session,连接密钥) | (RESUME_MISS,None,None)
+        """
+        session = self.get(data[4:20])
+        if not session:
+            return RESUME_MISS, None, None
+        client_nonce = data[20:36]
+        timestamp = struct.unpack('>L', data[36:40])[0]
+        if not hmac.compare_digest(data[40:], hmac.new(session.secret, data[:40], hashlib.sha256).digest()) or calendar.timegm(datetime.datetime.utcnow().utctimetuple()) - timestamp >= 5:  # 消息认证码校验&时间戳校验
+            self.misses += 1
+            return RESUME_MISS, None, None
+        self.hits += 1
+        server_nonce = secrets.token_bytes(16)
+        reply = RESUME + server_nonce + hmac.new(session.secret, b'server' + client_nonce + server_nonce, hashlib.sha256).digest()
+        return reply, session, session.derive_key(client_nonce, server_nonce)
+
+    def stats(self):
+        now = time.monotonic()
+        with self.lock:
+            slots = [SESSION_SLOT.unpack_from(self.memory, offset) for offset in range(0, len(self.memory), SESSION_SLOT.size)]
+        total = self.hits + self.misses
+        size = sum(1 for slot in slots if slot[-1] and now - slot[-1] < self.ttl)
+        return {'size': size, 'hits': self.hits, 'misses': self.misses, 'hit_rate': self.hits / total if total else 0.0}
+
+
 class Cipher:
     def encrypt(self, key, plaintext):
         arc4 = ARC4(key)
@@ -67,6 +645,107 @@ class Cipher:
         return data
 
 
+class AEAD:
+    """
+    一个方向的AEAD加密,每次加密或解密一帧,nonce为4字节0加8字节递增计数器,认证标签附加在密文之后。
+    安装了cryptography时使用OpenSSL的实现,密钥只初始化一次;否则每帧创建pycryptodome的加密对象,小帧开销较大
+    """
+    tag_size = 16
+
+    def __init__(self, suite, key):
+        self.suite = suite
+        self.key = key
+        self.counter = 0
+        self.context = None
+        if openssl_aead is not None:
+            if suite == SUITE_AES_128_GCM:
+                self.context = openssl_aead.AESGCM(key)
+            else:
+                self.context = openssl_aead.ChaCha20Poly1305(key)
+
+    def nonce(self):
+        nonce = struct.pack('>4xQ', self.counter)
+        self.counter += 1
+        return nonce
+
+    def new(self):
+        if self.suite == SUITE_AES_128_GCM:
+            return AES.new(self.key, AES.MODE_GCM, nonce=self.nonce())  # pycryptodome在支持AES-NI的CPU上使用硬件加速
+        return ChaCha20_Poly1305.new(key=self.key, nonce=self.nonce())
+
+    def encrypt(self, plaintext):
+        if self.context is not None:
+            return self.context.encrypt(self.nonce(), plaintext, None)
+        cipher_text, tag = self.new().encrypt_and_digest(plaintext)
+        return cipher_text + tag
+
+    def decrypt(self, data):
+        """
+        :raise ValueError: 认证失败
+        """
+        if len(data) < self.tag_size:
+            raise ValueError("Frame too short")
+        if self.context is not None:
+            try:
+                return self.context.decrypt(self.nonce(), data, None)
+            except InvalidTag:
+                raise ValueError("MAC check failed")
+        return self.new().decrypt_and_verify(data[:-self.tag_size], data[-self.tag_size:])
+
+
+class CipherSession:
+    """
+    一个连接的加密会话,握手完成后创建一次。
+    RC4版本0每帧重新初始化ARC4,与旧版本兼容;
+    RC4版本1每个方向使用各自派生的密钥创建一次ARC4,密钥流在帧之间持续推进;
+    AES-128-GCM和ChaCha20-Poly1305每帧附加16字节认证标签,解密失败时抛出ValueError
+    """
+
+    def __init__(self, key, params, client):
+        """
+        :param key: 连接密钥
+        :param params: 协商的连接参数
+        :param client: 是否为客户端,决定加密和解密分别使用哪个方向的密钥
+        """
+        self.key = key
+        self.params = params
+        self.early_data = None  # 0-RTT握手中随握手数据发送并被服务端接受的请求
+        self.version = params['version']
+        self.suite = params.get('suite', SUITE_RC4)
+        self.overhead = 0  # 每帧密文比明文多出的字节数
+        self.encryptor = self.decryptor = None
+        upstream_key = hashlib.sha256(key + b'client to server').digest()
+        downstream_key = hashlib.sha256(key + b'server to client').digest()
+        if self.suite == SUITE_AES_128_GCM:
+            upstream, downstream = AEAD(self.suite, upstream_key[:16]), AEAD(self.suite, downstream_key[:16])
+            self.overhead = AEAD.tag_size
+        elif self.suite == SUITE_CHACHA20_POLY1305:
+            upstream, downstream = AEAD(self.suite, upstream_key), AEAD(self.suite, downstream_key)
+            self.overhead = AEAD.tag_size
+        elif self.version >= 1:
+            upstream, downstream = ARC4(upstream_key), ARC4(downstream_key)
+        else:
+            self.cipher = Cipher()
+            return
+        self.encryptor, self.decryptor = (upstream, downstream) if client else (downstream, upstream)
+
+    def encrypt(self, plaintext):
+        if self.encryptor:
+            return self.encryptor.encrypt(plaintext)
+        return self.cipher.encrypt(self.key, plaintext)
+
+    def decrypt(self, ciphertext):
+        """
+        :param ciphertext: bytes | memoryview(frame.FrameDecoder返回的帧)
+        :raise ValueError: AEAD认证失败
+        """
+        if self.suite == SUITE_RC4 and isinstance(ciphertext, memoryview):
+            ciphertext = ciphertext.tobytes()  # arc4只接受bytes
+        if self.decryptor:
+            return self.decryptor.decrypt(ciphertext)
+        return self.cipher.decrypt(self.key, ciphertext)
+
+
 if __name__ == '__main__':
     from configparser import ConfigParser
 
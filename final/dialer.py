@@ -0,0 +1,121 @@
+import time
+import errno
+import socket
+import asyncio
+import selectors
+
+CONNECTION_ATTEMPT_DELAY = 0.25  # RFC 8305建议的连接尝试间隔
+
+
+def interleave(addresses):
+    """
+    按地址族交替排列地址,每个地址族内保持getaddrinfo的优先顺序,第一个地址的地址族优先(RFC 8305 第4节)
+    :param addresses: [(family,ip)]
+    :return: [(family,ip)]
+    """
+    families = {}
+    for family, ip in addresses:
+        families.setdefault(family, []).append((family, ip))
+    groups = list(families.values())
+    result = []
+    for i in range(max(map(len, groups), default=0)):
+        for group in groups:
+            if i < len(group):
+                result.append(group[i])
+    return result
+
+
+def connect(addresses, port, delay, timeout):
+    """
+    交错并行连接(Happy Eyeballs):每隔delay秒或上一次尝试失败时对下一个地址发起连接,第一个成功的连接胜出,其余连接关闭
+    :param addresses: [(family,ip)]
+    :param port: 端口
+    :param delay: 连接尝试间隔(秒)
+    :param timeout: 总超时时间(秒)
+    :return: socket
+    """
+    addresses = interleave(addresses)
+    deadline = time.monotonic() + timeout
+    selector = selectors.DefaultSelector()
+    error = socket.timeout('connect timed out')
+    try:
+        while addresses or selector.get_map():
+            remaining = deadline - time.monotonic()
+            if remaining <= 0:
+                raise socket.timeout('connect timed out')
+            if addresses:
+                family, ip = addresses.pop(0)
+                sock = socket.socket(family, socket.SOCK_STREAM)
+                sock.setblocking(False)
+                err = sock.connect_ex((ip, port))
+                if err == 0:
+                    sock.settimeout(timeout)
+                    return sock
+                if err != errno.EINPROGRESS:
+                    sock.close()
+                    error = OSError(err, 'connect to {} failed'.format(ip))
+                    continue  # 立即失败时直接尝试下一个地址
+                selector.register(sock, selectors.EVENT_WRITE, ip)
+            for key, mask in selector.select(min(delay, remaining) if addresses else remaining):
+                sock = key.fileobj
+                selector.unregister(sock)
+                err = sock.getsockopt(socket.SOL_SOCKET, socket.SO_ERROR)
+                if err == 0:
+                    sock.settimeout(timeout)
+                    return sock
+                sock.close()
+                error = OSError(err, 'connect to {} failed'.format(key.data))
+        raise error
+    finally:
+        for key in list(selector.get_map().values()):  # 取消其余的连接尝试
+            key.fileobj.close()
+        selector.close()
+
+
+def close_attempt(task):
+    """
+    关闭已被取消但已经建立的连接
+    :param task: asyncio.Task
+    """
+    if not task.cancelled() and task.exception() is None:
+        task.result()[1].close()
+
+
+async def open_connection(addresses, port, delay, timeout):
+    """
+    asyncio模式的交错并行连接
+    :param addresses: [(family,ip)]
+    :param port: 端口
+    :param delay: 连接尝试间隔(秒)
+    :param timeout: 总超时时间(秒)
+    :return: (StreamReader,StreamWriter)
+    """
+    addresses = interleave(addresses)
+    loop = asyncio.get_running_loop()
+    deadline = loop.time() + timeout
+    attempts = set()
+    error = asyncio.TimeoutError()
+    try:
+        while addresses or attempts:
+            remaining = deadline - loop.time()
+            if remaining <= 0:
+                raise asyncio.TimeoutError()
+            if addresses:
+                family, ip = addresses.pop(0)
+                attempts.add(asyncio.ensure_future(asyncio.open_connection(ip, port)))
+            done, attempts = await asyncio.wait(attempts, timeout=min(delay, remaining) if addresses else remaining, return_when=asyncio.FIRST_COMPLETED)
+            winner = None
+            for task in done:
+                if task.exception() is not None:
+                    error = task.exception()
+                elif winner is None:
+                    winner = task.result()
+                else:
+                    task.result()[1].close()  # 同时成功的多余连接
+            if winner:
+                return winner
+        raise error
+    finally:
+        for task in attempts:
+            task.cancel()
+            task.add_done_callback(close_attempt)
@@ -0,0 +1,379 @@
+import time
+import struct
+import threading
+
+LENGTH = struct.Struct('>I')  # 帧的长度前缀
+BUFFER_SIZE = 65536  # 接收缓冲区的初始大小,超过该大小的帧会使缓冲区扩容
+MAX_FRAME = 1 << 24  # 帧长度上限,超过时认为数据已损坏
+IOV_MAX = 1024  # 一次sendmsg的缓冲区数量上限
+HIGH_WATERMARK = 524288  # 发送队列的默认高水位
+LOW_WATERMARK = 131072  # 发送队列的默认低水位
+SMALL_FRAME = 2048  # 不超过该大小的帧直接拼接长度前缀,复制的开销小于多一个分散缓冲区
+
+
+class BufferPool:
+    """
+    接收缓冲区池,连接开始中继时取出一个缓冲区,连接关闭后归还,稳定中继时不再分配内存
+    """
+
+    def __init__(self, size=BUFFER_SIZE, limit=256):
+        """
+        :param size: 缓冲区大小
+        :param limit: 最多保留的空闲缓冲区数量
+        """
+        self.size = size
+        self.limit = limit
+        self.free = []
+        self.lock = threading.Lock()
+        self.allocated = 0
+        self.reused = 0
+
+    def acquire(self):
+        """
+        :return: bytearray
+        """
+        with self.lock:
+            if self.free:
+                self.reused += 1
+                return self.free.pop()
+            self.allocated += 1
+        return bytearray(self.size)
+
+    def release(self, buffer):
+        """
+        归还缓冲区,扩容过的缓冲区直接丢弃
+        :param buffer: bytearray
+        """
+        if len(buffer) != self.size:
+            return
+        with self.lock:
+            if len(self.free) < self.limit:
+                self.free.append(buffer)
+
+    def stats(self):
+        with self.lock:
+            return {'free': len(self.free), 'allocated': self.allocated, 'reused': self.reused}
+
+
+class FrameDecoder:
+    """
+    增量解析>I长度前缀的帧,数据通过recv_into直接读入缓冲区,完整的帧以memoryview返回,不复制帧内容。
+    长度前缀可以跨多次读取,一次读取也可以包含任意多个帧;缓冲区尾部空间不足时只移动未完成的帧
+    """
+
+    def __init__(self, pool, max_frame=MAX_FRAME):
+        """
+        :param pool: BufferPool
+        :param max_frame: 帧长度上限
+        """
+        self.pool = pool
+        self.max_frame = max_frame
+        self.buffer = pool.acquire()
+        self.view = memoryview(self.buffer)
+        self.start = 0  # 未解析数据的起始位置
+        self.end = 0  # 已接收数据的结束位置
+        self.received = 0  # 读入缓冲区的字节数
+        self.copied = 0  # 为腾出空间移动的字节数
+
+    def frame_length(self):
+        """
+        :return: 当前帧的长度 | None(长度前缀不完整)
+        :raise ValueError: 帧长度超过上限
+        """
+        if self.end - self.start < LENGTH.size:
+            return
+        length = LENGTH.unpack_from(self.buffer, self.start)[0]
+        if length > self.max_frame:
+            raise ValueError("Frame too large: {}".format(length))
+        return length
+
+    def reserve(self):
+        """
+        保证缓冲区尾部有空间,并且当前帧可以完整放入缓冲区
+        """
+        length = self.frame_length()
+        needed = LENGTH.size if length is None else LENGTH.size + length
+        if self.start + needed <= len(self.buffer) and self.end < len(self.buffer):
+            return
+        pending = self.end - self.start
+        if needed > len(self.buffer):
+            buffer = bytearray(needed)
+            buffer[:pending] = self.view[self.start:self.end]
+            self.view.release()
+            self.pool.release(self.buffer)
+            self.buffer = buffer
+            self.view = memoryview(buffer)
+        else:
+            self.buffer[:pending] = self.view[self.start:self.end]
+        self.copied += pending
+        self.start = 0
+        self.end = pending
+
+    def recv_into(self, sock):
+        """
+        从socket读取数据到缓冲区
+        :param sock: socket
+        :return: 读取的字节数,0表示连接已关闭
+        """
+        self.reserve()
+        size = sock.recv_into(self.view[self.end:])
+        self.end += size
+        self.received += size
+        return size
+
+    def feed(self, data):
+        """
+        写入已读取的数据并返回其中完整的帧,用于没有socket的场景
+        :param data: bytes
+        :return: memoryview生成器
+        """
+        data = memoryview(data)
+        while data:
+            self.reserve()
+            size = min(len(data), len(self.buffer) - self.end)
+            self.buffer[self.end:self.end + size] = data[:size]
+            self.end += size
+            self.received += size
+            data = data[size:]
+            yield from self.frames()
+
+    def frames(self):
+        """
+        依次返回缓冲区中所有完整的帧,返回的memoryview在下一次读取之前有效
+        :return: memoryview生成器
+        :raise ValueError: 帧长度超过上限
+        """
+        while True:
+            length = self.frame_length()
+            if length is None or self.end - self.start - LENGTH.size < length:
+                break
+            start = self.start + LENGTH.size
+            self.start = start + length
+            yield self.view[start:self.start]
+        if self.start == self.end:
+            self.start = self.end = 0
+
+    def close(self):
+        """
+        归还缓冲区
+        """
+        if self.buffer is None:
+            return
+        self.view.release()
+        self.pool.release(self.buffer)
+        self.buffer = self.view = None
+
+
+class OutputQueue:
+    """
+    非阻塞socket的发送队列,socket暂时不可写时保留未发送的数据,由中继在select的wlist中等待可写后继续发送。
+    队列达到high时中继停止从对端读取,降到low以下后恢复,每个连接占用的内存不会随两端速度差增长
+    """
+
+    def __init__(self, sock, high=HIGH_WATERMARK, low=LOW_WATERMARK):
+        """
+        :param sock: socket(非阻塞)
+        :param high: 高水位(字节)
+        :param low: 低水位(字节)
+        """
+        self.sock = sock
+        self.high = high
+        self.low = low
+        self.buffers = []
+        self.pending = 0  # 队列中未发送的字节数
+        self.blocked = False  # 上一次发送时socket不可写
+        self.syscalls = 0
+
+    def write(self, data):
+        """
+        :param data: bytes
+        :raise socket.error
+        """
+        self.buffers.append(data)
+        self.pending += len(data)
+        self.flush()
+
+    def flush(self):
+        """
+        用sendmsg发送队列中的数据,直到全部发送或socket不可写,部分发送时从未发送的位置继续
+        :raise socket.error
+        """
+        buffers = self.buffers
+        index = 0
+        try:
+            while index < len(buffers):
+                sent = self.sock.sendmsg(buffers[index:index + IOV_MAX])
+                self.syscalls += 1
+                self.pending -= sent
+                while sent:
+                    if sent >= len(buffers[index]):
+                        sent -= len(buffers[index])
+                        index += 1
+                    else:
+                        buffers[index] = memoryview(buffers[index])[sent:]
+                        sent = 0
+        except BlockingIOError:
+            pass
+        del buffers[:index]
+        self.blocked = bool(buffers)
+
+    def full(self):
+        return self.pending >= self.high
+
+    def drained(self):
+        return self.pending <= self.low
+
+
+class FrameWriter(OutputQueue):
+    """
+    发送>I长度前缀的帧,长度前缀和帧内容作为sendmsg的分散缓冲区发送,不拼接(latency为0时小帧直接拼接后发送)。
+    距离上一次发送不足latency秒时帧先进入队列,到期或队列超过max_pending字节后一次sendmsg发送全部帧,
+    突发的小帧合并为一次系统调用,偶发的交互数据立即发送
+    """
+
+    def __init__(self, sock, latency=0, max_pending=BUFFER_SIZE, high=HIGH_WATERMARK, low=LOW_WATERMARK):
+        """
+        :param sock: socket(非阻塞)
+        :param latency: 帧在队列中的最长等待时间(秒),0表示每帧立即发送
+        :param max_pending: 队列中的字节数达到该值时立即发送
+        :param high: 高水位(字节)
+        :param low: 低水位(字节)
+        """
+        super().__init__(sock, high, low)
+        self.latency = latency
+        self.max_pending = max_pending
+        self.deadline = None  # 队列中的帧最晚的发送时间
+        self.last_flush = 0
+        self.frames = 0
+
+    def write(self, data):
+        """
+        发送或排队一个帧
+        :param data: 帧内容(已加密)
+        :raise socket.error
+        """
+        self.frames += 1
+        self.pending += LENGTH.size + len(data)
+        if not self.latency:
+            if len(data) <= SMALL_FRAME:
+                self.buffers.append(LENGTH.pack(len(data)) + data)
+            else:
+                self.buffers += (LENGTH.pack(len(data)), data)
+            self.flush()
+            return
+        self.buffers += (LENGTH.pack(len(data)), data)
+        now = time.monotonic()
+        if self.deadline is None:
+            self.deadline = max(self.last_flush + self.latency, now)
+        if not self.blocked and (now >= self.deadline or self.pending >= self.max_pending):
+            self.flush()
+
+    def timeout(self):
+        """
+        :return: 距离队列到期的秒数,用作select的超时时间 | None(队列为空或正在等待socket可写)
+        """
+        if self.deadline is None or self.blocked:
+            return
+        return max(self.deadline - time.monotonic(), 0)
+
+    def poll(self):
+        """
+        队列到期时发送
+        """
+        if self.deadline is not None and not self.blocked and time.monotonic() >= self.deadline:
+            self.flush()
+
+    def flush(self):
+        super().flush()
+        self.deadline = None
+        self.last_flush = time.monotonic()
+
+
+class ReadSize:
+    """
+    按每次读取的数据量调整下一次读取的大小:读满说明还有数据在等待,大小加倍;
+    连续多次读取不到四分之一时减半。批量传输很快增长到最大帧,交互数据保持较小的帧
+    """
+    shrink_after = 4  # 连续多少次读取不足四分之一后减半
+
+    def __init__(self, minimum, maximum):
+        """
+        :param minimum: 最小读取大小
+        :param maximum: 最大读取大小
+        """
+        self.minimum = minimum
+        self.maximum = max(maximum, minimum)
+        self.size = minimum
+        self.small = 0
+
+    def update(self, received):
+        """
+        :param received: 本次读取到的字节数
+        """
+        if received >= self.size:
+            self.size = min(self.size * 2, self.maximum)
+            self.small = 0
+        elif received < self.size // 4:
+            self.small += 1
+            if self.small >= self.shrink_after:
+                self.size = max(self.size // 2, self.minimum)
+                self.small = 0
+        else:
+            self.small = 0
+
+
+def read_size(buffer_size, cipher):
+    """
+    创建一个连接的读取大小,在buffer_size和协商的最大帧长度(减去加密开销)之间调整,
+    没有协商最大帧长度时固定为buffer_size
+    :param buffer_size: 配置的读取大小
+    :param cipher: crypto.CipherSession
+    :return: ReadSize
+    """
+    max_frame = cipher.params.get('max_frame', 0)
+    return ReadSize(buffer_size, max_frame - cipher.overhead if max_frame else buffer_size)
+
+
+def recv_exactly(sock, size):
+    """
+    阻塞读取size字节,一次recv可能只返回部分数据,用于握手阶段的定长数据
+    :param sock: socket
+    :param size: 字节数
+    :return: bytes
+    :raise ConnectionError: 读取完size字节之前连接关闭
+    """
+    data = b''
+    while len(data) < size:
+        chunk = sock.recv(size - len(data))
+        if not chunk:
+            raise ConnectionError("connection closed after {} of {} bytes".format(len(data), size))
+        data += chunk
+    return data
+
+
+def recv_frame(sock):
+    """
+    阻塞读取一个完整的帧,用于握手阶段。先读长度前缀再读帧内容,不会读走之后的数据
+    :param sock: socket
+    :return: 帧内容
+    :raise ValueError: 帧长度超过上限
+    :raise ConnectionError: 读取完整的帧之前连接关闭
+    """
+    length = LENGTH.unpack(recv_exactly(sock, LENGTH.size))[0]
+    if length > MAX_FRAME:
+        raise ValueError("Frame too large: {}".format(length))
+    return recv_exactly(sock, length)
+
+
+async def read_frame(reader):
+    """
+    asyncio模式读取一个完整的帧,长度超过上限时不分配内存直接报错
+    :param reader: StreamReader
+    :return: 帧内容
+    :raise ValueError: 帧长度超过上限
+    :raise asyncio.IncompleteReadError: 读取完整的帧之前连接关闭
+    """
+    length = LENGTH.unpack(await reader.readexactly(LENGTH.size))[0]
+    if length > MAX_FRAME:
+        raise ValueError("Frame too large: {}".format(length))
+    return await reader.readexactly(length)
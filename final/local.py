@@ -1,17 +1,53 @@
 import socket
 import select
+import asyncio
 import crypto
-import threading
+import prefork
+import mux
+import pool
+import frame
+import workers
+import udp
+import socks5
+import metrics
+import tracing
 import time
 import logging
+import signal
+import functools
 import struct
 from configparser import ConfigParser
 
+TCP_FASTOPEN_CONNECT = getattr(socket, 'TCP_FASTOPEN_CONNECT', 30)  # Linux 4.11+,Python没有定义该常量
+
 
 class Local:
     def __init__(self, config):
         self.config = config
-        self.cipher = crypto.Cipher()
+        self.counters = None  # 多进程模式下由prefork.Supervisor设置
+        self.worker_index = 0  # 多进程模式下的工作进程编号
+        self.buffers = frame.BufferPool()
+        self.workers = None  # 多线程模式的工作线程池
+        self.pool = None
+        self.suites = crypto.parse_suites(self.config.get('encrypt', 'suites', fallback='rc4'))
+        self.buffer_size = self.config.getint('server', 'buffer_size')  # 配置只解析一次,中继时不再查询
+        self.flush_latency = self.config.getint('server', 'flush_latency', fallback=0) / 1000
+        self.max_frame = self.config.getint('server', 'max_frame', fallback=0)
+        self.high_watermark = self.config.getint('server', 'high_watermark', fallback=frame.HIGH_WATERMARK)
+        self.low_watermark = self.config.getint('server', 'low_watermark', fallback=frame.LOW_WATERMARK)
+        self.timeout = self.config.getint('server', 'timeout')
+        self.resumption = self.config.getboolean('encrypt', 'resumption', fallback=False)
+        self.early_data = self.config.getboolean('encrypt', 'early_data', fallback=False)
+        self.fastopen = self.config.getboolean('local', 'fastopen', fallback=False)
+        self.optimistic = self.config.getboolean('local', 'optimistic', fallback=False)
+        self.optimistic_wait = self.config.getint('local', 'optimistic_wait', fallback=10) / 1000
+        self.optimistic_size = self.config.getint('local', 'optimistic_size', fallback=16384)
+        self.tracer = None  # 按[trace]中的sample采样连接的各阶段耗时
+        if self.config.getfloat('trace', 'sample', fallback=0) > 0:
+            self.tracer = tracing.Tracer('local', self.config.get('trace', 'filename', fallback='trace.jsonl'), self.config.getfloat('trace', 'sample'))
+        self.session = None  # 最近一次完整握手得到的会话
+        self.resumed = 0
+        self.full_handshakes = 0
         logging.basicConfig(filename=self.config.get('log', 'filename'), filemode="w", format="%(asctime)s %(name)s:%(levelname)s:%(message)s", datefmt="%Y-%M-%d %H:%M:%S", level=logging.ERROR)
 
     def socket_init(self):
@@ -35,6 +71,8 @@ class Local:
         """
         try:
             sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+            if self.config.getint('local', 'workers', fallback=1) > 1:
+                sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEPORT, 1)  # 多进程模式下每个工作进程绑定相同的地址和端口
             sock.bind((self.config.get('local', 'address'), self.config.getint('local', 'port')))
         except socket.error:
             logging.exception("Failed to bind port")
@@ -55,7 +93,7 @@ class Local:
         :return: b'\xff' | b'\x00'
         """
         try:
-            data = conn.recv(self.config.getint('server', 'buffer_size'))
+            data = conn.recv(self.buffer_size)
         except socket.error:
             return b'\xff'
         if b'\x05' != data[0:1]:
@@ -93,142 +131,393 @@ class Local:
         :return: 原始数据
         """
         try:
-            data = conn.recv(self.config.getint('server', 'buffer_size'))
+            data = conn.recv(self.buffer_size)
         except ConnectionResetError:
             conn.close()
             logging.exception("Exception occurred")
             return False
-        if data[0:3] != b'\x05\x01\x00':  # 版本号为5,CONNECT请求为0x01,0x00为保留字
+        if data[0:3] != b'\x05\x01\x00' and data[0:3] != udp.ASSOCIATE:  # 版本号为5,CONNECT请求为0x01,UDP ASSOCIATE请求为0x03,0x00为保留字
             return False
         return data
 
-    def remote_handshake(self):
+    def fastopen_socket(self):
         """
-        远程服务器握手
-        :return: (加密密钥,socket)
+        开启了TCP_FASTOPEN_CONNECT的socket,connect立即返回,第一次发送的数据随SYN发出
+        :return: socket | None(内核不支持)
         """
         sock = self.socket_init()
         try:
-            sock.connect((self.config.get('local', 'remote'), self.config.getint('server', 'port')))
-            encrypt = crypto.ECDH(self.config.get('encrypt', 'curve'))  # ECDH密钥协商
-            data = encrypt.generate_first_handshake_data()
-            sock.send(data)
-            data = sock.recv(self.config.getint('server', 'buffer_size'))
+            sock.setsockopt(socket.IPPROTO_TCP, TCP_FASTOPEN_CONNECT, 1)
+        except socket.error:
+            sock.close()
+            return
+        return sock
+
+    def remote_socket(self):
+        """
+        连接远程服务器,开启fastopen且内核支持时使用TCP Fast Open
+        :return: socket
+        """
+        sock = (self.fastopen_socket() if self.fastopen else None) or self.socket_init()
+        sock.connect((self.config.get('local', 'remote'), self.config.getint('server', 'port')))
+        return sock
+
+    def first_handshake_data(self, encrypt, request):
+        """
+        生成完整握手的第一次发送的数据,开启0-RTT且有请求时附带用早期密钥加密的请求帧
+        :param encrypt: crypto.ECDH
+        :param request: SOCKS请求 | None
+        :return: bytes
+        """
+        extensions = crypto.client_extensions(self.suites, self.max_frame)
+        if not (self.early_data and request):
+            return encrypt.generate_first_handshake_data(extensions)
+        early = crypto.EarlyData(self.suites[0])
+        extensions[crypto.EXTENSION_EARLY_DATA] = early.extension()
+        data = early.cipher(client=True).encrypt(request)
+        return encrypt.generate_first_handshake_data(extensions) + frame.LENGTH.pack(len(data)) + data
+
+    def recv_resume_reply(self, sock):
+        """
+        读取会话恢复的响应,RESUME_MISS之后服务器等待完整握手,不能多读
+        :param sock: socket
+        :return: 响应数据 | b''(服务器不支持会话恢复,已关闭连接)
+        """
+        try:
+            data = frame.recv_exactly(sock, len(crypto.RESUME))
+            if data == crypto.RESUME:
+                data += frame.recv_exactly(sock, crypto.RESUME_REPLY_LENGTH - len(data))
+        except ConnectionError:
+            return b''
+        return data
+
+    def remote_handshake(self, request=None):
+        """
+        远程服务器握手,存在未过期的会话时优先进行会话恢复,失败后回退到完整的ECDH握手
+        :param request: 开启0-RTT时随握手数据发送的SOCKS请求,服务端接受时CipherSession.early_data为该请求
+        :return: (crypto.CipherSession,socket)
+        """
+        try:
+            sock = self.remote_socket()
+            session = self.session
+            if session and time.monotonic() - session.created < self.config.getint('encrypt', 'session_ttl', fallback=3600):
+                data, client_nonce = session.generate_resume_data()
+                sock.send(data)
+                data = self.recv_resume_reply(sock)
+                key = session.parse_resume_reply(data, client_nonce)
+                if key:
+                    self.resumed += 1
+                    return crypto.CipherSession(key, session.params, client=True), sock
+                self.session = None
+                if data != crypto.RESUME_MISS:  # 服务器不支持会话恢复,重新建立连接
+                    sock.close()
+                    sock = self.remote_socket()
+            encrypt = crypto.ECDH(self.config.get('encrypt', 'curve'), self.config.get('encrypt', 'backend', fallback='tinyec'))  # ECDH密钥协商
+            sock.sendall(self.first_handshake_data(encrypt, request))
+            data = frame.recv_exactly(sock, encrypt.handshake_size)  # 0-RTT握手时服务器的响应紧跟在握手数据之后,不能提前读取
             share_key = encrypt.parse_share_key_from_first_handshake_data(data)
-            if share_key:
+            params = crypto.client_negotiate(encrypt.extensions, self.suites) if share_key else None
+            if params:
                 key = share_key[10:42].encode()
             else:
                 return
         except socket.error:
             logging.exception("Exception occurred")
             return
-        return key, sock
+        self.full_handshakes += 1
+        if self.resumption:
+            self.session = crypto.Session(key, params)
+        cipher = crypto.CipherSession(key, params, client=True)
+        if encrypt.extensions.get(crypto.EXTENSION_EARLY_DATA) == b'\x01':
+            cipher.early_data = request
+        return cipher, sock
+
+    def start_pool(self):
+        """
+        启动预握手连接池
+        """
+        size = self.config.getint('local', 'pool', fallback=0)
+        if size <= 0:
+            return
+        self.pool = pool.TunnelPool(functools.partial(Local.remote_handshake, self), size, self.config.getint('local', 'pool_max_age', fallback=30))
+        self.pool.start()
+
+    def print_stats(self, signum=None, frame=None):
+        """
+        收到SIGUSR1时输出密钥加载情况、连接池的命中情况和会话恢复的命中率
+        """
+        if self.workers:
+            self.workers.print_stats()
+        print("keys load_time={load_time:.6f}s reloads={reload_count}".format(**crypto.get_key_store().stats()), flush=True)
+        if self.pool:
+            self.pool.print_stats()
+        total = self.resumed + self.full_handshakes
+        print("handshakes resumed={} full={} resume_rate={:.2%}".format(self.resumed, self.full_handshakes, self.resumed / total if total else 0.0), flush=True)
 
-    def relay(self, socket_src, socket_dst, key):
+    def relay(self, socket_src, socket_dst, cipher):
         """
         中继(relay)阶段
         :param socket_src: 源地址
         :param socket_dst: 目标地址
-        :param key: 加密密钥
+        :param cipher: 加密会话
         """
-        length_dict = {}
-        while True:
-            try:
-                rlist, wlist, xlist = select.select([socket_src, socket_dst], [], [])
-            except select.error:
-                logging.exception("Exception occurred")
-                return
-            if not rlist:
-                continue
-            try:
-                for sock in rlist:
-                    data = sock.recv(self.config.getint('server', 'buffer_size'))
-                    if data == b'':
-                        return
-                    if sock is socket_dst:
-                        if sock not in length_dict.keys():
-                            length = struct.unpack(">I", data[0:4])[0]
-                            length_dict[sock] = [length, b'']
-                        length_dict[sock][1] += data
-                        if length_dict[sock][0] == len(length_dict[sock][1][4:]):
-                            data = self.cipher.decrypt(key, length_dict[sock][1][4:])
-                            socket_src.send(data)
-                            length_dict.pop(sock)
-                        elif length_dict[sock][0] < len(length_dict[sock][1][4:]):
-                            data = self.cipher.decrypt(key, length_dict[sock][1][4:4 + length_dict[sock][0]])
-                            socket_src.send(data)
-                            length_dict[sock][1] = length_dict[sock][1][4 + length_dict[sock][0]:]
-                            length_dict[sock][0] = struct.unpack(">I", length_dict[sock][1][0:4])[0]
-                    else:
-                        data = self.cipher.encrypt(key, data)
-                        length = struct.pack(">I", len(data))
-                        data = length + data
-                        socket_dst.send(data)
-            except socket.error:
-                logging.exception("Exception occurred")
+        decoder = frame.FrameDecoder(self.buffers)
+        read_size = frame.read_size(self.buffer_size, cipher)
+        writer = frame.FrameWriter(socket_dst, self.flush_latency, high=self.high_watermark, low=self.low_watermark)  # 发送到远程服务器
+        output = frame.OutputQueue(socket_src, self.high_watermark, self.low_watermark)  # 发送到浏览器
+        reading = {socket_src: True, socket_dst: True}  # 对端的发送队列超过高水位时暂停读取
+        closing = False  # 任意一端关闭后停止读取,发送完队列中的数据后结束
+        trace = tracing.current.get()
+        socket_src.setblocking(False)
+        socket_dst.setblocking(False)
+        try:
+            while True:
+                if closing and not writer.buffers and not output.buffers:
+                    return
+                rlist = [sock for sock in (socket_src, socket_dst) if reading[sock] and not closing]
+                wlist = [queue.sock for queue in (writer, output) if queue.blocked]
+                try:
+                    rlist, wlist, xlist = select.select(rlist, wlist, [], self.timeout if closing else writer.timeout())
+                except select.error:
+                    logging.exception("Exception occurred")
+                    return
+                if closing and not wlist:
+                    return
+                try:
+                    for sock in wlist:
+                        (writer if sock is socket_dst else output).flush()
+                    for sock in rlist:
+                        if sock is socket_dst:
+                            if decoder.recv_into(sock) == 0:
+                                closing = True
+                                writer.flush()
+                                break
+                            for data in decoder.frames():
+                                if trace:
+                                    trace.mark('first_byte_downstream')
+                                metrics.DOWNSTREAM.frame(len(data))
+                                data = cipher.decrypt(data)
+                                metrics.DOWNSTREAM.bytes.inc(len(data))
+                                output.write(data)
+                        else:
+                            data = sock.recv(read_size.size)
+                            if data == b'':
+                                closing = True
+                                writer.flush()
+                                break
+                            if trace:
+                                trace.mark('first_byte_upstream')
+                            read_size.update(len(data))
+                            metrics.UPSTREAM.bytes.inc(len(data))
+                            data = cipher.encrypt(data)
+                            metrics.UPSTREAM.frame(len(data))
+                            writer.write(data)
+                    writer.poll()
+                except (socket.error, ValueError):  # ValueError: AEAD认证失败或帧长度超过上限
+                    metrics.RELAY_ERRORS.inc()
+                    logging.exception("Exception occurred")
+                    return
+                for queue, sock in ((writer, socket_src), (output, socket_dst)):
+                    if queue.full():
+                        reading[sock] = False
+                    elif queue.drained():
+                        reading[sock] = True
+        finally:
+            decoder.close()
+
+    def optimistic_reply(self, conn):
+        """
+        乐观模式:连接远程服务器之前先回复浏览器成功,等待最多optimistic_wait毫秒读取浏览器随即发送的第一段数据(如TLS ClientHello)
+        :param conn: socket
+        :return: 浏览器的第一段数据 | None(浏览器连接已断开)
+        """
+        try:
+            conn.sendall(b'\x05\x00\x00\x01\x00\x00\x00\x00\x00\x00')
+            rlist, wlist, xlist = select.select([conn], [], [], self.optimistic_wait)
+            return conn.recv(self.optimistic_size) if rlist else b''
+        except (socket.error, ValueError):
+            logging.exception("Exception occurred")
+            return
+
+    def remote_request(self, data, payload=b''):
+        """
+        将请求转发到远程服务器并读取服务器的响应
+        :param data: 浏览器的请求
+        :param payload: 乐观模式下浏览器的第一段数据
+        :return: (crypto.CipherSession,socket) | None
+        """
+        remote = self.pool.take() if self.pool else None  # 优先使用连接池中已完成握手的连接
+        if not remote:
+            with metrics.HANDSHAKE.time(), tracing.span('remote_handshake'):
+                remote = self.remote_handshake(data + payload)  # 远程服务器握手并进行ECDH密钥协商,0-RTT握手时第一段数据随请求发送
+        try:
+            cipher, sock = remote
+        except TypeError:
+            logging.exception("Exception occurred")
+            return
+        try:
+            with metrics.CONNECT.time(), tracing.span('request'):  # 等待服务器连接目标并响应
+                if not cipher.early_data:  # 0-RTT握手时请求已随握手数据发送
+                    send_data = cipher.encrypt(data)
+                    sock.send(send_data)  # 将请求转发到远程服务器
+                response = frame.recv_exactly(sock, 10 + cipher.overhead)  # 服务器的响应固定为10字节,之后的数据属于中继阶段,不能提前读取和解密
+            response = cipher.decrypt(response)
+            if response[0:4] != b'\x05\x00\x00\x01':
+                sock.close()
                 return
+            if payload and not cipher.early_data:  # 第一段数据没有随请求发送,作为中继阶段的第一帧发送
+                payload = cipher.encrypt(payload)
+                sock.sendall(frame.LENGTH.pack(len(payload)) + payload)
+        except (socket.error, ValueError):
+            logging.exception("Exception occurred")
+            sock.close()
+            return
+        return cipher, sock
 
     def request(self, conn):
         """
-        请求阶段,满足条件则进行中继
+        请求阶段,满足条件则进行中继。乐观模式下浏览器已经收到成功响应,远程服务器连接失败时直接关闭浏览器连接
         :param conn: socket
         """
         data = self.parse_data_from_request(conn)
-        sock = None
         if data:
-            try:
-                key, sock = self.remote_handshake()  # 远程服务器握手并进行ECDH密钥协商
-            except TypeError:
-                logging.exception("Exception occurred")
-                return
-            try:
-                send_data = self.cipher.encrypt(key, data)
-                sock.send(send_data)  # 将请求转发到远程服务器
-                response = sock.recv(self.config.getint('server', 'buffer_size'))  # todo
-                response = self.cipher.decrypt(key, response)
-                if response[0:4] != b'\x05\x00\x00\x01':
-                    return
-            except socket.error:
-                logging.exception("Exception occurred")
+            tracing.annotate_target(data)
+        if data and data[0:3] == udp.ASSOCIATE:
+            self.udp_associate(conn, data)
+            return
+        sock = None
+        payload = b''
+        if data and self.optimistic:
+            payload = self.optimistic_reply(conn)
+            if payload is None:
                 return
-        if not data:
-            rep = b'\x01'  # 无法初始化SOCKS服务
-        else:
+        remote = self.remote_request(data, payload) if data else None
+        if remote:
+            cipher, sock = remote
             rep = b'\x00'  # 初始化完成
+        else:
+            rep = b'\x01'  # 无法初始化SOCKS服务,包括远程服务器握手失败或连接目标失败
         bnd = b'\x00\x00\x00\x00\x00\x00'
         response = b'\x05' + rep + b'\x00' + b'\x01' + bnd
         try:
-            conn.sendall(response)
+            if not (data and self.optimistic):  # 乐观模式下已经回复过浏览器
+                conn.sendall(response)
         except socket.error:
             logging.exception("Exception occurred")
             conn.close()
             return
         if rep == b'\x00':
-            self.relay(conn, sock, key)
+            with tracing.span('relay'):
+                self.relay(conn, sock, cipher)
         if conn:
             conn.close()
         if sock:
             sock.close()
 
+    def udp_associate(self, conn, data):
+        """
+        UDP ASSOCIATE请求:在浏览器连接的本地地址上绑定UDP socket并回复其地址,数据报由udp.LocalAssociation
+        通过隧道中继,浏览器关闭TCP连接时关联结束
+        :param conn: socket
+        :param data: 浏览器的请求
+        """
+        remote = self.remote_request(data)
+        if not remote:
+            try:
+                conn.sendall(b'\x05\x01\x00\x01\x00\x00\x00\x00\x00\x00')
+            except socket.error:
+                logging.exception("Exception occurred")
+            return
+        cipher, sock = remote
+        udp_sock = None
+        try:
+            udp_sock = socket.socket(conn.family, socket.SOCK_DGRAM)
+            udp_sock.bind((conn.getsockname()[0], 0))
+            udp_sock.setblocking(False)
+            ip, port = udp_sock.getsockname()[:2]
+            conn.sendall(b'\x05\x00\x00' + socks5.pack_address(ip, port))
+            udp.LocalAssociation(conn, udp_sock, sock, cipher, self.buffers, self.flush_latency, self.high_watermark, self.low_watermark).run()
+        except socket.error:
+            logging.exception("Exception occurred")
+        finally:
+            if udp_sock:
+                udp_sock.close()
+            sock.close()
+
     def local_handshake(self, conn):
         """
         本地握手阶段,包含本地协商和请求中继阶段
         :param conn: socket
         """
-        if self.local_negotiate(conn):
-            self.request(conn)
+        if self.counters:
+            self.counters.incr('accepted')
+        metrics.ACCEPTED.inc()
+        metrics.ACTIVE.inc()
+        try:
+            with self.tracer.connection() if self.tracer else tracing.null_span:
+                with tracing.span('local_negotiate'):
+                    negotiated = self.local_negotiate(conn)
+                if negotiated:
+                    self.request(conn)
+        finally:
+            metrics.ACTIVE.dec()
+            if self.counters:
+                self.counters.incr('closed')
+
+    def worker_pool(self, handler):
+        """
+        多线程模式的工作线程池,线程数量为threads,准入队列已满或等待超时的浏览器连接收到SOCKS失败响应
+        :param handler: 连接处理函数
+        :return: workers.WorkerPool
+        """
+        return workers.WorkerPool(handler, self.reject, self.config.getint('server', 'threads'),
+                                  self.config.getint('server', 'queue_size', fallback=128),
+                                  self.config.getfloat('server', 'queue_timeout', fallback=self.timeout))
+
+    def reject(self, conn):
+        """
+        不读取浏览器的请求,直接回复无认证方法和一般性失败(REP=0x01)。
+        关闭前取出已经到达的协商请求,避免接收缓冲区中有未读数据时内核发送RST导致浏览器收不到响应
+        :param conn: socket
+        """
+        try:
+            conn.sendall(b'\x05\x00' + b'\x05\x01\x00\x01\x00\x00\x00\x00\x00\x00')
+            conn.setblocking(False)
+            conn.recv(self.buffer_size)
+        except socket.error:
+            pass
+
+    def start_metrics(self):
+        """
+        [metrics]中local_port不为0时启动指标的HTTP服务,多进程模式下每个工作进程监听local_port加工作进程编号
+        """
+        port = self.config.getint('metrics', 'local_port', fallback=0)
+        if port:
+            metrics.start_server(self.config.get('metrics', 'address', fallback='127.0.0.1'), port + self.worker_index)
+
+    def profile(self, signum=None, frame=None):
+        """
+        收到SIGUSR2时在后台采样[trace]中profile_seconds秒的调用栈
+        """
+        tracing.profile_to_file(self.config.getint('trace', 'profile_seconds', fallback=10))
 
     def run(self):
+        signal.signal(signal.SIGUSR1, self.print_stats)
+        signal.signal(signal.SIGUSR2, self.profile)
+        crypto.get_key_store()  # 启动时加载RSA密钥,握手时不再读取文件
+        self.start_metrics()
+        self.start_pool()
         sock = self.socket_init()
         sock = self.bind_port(sock)
+        self.workers = self.worker_pool(self.local_handshake)
+        self.workers.start()
+        sock.settimeout(min(sock.gettimeout(), self.workers.queue_timeout))  # accept超时时清理等待超时的连接
         while True:
-            if threading.activeCount() > self.config.getint('server', 'threads'):  # 线程数量达到上限
-                time.sleep(1)
-                continue
             try:
                 conn, address = sock.accept()  # conn是一个新的套接字对象,用于在local和浏览器之间交换数据
                 conn.setblocking(True)  # 设置套接字为阻塞模式
             except socket.timeout:
+                self.workers.expire()  # 没有新连接时也清理队列中等待超时的连接
                 continue
             except socket.error:
                 logging.exception("Exception occurred")
@@ -236,16 +525,378 @@ class Local:
             except TypeError:
                 logging.exception("Exception occurred")
                 exit(-1)
-            thread = threading.Thread(target=self.local_handshake, args=(conn,))
-            thread.start()
+            self.workers.submit(conn)
         sock.close()
 
 
+class AsyncLocal(Local):
+    """
+    基于asyncio的本地客户端,浏览器协商、远程服务器握手和中继都在同一个事件循环中完成
+    """
+
+    async def negotiate_get_method(self, reader):
+        """
+        协商阶段获取认证方法,并检查是否支持免认证方式
+        :param reader: StreamReader
+        :return: b'\xff' | b'\x00'
+        """
+        try:
+            data = await reader.read(self.buffer_size)
+        except socket.error:
+            return b'\xff'
+        if b'\x05' != data[0:1]:
+            return b'\xff'
+        nmethods = data[1]
+        methods = data[2:]
+        if len(methods) != nmethods:
+            return b'\xff'
+        for method in methods:
+            if method == 0:
+                return b'\x00'
+        return b'\xff'
+
+    async def local_negotiate(self, reader, writer):
+        """
+        本地协商阶段,尝试使用免认证方式
+        :param reader: StreamReader
+        :param writer: StreamWriter
+        :return: 是否支持免认证方式
+        """
+        method = await self.negotiate_get_method(reader)
+        if method != b'\x00':
+            return False
+        try:
+            writer.write(b'\x05\x00')
+            await writer.drain()
+        except socket.error:
+            logging.exception("Exception occurred")
+            return False
+        return True
+
+    async def parse_data_from_request(self, reader):
+        """
+        从请求中提取数据并检查数据是否符合格式要求
+        :param reader: StreamReader
+        :return: 原始数据
+        """
+        try:
+            data = await reader.read(self.buffer_size)
+        except ConnectionResetError:
+            logging.exception("Exception occurred")
+            return False
+        if data[0:3] != b'\x05\x01\x00':  # 版本号为5,CONNECT请求为0x01,0x00为保留字
+            return False
+        return data
+
+    async def remote_open_connection(self):
+        """
+        连接远程服务器,开启fastopen时connect立即返回,不会阻塞事件循环
+        :return: (StreamReader,StreamWriter)
+        """
+        sock = self.fastopen_socket() if self.fastopen else None
+        if sock:
+            sock.connect((self.config.get('local', 'remote'), self.config.getint('server', 'port')))
+            return await asyncio.open_connection(sock=sock)
+        return await asyncio.wait_for(asyncio.open_connection(self.config.get('local', 'remote'), self.config.getint('server', 'port')), self.config.getint('server', 'timeout'))
+
+    async def read_resume_reply(self, reader):
+        """
+        读取会话恢复的响应,RESUME_MISS之后服务器等待完整握手,不能多读
+        :param reader: StreamReader
+        :return: 响应数据 | b''(服务器不支持会话恢复,已关闭连接)
+        """
+        try:
+            data = await reader.readexactly(len(crypto.RESUME))
+            if data == crypto.RESUME:
+                data += await reader.readexactly(crypto.RESUME_REPLY_LENGTH - len(data))
+        except (asyncio.IncompleteReadError, ConnectionError):
+            return b''
+        return data
+
+    async def remote_handshake(self, request=None):
+        """
+        远程服务器握手,连接和等待服务器响应期间不会阻塞其他连接,存在未过期的会话时优先进行会话恢复
+        :param request: 开启0-RTT时随握手数据发送的SOCKS请求,服务端接受时CipherSession.early_data为该请求
+        :return: (crypto.CipherSession,StreamReader,StreamWriter)
+        """
+        timeout = self.config.getint('server', 'timeout')
+        writer = None
+        try:
+            reader, writer = await self.remote_open_connection()
+            session = self.session
+            if session and time.monotonic() - session.created < self.config.getint('encrypt', 'session_ttl', fallback=3600):
+                data, client_nonce = session.generate_resume_data()
+                writer.write(data)
+                await writer.drain()
+                data = await asyncio.wait_for(self.read_resume_reply(reader), timeout)
+                key = session.parse_resume_reply(data, client_nonce)
+                if key:
+                    self.resumed += 1
+                    return crypto.CipherSession(key, session.params, client=True), reader, writer
+                self.session = None
+                if data != crypto.RESUME_MISS:  # 服务器不支持会话恢复,重新建立连接
+                    writer.close()
+                    reader, writer = await self.remote_open_connection()
+            encrypt = crypto.ECDH(self.config.get('encrypt', 'curve'), self.config.get('encrypt', 'backend', fallback='tinyec'))  # ECDH密钥协商
+            writer.write(self.first_handshake_data(encrypt, request))
+            await writer.drain()
+            data = await asyncio.wait_for(reader.readexactly(encrypt.handshake_size), timeout)  # 0-RTT握手时服务器的响应紧跟在握手数据之后,不能提前读取
+            share_key = encrypt.parse_share_key_from_first_handshake_data(data)
+            params = crypto.client_negotiate(encrypt.extensions, self.suites) if share_key else None
+            if params:
+                key = share_key[10:42].encode()
+            else:
+                writer.close()
+                return
+        except (socket.error, asyncio.TimeoutError, asyncio.IncompleteReadError):
+            logging.exception("Exception occurred")
+            if writer:
+                writer.close()
+            return
+        self.full_handshakes += 1
+        if self.resumption:
+            self.session = crypto.Session(key, params)
+        cipher = crypto.CipherSession(key, params, client=True)
+        if encrypt.extensions.get(crypto.EXTENSION_EARLY_DATA) == b'\x01':
+            cipher.early_data = request
+        return cipher, reader, writer
+
+    async def remote_connect(self, request=None):
+        """
+        获取与远程服务器的加密连接,优先使用连接池中已完成握手的连接
+        :param request: 开启0-RTT时随握手数据发送的SOCKS请求
+        :return: (crypto.CipherSession,StreamReader,StreamWriter)
+        """
+        remote = self.pool.take() if self.pool else None
+        if not remote:
+            with metrics.HANDSHAKE.time(), tracing.span('remote_handshake'):
+                return await self.remote_handshake(request)
+        cipher, sock = remote
+        try:
+            reader, writer = await asyncio.open_connection(sock=sock)
+        except socket.error:
+            logging.exception("Exception occurred")
+            sock.close()
+            return
+        return cipher, reader, writer
+
+    async def relay_encrypt(self, reader, writer, cipher):
+        """
+        读取浏览器的数据,加密并添加长度前缀后发送到远程服务器
+        :param reader: 浏览器StreamReader
+        :param writer: 远程服务器StreamWriter
+        :param cipher: 加密会话
+        """
+        read_size = frame.read_size(self.buffer_size, cipher)
+        trace = tracing.current.get()
+        while True:
+            data = await reader.read(read_size.size)
+            if data == b'':
+                return
+            if trace:
+                trace.mark('first_byte_upstream')
+            read_size.update(len(data))
+            metrics.UPSTREAM.bytes.inc(len(data))
+            data = cipher.encrypt(data)
+            metrics.UPSTREAM.frame(len(data))
+            writer.writelines((struct.pack(">I", len(data)), data))
+            await writer.drain()
+
+    async def relay_decrypt(self, reader, writer, cipher):
+        """
+        按长度前缀读取远程服务器的完整数据帧,解密后发送到浏览器
+        :param reader: 远程服务器StreamReader
+        :param writer: 浏览器StreamWriter
+        :param cipher: 加密会话
+        """
+        trace = tracing.current.get()
+        while True:
+            try:
+                data = await frame.read_frame(reader)  # 帧长度超过上限时抛出ValueError,结束中继
+            except asyncio.IncompleteReadError:
+                return
+            if trace:
+                trace.mark('first_byte_downstream')
+            metrics.DOWNSTREAM.frame(len(data))
+            data = cipher.decrypt(data)
+            metrics.DOWNSTREAM.bytes.inc(len(data))
+            writer.write(data)
+            await writer.drain()
+
+    async def relay(self, src_reader, src_writer, dst_reader, dst_writer, cipher):
+        """
+        中继(relay)阶段,任意一个方向结束后关闭整个连接
+        :param src_reader: 浏览器StreamReader
+        :param src_writer: 浏览器StreamWriter
+        :param dst_reader: 远程服务器StreamReader
+        :param dst_writer: 远程服务器StreamWriter
+        :param cipher: 加密会话
+        """
+        for writer in (src_writer, dst_writer):
+            writer.transport.set_write_buffer_limits(self.high_watermark, self.low_watermark)  # drain()在超过高水位时等待
+        tasks = [
+            asyncio.ensure_future(self.relay_encrypt(src_reader, dst_writer, cipher)),
+            asyncio.ensure_future(self.relay_decrypt(dst_reader, src_writer, cipher)),
+        ]
+        done, pending = await asyncio.wait(tasks, return_when=asyncio.FIRST_COMPLETED)
+        for task in pending:
+            task.cancel()
+        for task in done:
+            if task.exception():
+                metrics.RELAY_ERRORS.inc()
+            if task.exception() and not isinstance(task.exception(), socket.error):
+                logging.error("Exception occurred", exc_info=task.exception())
+
+    async def optimistic_reply(self, reader, writer):
+        """
+        乐观模式:连接远程服务器之前先回复浏览器成功,等待最多optimistic_wait毫秒读取浏览器随即发送的第一段数据(如TLS ClientHello)
+        :param reader: StreamReader
+        :param writer: StreamWriter
+        :return: 浏览器的第一段数据 | None(浏览器连接已断开)
+        """
+        try:
+            writer.write(b'\x05\x00\x00\x01\x00\x00\x00\x00\x00\x00')
+            await writer.drain()
+            return await asyncio.wait_for(reader.read(self.optimistic_size), self.optimistic_wait)
+        except asyncio.TimeoutError:
+            return b''
+        except socket.error:
+            logging.exception("Exception occurred")
+            return
+
+    async def request(self, reader, writer):
+        """
+        请求阶段,满足条件则进行中继。乐观模式下浏览器已经收到成功响应,远程服务器连接失败时直接关闭浏览器连接
+        :param reader: StreamReader
+        :param writer: StreamWriter
+        """
+        data = await self.parse_data_from_request(reader)
+        if data:
+            tracing.annotate_target(data)
+        if data and self.mux and self.mux.supported:
+            opened = await self.mux.open(data)  # 隧道建立失败、打开超时或隧道关闭时回退到每个请求一个连接
+            if opened:
+                await self.mux_request(reader, writer, opened)
+                return
+        payload = b''
+        if data and self.optimistic:
+            payload = await self.optimistic_reply(reader, writer)
+            if payload is None:
+                return
+        dst_writer = None
+        remote = await self.remote_connect(data + payload) if data else None  # 远程服务器握手并进行ECDH密钥协商,0-RTT握手时第一段数据随请求发送
+        if remote:
+            cipher, dst_reader, dst_writer = remote
+            try:
+                with metrics.CONNECT.time(), tracing.span('request'):  # 等待服务器连接目标并响应
+                    if not cipher.early_data:  # 0-RTT握手时请求已随握手数据发送
+                        dst_writer.write(cipher.encrypt(data))  # 将请求转发到远程服务器
+                        await dst_writer.drain()
+                    response = await asyncio.wait_for(dst_reader.readexactly(10 + cipher.overhead), self.config.getint('server', 'timeout'))  # 服务器的响应固定为10字节
+                response = cipher.decrypt(response)
+                if response[0:4] != b'\x05\x00\x00\x01':
+                    dst_writer.close()
+                    remote = None
+                elif payload and not cipher.early_data:  # 第一段数据没有随请求发送,作为中继阶段的第一帧发送
+                    payload = cipher.encrypt(payload)
+                    dst_writer.writelines((frame.LENGTH.pack(len(payload)), payload))
+            except (socket.error, ValueError, asyncio.TimeoutError, asyncio.IncompleteReadError):
+                logging.exception("Exception occurred")
+                dst_writer.close()
+                remote = None
+        if not remote:
+            rep = b'\x01'  # 无法初始化SOCKS服务,包括远程服务器握手失败或连接目标失败
+        else:
+            rep = b'\x00'  # 初始化完成
+        bnd = b'\x00\x00\x00\x00\x00\x00'
+        response = b'\x05' + rep + b'\x00' + b'\x01' + bnd
+        try:
+            if not (data and self.optimistic):  # 乐观模式下已经回复过浏览器
+                writer.write(response)
+                await writer.drain()
+        except socket.error:
+            logging.exception("Exception occurred")
+            if dst_writer:
+                dst_writer.close()
+            return
+        if rep == b'\x00':
+            with tracing.span('relay'):
+                await self.relay(reader, writer, dst_reader, dst_writer, cipher)
+        if dst_writer:
+            dst_writer.close()
+
+    async def mux_request(self, reader, writer, opened):
+        """
+        多路复用模式的请求阶段,在隧道中打开的逻辑流上进行中继,服务端连接目标失败时回复浏览器失败
+        :param reader: StreamReader
+        :param writer: StreamWriter
+        :param opened: (mux.Stream,SOCKS响应)
+        """
+        stream, response = opened
+        succeeded = response[0:4] == b'\x05\x00\x00\x01'
+        try:
+            writer.write(b'\x05' + (b'\x00' if succeeded else b'\x01') + b'\x00\x01\x00\x00\x00\x00\x00\x00')
+            await writer.drain()
+        except socket.error:
+            logging.exception("Exception occurred")
+            succeeded = False
+        if not succeeded:
+            await stream.close()
+            return
+        await mux.relay(stream, reader, writer, self.buffer_size)
+
+    async def local_handshake(self, reader, writer):
+        """
+        本地握手阶段,包含本地协商和请求中继阶段
+        :param reader: StreamReader
+        :param writer: StreamWriter
+        """
+        if self.counters:
+            self.counters.incr('accepted')
+        metrics.ACCEPTED.inc()
+        metrics.ACTIVE.inc()
+        try:
+            with self.tracer.connection() if self.tracer else tracing.null_span:
+                with tracing.span('local_negotiate'):
+                    negotiated = await self.local_negotiate(reader, writer)
+                if negotiated:
+                    await self.request(reader, writer)
+        finally:
+            metrics.ACTIVE.dec()
+            writer.close()
+            if self.counters:
+                self.counters.incr('closed')
+
+    async def serve(self):
+        signal.signal(signal.SIGUSR1, self.print_stats)
+        signal.signal(signal.SIGUSR2, self.profile)
+        crypto.get_key_store()  # 启动时加载RSA密钥,握手时不再读取文件
+        self.start_metrics()
+        self.start_pool()
+        tunnels = self.config.getint('local', 'mux', fallback=0)
+        self.mux = mux.MuxClient(self, tunnels) if tunnels > 0 else None  # 多路复用隧道数量,0为不使用多路复用
+        sock = self.socket_init()
+        sock = self.bind_port(sock)
+        server = await asyncio.start_server(self.local_handshake, sock=sock)
+        async with server:
+            await server.serve_forever()
+
+    def run(self):
+        asyncio.run(self.serve())
+
+
 def main():
     config = ConfigParser()
     config.read('config.ini')
-    local = Local(config)
-    local.run()
+    if config.get('local', 'engine', fallback='thread') == 'asyncio':
+        local = AsyncLocal(config)
+    else:
+        local = Local(config)
+    workers = config.getint('local', 'workers', fallback=1)
+    if workers > 1:
+        prefork.Supervisor(local, workers).run()
+    else:
+        local.run()
 
 
 if __name__ == '__main__':
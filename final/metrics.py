@@ -0,0 +1,234 @@
+import time
+import bisect
+import threading
+import contextlib
+import http.server
+import urllib.parse
+import tracing
+
+LATENCY_BUCKETS = tuple(0.0001 * 2 ** i for i in range(18))  # 0.1ms ~ 13s
+SIZE_BUCKETS = tuple(64 * 2 ** i for i in range(13))  # 64B ~ 256KB
+
+
+class Metric:
+    """
+    指标的值按线程分片,每个线程只写自己的分片,更新时不加锁;抓取时合并所有分片。
+    线程结束后分片保留,计数器不会减少
+    """
+    type = 'untyped'
+
+    def __init__(self, name, help, labels):
+        """
+        :param name: 指标名称
+        :param help: 说明
+        :param labels: {标签: 值}
+        """
+        self.name = name
+        self.help = help
+        self.labels = labels
+        self.local = threading.local()
+        self.shards = []
+        self.lock = threading.Lock()  # 只在线程第一次更新和抓取时使用
+
+    def new_shard(self):
+        return [0]
+
+    def shard(self):
+        """
+        :return: 当前线程的分片
+        """
+        try:
+            return self.local.shard
+        except AttributeError:
+            shard = self.local.shard = self.new_shard()
+            with self.lock:
+                self.shards.append(shard)
+            return shard
+
+    def merge(self):
+        """
+        :return: 所有分片之和
+        """
+        with self.lock:
+            shards = list(self.shards)
+        total = self.new_shard()
+        for shard in shards:
+            for i, value in enumerate(shard):
+                total[i] += value
+        return total
+
+    def samples(self):
+        """
+        :return: [(名称后缀,标签,值)]
+        """
+        return [('', self.labels, self.merge()[0])]
+
+
+class Counter(Metric):
+    type = 'counter'
+
+    def inc(self, value=1):
+        try:
+            self.local.shard[0] += value
+        except AttributeError:
+            self.shard()[0] += value
+
+
+class Gauge(Counter):
+    type = 'gauge'
+
+    def dec(self, value=1):
+        self.inc(-value)
+
+
+class Histogram(Metric):
+    type = 'histogram'
+
+    def __init__(self, name, help, labels, buckets):
+        """
+        :param buckets: 升序的桶上限
+        """
+        self.buckets = buckets
+        super().__init__(name, help, labels)
+
+    def new_shard(self):
+        return [0] * (len(self.buckets) + 2)  # 各桶的计数,最后一个桶为+Inf,之后为总和
+
+    def observe(self, value):
+        try:
+            shard = self.local.shard
+        except AttributeError:
+            shard = self.shard()
+        shard[bisect.bisect_left(self.buckets, value)] += 1
+        shard[-1] += value
+
+    @contextlib.contextmanager
+    def time(self):
+        """
+        记录with语句块的耗时(秒)
+        """
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.observe(time.perf_counter() - start)
+
+    def samples(self):
+        total = self.merge()
+        samples = []
+        count = 0
+        for bound, value in zip(self.buckets + (float('inf'),), total):
+            count += value
+            samples.append(('_bucket', dict(self.labels, le='+Inf' if bound == float('inf') else repr(bound)), count))
+        samples.append(('_sum', self.labels, total[-1]))
+        samples.append(('_count', self.labels, count))
+        return samples
+
+
+class Registry:
+    """
+    指标注册表,按Prometheus文本格式输出,同名不同标签的指标共用HELP和TYPE
+    """
+
+    def __init__(self):
+        self.metrics = []
+
+    def register(self, metric):
+        self.metrics.append(metric)
+        return metric
+
+    def counter(self, name, help, **labels):
+        return self.register(Counter(name, help, labels))
+
+    def gauge(self, name, help, **labels):
+        return self.register(Gauge(name, help, labels))
+
+    def histogram(self, name, help, buckets, **labels):
+        return self.register(Histogram(name, help, labels, buckets))
+
+    def exposition(self):
+        """
+        :return: Prometheus文本格式(0.0.4)
+        """
+        lines = []
+        described = set()
+        for metric in self.metrics:
+            if metric.name not in described:
+                described.add(metric.name)
+                lines.append('# HELP {} {}'.format(metric.name, metric.help))
+                lines.append('# TYPE {} {}'.format(metric.name, metric.type))
+            for suffix, labels, value in metric.samples():
+                label_text = ','.join('{}="{}"'.format(key, value) for key, value in labels.items())
+                lines.append('{}{}{} {}'.format(metric.name, suffix, '{' + label_text + '}' if label_text else '', value))
+        return '\n'.join(lines) + '\n'
+
+
+class Direction:
+    """
+    一个中继方向的指标,upstream为浏览器到目标地址,downstream为目标地址到浏览器。
+    帧数即socks_frame_size_bytes_count,不再单独计数
+    """
+
+    def __init__(self, registry, direction):
+        self.bytes = registry.counter('socks_relay_bytes_total', '中继的明文字节数', direction=direction)
+        self.frame_size = registry.histogram('socks_frame_size_bytes', '中继的加密帧的大小,_count为帧数', SIZE_BUCKETS, direction=direction)
+        self.frame = self.frame_size.observe  # 记录一个加密帧,参数为帧的大小(字节)
+
+
+REGISTRY = Registry()
+ACCEPTED = REGISTRY.counter('socks_connections_accepted_total', '接受的连接数')
+ACTIVE = REGISTRY.gauge('socks_connections_active', '正在处理的连接数')
+HANDSHAKE = REGISTRY.histogram('socks_handshake_seconds', 'ECDH握手的耗时', LATENCY_BUCKETS)
+CONNECT = REGISTRY.histogram('socks_connect_seconds', '连接目标地址的耗时', LATENCY_BUCKETS)
+DNS = REGISTRY.histogram('socks_dns_seconds', '域名解析的耗时(包括缓存命中)', LATENCY_BUCKETS)
+UPSTREAM = Direction(REGISTRY, 'upstream')
+DOWNSTREAM = Direction(REGISTRY, 'downstream')
+RELAY_ERRORS = REGISTRY.counter('socks_relay_errors_total', '因异常结束的中继')
+
+
+class Handler(http.server.BaseHTTPRequestHandler):
+    registry = REGISTRY
+
+    def do_GET(self):
+        url = urllib.parse.urlsplit(self.path)
+        if url.path == '/metrics':
+            body = self.registry.exposition().encode()
+        elif url.path == '/profile':  # /profile?seconds=N 采样N秒(最多tracing.MAX_SECONDS秒)后返回折叠调用栈
+            try:
+                seconds = float(urllib.parse.parse_qs(url.query).get('seconds', ['10'])[0])
+            except ValueError:
+                self.send_error(400)
+                return
+            if not 0 < seconds < float('inf'):  # 同时排除nan
+                self.send_error(400, 'seconds must be a positive number')
+                return
+            body = tracing.profile(seconds)
+            if body is None:
+                self.send_error(409, 'Profile already running')
+                return
+            body = body.encode()
+        else:
+            self.send_error(404)
+            return
+        self.send_response(200)
+        self.send_header('Content-Type', 'text/plain; version=0.0.4; charset=utf-8')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format, *args):
+        pass
+
+
+def start_server(address, port):
+    """
+    在后台线程中启动HTTP服务,GET /metrics返回所有指标
+    :param address: 监听地址
+    :param port: 监听端口
+    :return: http.server.ThreadingHTTPServer
+    """
+    server = http.server.ThreadingHTTPServer((address, port), Handler)
+    server.daemon_threads = True
+    thread = threading.Thread(target=server.serve_forever, daemon=True)
+    thread.start()
+    return server
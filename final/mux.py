@@ -0,0 +1,347 @@
+import struct
+import socket
+import asyncio
+import logging
+import frame
+import metrics
+
+# 多路复用帧类型,帧头(类型,流编号)和数据一起加密后再添加>I长度前缀
+OPEN = 1  # 打开流,数据为SOCKS请求
+REPLY = 2  # 服务端对OPEN的响应,数据为SOCKS响应
+DATA = 3  # 流数据
+CLOSE = 4  # 关闭流
+WINDOW_UPDATE = 5  # 接收方读出数据后归还发送窗口,数据为>I增量
+
+MUX_REQUEST = b'\x05\xf1\x00\x01\x00\x00\x00\x00\x00\x00'  # 握手完成后发送该请求(CMD=0xf1)表示进入带流量控制的多路复用模式,不支持的服务器回复失败
+HEADER = struct.Struct('>BI')
+INCREMENT = struct.Struct('>I')
+WINDOW = frame.HIGH_WATERMARK  # 每个流的接收窗口(字节),对端最多发送这么多尚未被读取的数据
+MAX_STREAMS = 1024  # 每条隧道同时打开的流数量上限,服务端拒绝超出的OPEN,本地客户端不再向满的隧道打开流
+FAILURE = b'\x05\x01\x00\x01\x00\x00\x00\x00\x00\x00'  # 拒绝OPEN时的SOCKS响应
+
+
+class Stream:
+    """
+    隧道中的一个逻辑流。每个方向有独立的窗口:发送方最多发送WINDOW字节尚未被对端读取的数据,
+    接收方读出一半窗口后用WINDOW_UPDATE归还,读取慢的流只会暂停自己的发送方,不会让隧道无限缓存或阻塞其他流
+    """
+
+    def __init__(self, tunnel, stream_id):
+        self.tunnel = tunnel
+        self.stream_id = stream_id
+        self.queue = asyncio.Queue()  # 收到的数据,None表示流已关闭
+        self.buffered = 0  # 队列中的字节数,不超过WINDOW
+        self.consumed = 0  # 已读出但尚未归还给对端的窗口
+        self.window = WINDOW  # 还可以发送给对端的字节数
+        self.writable = asyncio.Event()  # 窗口用完时清除,收到WINDOW_UPDATE或流关闭时设置
+        self.writable.set()
+        self.reply = asyncio.get_running_loop().create_future()
+        self.closed = False
+
+    async def send(self, data):
+        """
+        按对端的接收窗口发送数据,窗口用完时等待WINDOW_UPDATE
+        :param data: bytes
+        :raise ConnectionResetError: 等待窗口期间流被关闭
+        """
+        while data:
+            while self.window <= 0:
+                if self.closed:
+                    raise ConnectionResetError("Stream closed")
+                self.writable.clear()
+                await self.writable.wait()
+            if len(data) <= self.window:
+                chunk, data = data, b''
+            else:
+                chunk, data = data[:self.window], data[self.window:]
+            self.window -= len(chunk)
+            await self.tunnel.send(DATA, self.stream_id, chunk)
+
+    async def read(self):
+        """
+        读出队列中已有的全部数据,合并为一次写入;累计读出半个窗口后归还给对端
+        :return: 数据 | b''(流已关闭)
+        """
+        data = await self.queue.get()
+        if data is None:
+            return b''
+        if not self.queue.empty():
+            chunks = [data]
+            while not self.queue.empty():
+                chunk = self.queue.get_nowait()
+                if chunk is None:
+                    self.queue.put_nowait(None)  # 下一次读取返回b''
+                    break
+                chunks.append(chunk)
+            data = b''.join(chunks)
+        self.buffered -= len(data)
+        self.consumed += len(data)
+        if self.consumed >= WINDOW // 2 and not self.closed:
+            increment, self.consumed = self.consumed, 0
+            try:
+                await self.tunnel.send(WINDOW_UPDATE, self.stream_id, INCREMENT.pack(increment))
+            except socket.error:
+                pass
+        return data
+
+    def feed(self, data):
+        """
+        :return: 是否在接收窗口内,对端超出窗口时不缓存
+        """
+        if self.buffered + len(data) > WINDOW:
+            return False
+        self.buffered += len(data)
+        self.queue.put_nowait(data)
+        return True
+
+    def feed_eof(self):
+        self.closed = True
+        self.queue.put_nowait(None)
+        self.writable.set()
+        if not self.reply.done():
+            self.reply.set_result(b'')
+
+    def on_frame(self, frame_type, data):
+        """
+        处理隧道中属于该流的DATA、WINDOW_UPDATE和CLOSE帧,对端超出接收窗口时关闭流
+        :param frame_type: 帧类型
+        :param data: 数据
+        """
+        if frame_type == DATA:
+            if not self.feed(data):
+                logging.error("Stream %d exceeded the receive window", self.stream_id)
+                self.feed_eof()
+                asyncio.ensure_future(self.close())
+        elif frame_type == WINDOW_UPDATE:
+            if len(data) == INCREMENT.size:
+                self.window += INCREMENT.unpack(data)[0]
+                self.writable.set()
+        elif frame_type == CLOSE:
+            self.tunnel.streams.pop(self.stream_id, None)
+            self.feed_eof()
+
+    async def close(self):
+        if self.tunnel.streams.pop(self.stream_id, None) is not None:
+            self.closed = True
+            self.writable.set()
+            try:
+                await self.tunnel.send(CLOSE, self.stream_id)
+            except socket.error:
+                pass
+
+
+class Tunnel:
+    """
+    完成握手的加密连接,承载多个逻辑流
+    """
+
+    def __init__(self, reader, writer, cipher):
+        self.reader = reader
+        self.writer = writer
+        self.cipher = cipher
+        self.streams = {}
+        self.next_stream_id = 1
+        self.closed = False
+
+    async def send(self, frame_type, stream_id, data=b''):
+        """
+        发送一个多路复用帧
+        :param frame_type: 帧类型
+        :param stream_id: 流编号
+        :param data: 数据
+        """
+        if self.closed:
+            raise ConnectionResetError("Tunnel closed")
+        data = self.cipher.encrypt(HEADER.pack(frame_type, stream_id) + data)
+        self.writer.writelines((struct.pack(">I", len(data)), data))
+        await self.writer.drain()
+
+    async def read_frame(self):
+        """
+        读取一个多路复用帧
+        :return: (帧类型,流编号,数据) | None(隧道已关闭)
+        """
+        try:
+            data = await frame.read_frame(self.reader)
+        except (asyncio.IncompleteReadError, socket.error):
+            return
+        except ValueError:  # 帧长度超过上限
+            logging.exception("Exception occurred")
+            return
+        try:
+            data = self.cipher.decrypt(data)
+        except ValueError:
+            logging.exception("Exception occurred")
+            return
+        frame_type, stream_id = HEADER.unpack(data[:HEADER.size])
+        return frame_type, stream_id, data[HEADER.size:]
+
+    async def reject(self, stream_id):
+        """
+        拒绝一个OPEN:回复失败并关闭该流编号,不影响已经打开的流
+        :param stream_id: 流编号
+        """
+        try:
+            await self.send(REPLY, stream_id, FAILURE)
+            await self.send(CLOSE, stream_id)
+        except socket.error:
+            pass
+
+    def close(self):
+        self.closed = True
+        self.writer.close()
+        for stream in list(self.streams.values()):
+            stream.feed_eof()
+        self.streams.clear()
+
+
+class MuxClient:
+    """
+    本地客户端的隧道管理,维护少量长连接隧道并在其上打开逻辑流
+    """
+
+    def __init__(self, local, size):
+        """
+        :param local: AsyncLocal
+        :param size: 隧道数量
+        """
+        self.local = local
+        self.size = size
+        self.tunnels = []
+        self.connecting = 0  # 正在握手的隧道数量,握手期间占用一个隧道名额
+        self.supported = True  # 远程服务器不支持多路复用时回退到每个请求一个连接
+
+    async def connect(self):
+        """
+        建立一条新的隧道
+        :return: Tunnel | None
+        """
+        with metrics.HANDSHAKE.time():
+            remote = await self.local.remote_handshake(MUX_REQUEST)
+        if not remote:
+            return
+        cipher, reader, writer = remote
+        try:
+            if not cipher.early_data:  # 0-RTT握手时多路复用请求已随握手数据发送
+                writer.write(cipher.encrypt(MUX_REQUEST))
+                await writer.drain()
+            response = await asyncio.wait_for(reader.readexactly(10 + cipher.overhead), self.local.config.getint('server', 'timeout'))
+            response = cipher.decrypt(response)
+        except (socket.error, ValueError, asyncio.TimeoutError, asyncio.IncompleteReadError):
+            logging.exception("Exception occurred")
+            writer.close()
+            return
+        if response[0:2] != b'\x05\x00':
+            logging.error("Remote server does not support multiplexing")
+            self.supported = False
+            writer.close()
+            return
+        tunnel = Tunnel(reader, writer, cipher)
+        asyncio.ensure_future(self.dispatch(tunnel))
+        return tunnel
+
+    async def dispatch(self, tunnel):
+        """
+        读取隧道中的帧并分发到对应的流
+        :param tunnel: Tunnel
+        """
+        while True:
+            frame = await tunnel.read_frame()
+            if frame is None:
+                break
+            frame_type, stream_id, data = frame
+            stream = tunnel.streams.get(stream_id)
+            if stream is None:
+                continue
+            if frame_type == REPLY:
+                if not stream.reply.done():
+                    stream.reply.set_result(data)
+            else:
+                stream.on_frame(frame_type, data)
+        tunnel.close()
+        if tunnel in self.tunnels:
+            self.tunnels.remove(tunnel)
+
+    async def tunnel(self):
+        """
+        获取承载流最少的隧道,隧道数量不足时新建。选择和占用名额之间没有await,不需要加锁;
+        握手在占用名额之后进行,服务器不可达时其他请求不会排在失败的握手后面,而是直接回退
+        :return: Tunnel | None(没有可用的隧道)
+        """
+        self.tunnels = [tunnel for tunnel in self.tunnels if not tunnel.closed]
+        if len(self.tunnels) + self.connecting < self.size:
+            self.connecting += 1
+            try:
+                tunnel = await self.connect()
+            finally:
+                self.connecting -= 1
+            if tunnel:
+                self.tunnels.append(tunnel)
+                return tunnel
+        tunnels = [tunnel for tunnel in self.tunnels if not tunnel.closed and len(tunnel.streams) < MAX_STREAMS]
+        if not tunnels:
+            return
+        return min(tunnels, key=lambda tunnel: len(tunnel.streams))
+
+    async def open(self, request):
+        """
+        打开一个逻辑流并发送SOCKS请求
+        :param request: 浏览器的SOCKS请求
+        :return: (Stream,SOCKS响应) | None(没有可用的隧道,或收到响应之前超时、隧道关闭,调用方回退到每个请求一个连接)
+        """
+        tunnel = await self.tunnel()
+        if not tunnel:
+            return
+        stream = Stream(tunnel, tunnel.next_stream_id)
+        tunnel.next_stream_id += 1
+        tunnel.streams[stream.stream_id] = stream
+        try:
+            await tunnel.send(OPEN, stream.stream_id, request)
+            response = await asyncio.wait_for(asyncio.shield(stream.reply), self.local.config.getint('server', 'timeout'))
+        except (socket.error, asyncio.TimeoutError):
+            logging.exception("Exception occurred")
+            await stream.close()
+            return
+        if not response:  # 隧道在收到响应之前关闭
+            return
+        return stream, response
+
+
+async def relay(stream, reader, writer, buffer_size, inbound=metrics.UPSTREAM, outbound=metrics.DOWNSTREAM):
+    """
+    在逻辑流和普通连接之间中继数据,任意一个方向结束后关闭逻辑流
+    :param stream: Stream
+    :param reader: StreamReader
+    :param writer: StreamWriter
+    :param buffer_size: 读取大小
+    :param inbound: 从普通连接读取的数据的方向(metrics.Direction)
+    :param outbound: 写入普通连接的数据的方向(metrics.Direction)
+    """
+
+    async def upstream():
+        while True:
+            data = await reader.read(buffer_size)
+            if data == b'':
+                return
+            inbound.bytes.inc(len(data))
+            await stream.send(data)
+
+    async def downstream():
+        while True:
+            data = await stream.read()
+            if data == b'':
+                return
+            outbound.bytes.inc(len(data))
+            writer.write(data)
+            await writer.drain()
+
+    tasks = [asyncio.ensure_future(upstream()), asyncio.ensure_future(downstream())]
+    done, pending = await asyncio.wait(tasks, return_when=asyncio.FIRST_COMPLETED)
+    for task in pending:
+        task.cancel()
+    for task in done:
+        if task.exception():
+            metrics.RELAY_ERRORS.inc()
+        if task.exception() and not isinstance(task.exception(), socket.error):
+            logging.error("Exception occurred", exc_info=task.exception())
+    await stream.close()
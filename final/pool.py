@@ -0,0 +1,97 @@
+import time
+import select
+import logging
+import threading
+import collections
+
+
+class TunnelPool:
+    """
+    预先完成远程服务器握手的连接池,后台线程将连接池补充到目标数量,并在服务器断开之前丢弃过期的连接
+    """
+
+    def __init__(self, handshake, size, max_age):
+        """
+        :param handshake: 远程服务器握手函数,返回(crypto.CipherSession,socket) | None
+        :param size: 连接池目标数量
+        :param max_age: 连接的最长保留时间(秒)
+        """
+        self.handshake = handshake
+        self.size = size
+        self.max_age = max_age
+        self.entries = collections.deque()  # (创建时间,(crypto.CipherSession,socket))
+        self.condition = threading.Condition()
+        self.hits = 0
+        self.misses = 0
+        self.discarded = 0
+
+    def start(self):
+        thread = threading.Thread(target=self.refill, daemon=True)
+        thread.start()
+
+    def alive(self, sock):
+        """
+        检查连接是否仍然可用,握手完成后服务器不会主动发送数据,可读说明连接已被关闭
+        :param sock: socket
+        :return: bool
+        """
+        try:
+            rlist, wlist, xlist = select.select([sock], [], [], 0)
+        except (select.error, ValueError):
+            return False
+        return not rlist
+
+    def discard_stale(self):
+        """
+        丢弃过期的连接,调用方需持有condition
+        """
+        now = time.monotonic()
+        while self.entries and now - self.entries[0][0] >= self.max_age:
+            created, (cipher, sock) = self.entries.popleft()
+            sock.close()
+            self.discarded += 1
+
+    def refill(self):
+        while True:
+            with self.condition:
+                self.discard_stale()
+                if len(self.entries) >= self.size:
+                    self.condition.wait(max(self.entries[0][0] + self.max_age - time.monotonic(), 0.1))
+                    continue
+            try:
+                remote = self.handshake()
+            except Exception:  # 服务器密钥不匹配或握手数据损坏时不能让补充线程退出
+                logging.exception("Exception occurred")
+                remote = None
+            if not remote:
+                time.sleep(1)
+                continue
+            with self.condition:
+                self.entries.append((time.monotonic(), remote))
+
+    def take(self):
+        """
+        从连接池中取出一个可用连接
+        :return: (crypto.CipherSession,socket) | None(连接池为空)
+        """
+        with self.condition:
+            self.discard_stale()
+            while self.entries:
+                created, (cipher, sock) = self.entries.popleft()
+                if self.alive(sock):
+                    self.hits += 1
+                    self.condition.notify()
+                    return cipher, sock
+                sock.close()
+                self.discarded += 1
+            self.misses += 1
+            self.condition.notify()
+        return
+
+    def stats(self):
+        with self.condition:
+            return {'size': len(self.entries), 'hits': self.hits, 'misses': self.misses, 'discarded': self.discarded}
+
+    def print_stats(self, signum=None, frame=None):
+        stats = self.stats()
+        print("pool size={size} hits={hits} misses={misses} discarded={discarded}".format(**stats), flush=True)
@@ -0,0 +1,117 @@
+import os
+import time
+import signal
+import logging
+import multiprocessing
+
+context = multiprocessing.get_context('fork')
+
+
+class Counters:
+    """
+    工作进程计数器,保存在共享内存中,管理进程可以直接读取
+    """
+    fields = ('accepted', 'closed')
+
+    def __init__(self):
+        self.array = context.Array('Q', len(self.fields))
+
+    def incr(self, name):
+        with self.array.get_lock():
+            self.array[self.fields.index(name)] += 1
+
+    def snapshot(self):
+        with self.array.get_lock():
+            return dict(zip(self.fields, self.array[:]))
+
+
+class Supervisor:
+    """
+    多进程模式的管理进程,启动多个工作进程,每个工作进程通过SO_REUSEPORT绑定相同的地址和端口并独立accept,
+    工作进程退出后自动重启,收到SIGUSR1时输出各工作进程的计数器
+    """
+
+    def __init__(self, instance, workers):
+        """
+        :param instance: Server | AsyncServer | Local | AsyncLocal
+        :param workers: 工作进程数量
+        """
+        self.instance = instance
+        self.workers = workers
+        self.processes = [None] * workers
+        self.counters = [Counters() for _ in range(workers)]
+        self.restarts = [0] * workers
+
+    def worker(self, index):
+        """
+        工作进程入口
+        :param index: 工作进程编号
+        """
+        signal.signal(signal.SIGTERM, signal.SIG_DFL)
+        signal.signal(signal.SIGUSR1, signal.SIG_IGN)
+        signal.signal(signal.SIGUSR2, signal.SIG_IGN)
+        self.instance.counters = self.counters[index]
+        self.instance.worker_index = index
+        self.instance.run()
+
+    def start(self, index):
+        process = context.Process(target=self.worker, args=(index,), daemon=True)
+        process.start()
+        self.processes[index] = process
+
+    def stats(self):
+        """
+        汇总各工作进程的计数器
+        :return: [每个工作进程的计数器], 合计
+        """
+        workers = []
+        total = dict.fromkeys(Counters.fields, 0)
+        total['restarts'] = 0
+        for index, process in enumerate(self.processes):
+            counters = self.counters[index].snapshot()
+            for name, value in counters.items():
+                total[name] += value
+            total['restarts'] += self.restarts[index]
+            counters.update(index=index, pid=process.pid if process else None, restarts=self.restarts[index])
+            workers.append(counters)
+        return workers, total
+
+    def print_stats(self, signum=None, frame=None):
+        workers, total = self.stats()
+        for counters in workers:
+            print("worker {index} pid={pid} accepted={accepted} closed={closed} restarts={restarts}".format(**counters), flush=True)
+        print("total accepted={accepted} closed={closed} restarts={restarts}".format(**total), flush=True)
+
+    def profile(self, signum=None, frame=None):
+        """
+        把SIGUSR2转发给所有工作进程,每个工作进程分别写入自己的采样结果
+        """
+        for process in self.processes:
+            if process and process.is_alive():
+                os.kill(process.pid, signal.SIGUSR2)
+
+    def stop(self, signum=None, frame=None):
+        for process in self.processes:
+            if process and process.is_alive():
+                process.terminate()
+        for process in self.processes:
+            if process:
+                process.join()
+        os._exit(0)
+
+    def run(self):
+        signal.signal(signal.SIGTERM, self.stop)
+        signal.signal(signal.SIGUSR1, self.print_stats)
+        signal.signal(signal.SIGUSR2, self.profile)
+        for index in range(self.workers):
+            self.start(index)
+        try:
+            while True:
+                time.sleep(1)
+                for index, process in enumerate(self.processes):
+                    if not process.is_alive():
+                        logging.error("Worker %d (pid %d) exited with code %s, restarting", index, process.pid, process.exitcode)
+                        self.restarts[index] += 1
+                        self.start(index)
+        except KeyboardInterrupt:
+            self.stop()
@@ -0,0 +1,134 @@
+import time
+import socket
+import asyncio
+import threading
+import collections
+import concurrent.futures
+
+
+class Resolver:
+    """
+    域名解析,getaddrinfo在线程池中执行。成功和失败的结果都按TTL缓存,超过容量时淘汰最久未使用的域名;
+    同一域名的并发查询合并为一次getaddrinfo,其余调用方等待同一个Future
+    """
+
+    def __init__(self, size, ttl, negative_ttl, threads):
+        """
+        :param size: 缓存的域名数量上限
+        :param ttl: 解析成功的缓存时间(秒),getaddrinfo不返回记录的TTL,使用固定值
+        :param negative_ttl: 解析失败的缓存时间(秒)
+        :param threads: 解析线程数量
+        """
+        self.size = size
+        self.ttl = ttl
+        self.negative_ttl = negative_ttl
+        self.executor = concurrent.futures.ThreadPoolExecutor(threads, thread_name_prefix='resolver')
+        self.cache = collections.OrderedDict()  # 域名: (过期时间,[(family,ip)] | 异常)
+        self.pending = {}  # 域名: 正在查询的Future
+        self.lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+        self.coalesced = 0  # 等待其他调用方查询结果的次数
+        self.lookups = 0
+        self.failures = 0
+        self.latency_total = 0
+        self.latency_max = 0
+
+    def lookup(self, host):
+        """
+        在解析线程中调用getaddrinfo并写入缓存
+        :param host: 域名
+        :return: [(family,ip)]
+        """
+        start = time.monotonic()
+        try:
+            infos = socket.getaddrinfo(host, None, socket.AF_UNSPEC, socket.SOCK_STREAM)
+            addresses = list(dict.fromkeys((family, sockaddr[0]) for family, type, proto, canonname, sockaddr in infos))
+            result, ttl = addresses, self.ttl
+        except socket.gaierror as err:
+            result, ttl = err, self.negative_ttl
+        except UnicodeError as err:  # 域名中有空标签或超长标签时idna编码失败
+            result, ttl = socket.gaierror(socket.EAI_NONAME, str(err)), self.negative_ttl
+        now = time.monotonic()
+        with self.lock:
+            self.lookups += 1
+            self.latency_total += now - start
+            self.latency_max = max(self.latency_max, now - start)
+            if isinstance(result, Exception):
+                self.failures += 1
+            self.cache[host] = (now + ttl, result)
+            self.cache.move_to_end(host)
+            while len(self.cache) > self.size:
+                self.cache.popitem(last=False)
+            del self.pending[host]
+        if isinstance(result, Exception):
+            raise result
+        return result
+
+    def submit(self, host):
+        """
+        查询缓存,未命中时提交查询,已有相同域名的查询时复用其Future
+        :param host: 域名
+        :return: concurrent.futures.Future
+        """
+        with self.lock:
+            entry = self.cache.get(host)
+            if entry and entry[0] > time.monotonic():
+                self.hits += 1
+                self.cache.move_to_end(host)
+                future = concurrent.futures.Future()
+                if isinstance(entry[1], Exception):
+                    future.set_exception(type(entry[1])(*entry[1].args))  # 每次抛出新的异常,避免同一个异常对象的traceback不断增长
+                else:
+                    future.set_result(entry[1])
+                return future
+            self.misses += 1
+            future = self.pending.get(host)
+            if future:
+                self.coalesced += 1
+                return future
+            future = self.executor.submit(self.lookup, host)
+            self.pending[host] = future
+            return future
+
+    def resolve(self, host, timeout=None):
+        """
+        阻塞解析,用于多线程模式
+        :param host: 域名
+        :param timeout: 等待时间(秒),超时后查询继续在后台执行并写入缓存
+        :return: [(family,ip)]
+        """
+        try:
+            return self.submit(host).result(timeout)
+        except concurrent.futures.TimeoutError:
+            raise socket.timeout('resolve {} timed out'.format(host))
+
+    async def resolve_async(self, host):
+        """
+        异步解析,用于asyncio模式
+        :param host: 域名
+        :return: [(family,ip)]
+        """
+        future = asyncio.wrap_future(self.submit(host))
+        future.add_done_callback(lambda future: future.cancelled() or future.exception())  # 调用方已超时的查询失败时取出异常,避免asyncio报告异常未被获取
+        # 调用方超时取消时不能取消共享的Future,否则其他等待同一域名的调用方也会被取消
+        return await asyncio.shield(future)
+
+    def stats(self):
+        with self.lock:
+            requests = self.hits + self.misses
+            return {
+                'size': len(self.cache),
+                'hits': self.hits,
+                'misses': self.misses,
+                'coalesced': self.coalesced,
+                'hit_rate': self.hits / requests if requests else 0.0,
+                'lookups': self.lookups,
+                'failures': self.failures,
+                'latency_avg': self.latency_total / self.lookups if self.lookups else 0.0,
+                'latency_max': self.latency_max,
+            }
+
+    def print_stats(self):
+        print("resolver size={size} hits={hits} misses={misses} coalesced={coalesced} hit_rate={hit_rate:.2%} lookups={lookups} failures={failures} "
+              "latency_avg={latency_avg:.6f}s latency_max={latency_max:.6f}s".format(**self.stats()), flush=True)
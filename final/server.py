@@ -1,17 +1,51 @@
 import socket
 import select
+import asyncio
 import struct
 import crypto
-import threading
-import time
+import prefork
+import mux
+import frame
+import workers
+import resolver
+import dialer
+import udp
+import metrics
+import tracing
 import logging
+import signal
 from configparser import ConfigParser
 
 
 class Server:
     def __init__(self, config):
         self.config = config
-        self.cipher = crypto.Cipher()
+        self.counters = None  # 多进程模式下由prefork.Supervisor设置
+        self.worker_index = 0  # 多进程模式下的工作进程编号
+        self.buffers = frame.BufferPool()
+        self.workers = None  # 多线程模式的工作线程池
+        self.suites = crypto.parse_suites(self.config.get('encrypt', 'suites', fallback='rc4'))
+        self.buffer_size = self.config.getint('server', 'buffer_size')  # 配置只解析一次,中继时不再查询
+        self.flush_latency = self.config.getint('server', 'flush_latency', fallback=0) / 1000
+        self.max_frame = self.config.getint('server', 'max_frame', fallback=0)
+        self.high_watermark = self.config.getint('server', 'high_watermark', fallback=frame.HIGH_WATERMARK)
+        self.low_watermark = self.config.getint('server', 'low_watermark', fallback=frame.LOW_WATERMARK)
+        self.timeout = self.config.getint('server', 'timeout')
+        self.request_timeout = self.config.getint('server', 'request_timeout', fallback=60)  # 握手后等待第一个请求的时间,需大于本地客户端的pool_max_age
+        self.connect_delay = self.config.getint('server', 'connect_delay', fallback=dialer.CONNECTION_ATTEMPT_DELAY * 1000) / 1000
+        self.udp_timeout = self.config.getint('server', 'udp_timeout', fallback=60)
+        if self.udp_timeout <= 0:
+            raise ValueError("[server] udp_timeout must be greater than 0, got {}".format(self.udp_timeout))
+        self.udp = udp.Stats()
+        self.resolver = resolver.Resolver(self.config.getint('server', 'dns_cache_size', fallback=1024), self.config.getint('server', 'dns_ttl', fallback=60),
+                                          self.config.getint('server', 'dns_negative_ttl', fallback=10), self.config.getint('server', 'dns_threads', fallback=8))
+        self.tracer = None  # 按[trace]中的sample采样连接的各阶段耗时
+        if self.config.getfloat('trace', 'sample', fallback=0) > 0:
+            self.tracer = tracing.Tracer('server', self.config.get('trace', 'filename', fallback='trace.jsonl'), self.config.getfloat('trace', 'sample'))
+        self.replays = crypto.ReplayCache() if self.config.getboolean('encrypt', 'early_data', fallback=False) else None  # 接受0-RTT请求时记录已使用的早期密钥材料
+        self.sessions = None
+        if self.config.getboolean('encrypt', 'resumption', fallback=False):
+            self.sessions = crypto.SessionCache(self.config.getint('encrypt', 'session_cache', fallback=1024), self.config.getint('encrypt', 'session_ttl', fallback=3600))
         logging.basicConfig(filename=self.config.get('log', 'filename'), filemode="w", format="%(asctime)s %(name)s:%(levelname)s:%(message)s", datefmt="%Y-%M-%d %H:%M:%S", level=logging.ERROR)
 
     def socket_init(self):
@@ -35,6 +69,8 @@ class Server:
         """
         try:
             sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+            if self.config.getint('server', 'workers', fallback=1) > 1:
+                sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEPORT, 1)  # 多进程模式下每个工作进程绑定相同的地址和端口
             sock.bind((self.config.get('server', 'address'), self.config.getint('server', 'port')))
         except socket.error:
             logging.exception("Failed to bind port")
@@ -46,51 +82,113 @@ class Server:
             logging.exception("Failed to listen")
             sock.close()
             exit(-1)
+        if self.config.getboolean('server', 'fastopen', fallback=False):
+            try:
+                sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_FASTOPEN, 128)  # 客户端的第一次发送随SYN到达,需要net.ipv4.tcp_fastopen包含2
+            except (socket.error, AttributeError):
+                logging.exception("Failed to enable TCP fast open")
         return sock
 
     def ECDH_negotiate(self, conn):
         """
-        ECDH密钥协商阶段
+        ECDH密钥协商阶段,客户端请求会话恢复时优先从会话缓存中派生密钥。
+        握手数据和早期数据帧都按长度读取,与客户端的数据如何分段到达无关
         :param conn: socket
-        :return: 协商密钥 | false
+        :return: crypto.CipherSession | false
         """
         try:
-            data = conn.recv(self.config.getint('server', 'buffer_size'))
+            data = frame.recv_exactly(conn, len(crypto.RESUME))
+            if data == crypto.RESUME:
+                data += frame.recv_exactly(conn, crypto.RESUME_LENGTH - len(data))
+                reply, session, key = self.sessions.parse_resume_data(data) if self.sessions else (crypto.RESUME_MISS, None, None)
+                conn.sendall(reply)
+                if key:
+                    return crypto.CipherSession(key, session.params, client=False)
+                data = b''  # 会话恢复失败,客户端在同一连接上进行完整握手
+            encrypt = crypto.ECDH(self.config.get('encrypt', 'curve'), self.config.get('encrypt', 'backend', fallback='tinyec'))
+            data += frame.recv_exactly(conn, encrypt.handshake_size - len(data))
         except socket.error:
             logging.exception("Exception occurred")
             return False
-        encrypt = crypto.ECDH(self.config.get('encrypt', 'curve'))
         share_key = encrypt.parse_share_key_from_first_handshake_data(data)
         if share_key:
-            data = encrypt.generate_first_handshake_data()
+            params, extensions = crypto.server_negotiate(encrypt.extensions, self.suites, self.max_frame)
+            if not params:
+                return False
+            request = None
+            if crypto.EarlyData.parse(encrypt.extensions):  # 客户端发送了早期数据时握手数据之后紧跟一个早期数据帧,不接受也要读出
+                try:
+                    request = self.early_request(encrypt.extensions, frame.recv_frame(conn))
+                except (socket.error, ValueError):
+                    logging.exception("Exception occurred")
+                    return False
+                if request:
+                    extensions[crypto.EXTENSION_EARLY_DATA] = b'\x01'
+            data = encrypt.generate_first_handshake_data(extensions)
             try:
                 conn.sendall(data)
             except socket.error:
                 logging.exception("Exception occurred")
                 return False
-            return share_key
+            key = share_key[10:42].encode()
+            if self.sessions:
+                self.sessions.put(crypto.Session(key, params))
+            cipher = crypto.CipherSession(key, params, client=False)
+            cipher.early_data = request
+            return cipher
         else:
             return False
 
-    def parse_dst_from_request(self, conn, key):
+    def early_request(self, extensions, data):
+        """
+        解密0-RTT请求。未开启0-RTT、不支持客户端使用的加密套件或密钥材料被重复使用时不接受,客户端会在握手完成后重新发送请求
+        :param extensions: 客户端的握手扩展
+        :param data: 早期数据帧的内容
+        :return: 解密后的请求 | None(不接受)
+        :raise ValueError: 解密失败
+        """
+        early = crypto.EarlyData.parse(extensions)
+        if not early or not self.replays or early.suite not in self.suites or not self.replays.check(early.secret):
+            return
+        return early.cipher(client=False).decrypt(data)
+
+    def parse_dst_from_request(self, conn, cipher):
         """
         从请求中提取目标地址和端口
         :param conn: socket
-        :param key: 密钥
-        :return: (目标地址,端口)
+        :param cipher: 加密会话
+        :return: (目标地址,端口) | udp.ASSOCIATE
         """
         try:
-            data = conn.recv(self.config.getint('server', 'buffer_size'))
-            data = self.cipher.decrypt(key, data)
-        except ConnectionResetError:
+            if cipher.early_data:  # 0-RTT握手时请求已随握手数据到达
+                data = cipher.early_data
+            else:
+                conn.settimeout(self.request_timeout)  # 连接池中的连接在握手后空闲等待请求,不能无限占用工作线程
+                data = cipher.decrypt(conn.recv(self.buffer_size))
+                conn.settimeout(None)
+        except (ConnectionResetError, socket.timeout, ValueError):
             conn.close()
             logging.exception("Exception occurred")
             return False
+        tracing.annotate_target(data)
+        if data[0:3] == udp.ASSOCIATE:  # UDP ASSOCIATE请求中的地址是客户端发送数据报的地址,由本地客户端处理,这里忽略
+            return udp.ASSOCIATE
+        return self.parse_dst(data)
+
+    def parse_dst(self, data):
+        """
+        解析解密后的请求数据
+        :param data: 解密后的请求
+        :return: (目标地址,端口) | False
+        """
         if data[0:3] != b'\x05\x01\x00':  # 版本号为5,CONNECT请求为0x01,0x00为保留字
             return False
         if data[3:4] == b'\x01':  # ATYP检查,1为ipv4
             addr = socket.inet_ntoa(data[4:8])  # addr是一个4字节的ipv4地址,inet_ntoa后得到10.11.12.13
             port = struct.unpack('>H', data[8:10])[0]  # 端口号是一个两字节的大端无符号整数
+        elif data[3:4] == b'\x04':  # ATYP检查,4为ipv6
+            addr = socket.inet_ntop(socket.AF_INET6, data[4:20])
+            port = struct.unpack('>H', data[20:22])[0]
         elif data[3:4] == b'\x03':  # ATYP检查,3为域名
             addr_length = data[4]
             addr = data[5: 5 + addr_length]  # addr是一个可变长度字符串,以1字节长度开头,后跟最多255字节的域名
@@ -99,19 +197,70 @@ class Server:
             return False
         return addr, port
 
-    def request(self, conn, key):
+    def early_payload(self, data):
+        """
+        本地客户端的乐观模式下,0-RTT请求之后紧跟浏览器的第一段数据,连接目标后直接发送
+        :param data: 解密后的0-RTT请求
+        :return: 请求之后的数据
+        """
+        if data[3:4] == b'\x01':
+            size = 10
+        elif data[3:4] == b'\x04':
+            size = 22
+        else:
+            size = 7 + data[4]
+        return data[size:]
+
+    def resolve(self, addr):
+        """
+        域名通过resolver解析,IP地址直接返回
+        :param addr: 目标地址,域名为bytes
+        :return: [(family,ip)]
+        """
+        if not isinstance(addr, bytes):
+            return [(socket.AF_INET6 if ':' in addr else socket.AF_INET, addr)]
+        with metrics.DNS.time(), tracing.span('resolve'):
+            return self.resolver.resolve(addr.decode(errors='replace'), self.timeout)
+
+    def connect(self, dst):
+        """
+        对解析得到的所有地址交错并行连接
+        :param dst: (目标地址,端口)
+        :return: socket
+        """
+        addr, port = dst
+        addresses = self.resolve(addr)
+        with metrics.CONNECT.time(), tracing.span('connect'):
+            return dialer.connect(addresses, port, self.connect_delay, self.timeout)
+
+    def bound_address(self, sockname):
+        """
+        响应中的绑定地址和端口。本地客户端按10字节读取响应,因此ATYP固定为0x01,连接目标使用ipv6时地址为0.0.0.0
+        :param sockname: 连接目标的socket的本地地址
+        :return: bytes
+        """
+        if ':' in sockname[0]:
+            return b'\x00\x00\x00\x00' + struct.pack(">H", sockname[1])
+        return socket.inet_aton(sockname[0]) + struct.pack(">H", sockname[1])
+
+    def request(self, conn, cipher):
         """
         请求阶段,满足条件则进行中继
         :param conn: socket
-        :param key: 密钥
+        :param cipher: 加密会话
         :return:
         """
-        dst = self.parse_dst_from_request(conn, key)
+        with tracing.span('request'):
+            dst = self.parse_dst_from_request(conn, cipher)
+        if dst == udp.ASSOCIATE:
+            self.udp_associate(conn, cipher)
+            return
         sock = None
         if dst:
-            sock = self.socket_init()
             try:
-                sock.connect(dst)
+                sock = self.connect(dst)
+                if cipher.early_data:
+                    sock.sendall(self.early_payload(cipher.early_data))
             except socket.error:
                 logging.exception("Exception occurred")
                 return
@@ -120,67 +269,110 @@ class Server:
             bnd = b'\x00\x00\x00\x00\x00\x00'
         else:
             rep = b'\x00'  # 初始化完成
-            bnd = socket.inet_aton(sock.getsockname()[0])  # 绑定地址
-            bnd += struct.pack(">H", sock.getsockname()[1])  # 绑定端口
+            bnd = self.bound_address(sock.getsockname())  # 绑定地址和端口
         response = b'\x05' + rep + b'\x00' + b'\x01' + bnd
         try:
-            response = self.cipher.encrypt(key, response)
+            response = cipher.encrypt(response)
             conn.sendall(response)
         except socket.error:
             logging.exception("Exception occurred")
             conn.close()
             return
         if rep == b'\x00':
-            self.relay(conn, sock, key)
+            with tracing.span('relay'):
+                self.relay(conn, sock, cipher)
         if conn:
             conn.close()
         if sock:
             sock.close()
 
-    def relay(self, socket_src, socket_dst, key):
+    def udp_associate(self, conn, cipher):
+        """
+        UDP ASSOCIATE请求,数据报在隧道中逐个成帧,由udp.ServerAssociation中继到目标地址
+        :param conn: socket
+        :param cipher: 加密会话
+        :return:
+        """
+        try:
+            conn.sendall(cipher.encrypt(b'\x05\x00\x00\x01' + b'\x00\x00\x00\x00\x00\x00'))  # 数据报由本地客户端的UDP socket接收,绑定地址由本地客户端回复浏览器
+        except socket.error:
+            logging.exception("Exception occurred")
+            conn.close()
+            return
+        self.udp.run(udp.ServerAssociation(self.resolver, conn, cipher, self.buffers, self.flush_latency, self.high_watermark, self.low_watermark, self.udp_timeout))
+        conn.close()
+
+    def relay(self, socket_src, socket_dst, cipher):
         """
         中继(relay)阶段
         :param socket_src: 来源地址
         :param socket_dst: 目标地址
-        :param key: 密钥
+        :param cipher: 加密会话
         :return:
         """
-        length_dict = {}
-        while True:
-            try:
-                rlist, wlist, xlist = select.select([socket_src, socket_dst], [], [])
-            except select.error:
-                logging.exception("Exception occurred")
-                return
-            if not rlist:
-                continue
-            try:
-                for sock in rlist:
-                    data = sock.recv(self.config.getint('server', 'buffer_size'))
-                    if data == b'':
-                        return
-                    if sock is socket_dst:
-                        data = self.cipher.encrypt(key, data)
-                        length = struct.pack(">I", len(data))
-                        data = length + data
-                        socket_src.send(data)
-                    else:
-                        if sock not in length_dict.keys():
-                            length = struct.unpack(">I", data[0:4])[0]
-                            length_dict[sock] = [length, b'']
-                        length_dict[sock][1] += data
-                        if length_dict[sock][0] == len(length_dict[sock][1][4:]):
-                            data = self.cipher.decrypt(key, length_dict[sock][1][4:])
-                            socket_dst.send(data)
-                            length_dict.pop(sock)
-                        elif length_dict[sock][0] < len(length_dict[sock][1][4:]):
-                            data = self.cipher.decrypt(key, length_dict[sock][1][4:4 + length_dict[sock][0]])
-                            socket_dst.send(data)
-                            length_dict[sock][1] = length_dict[sock][1][4 + length_dict[sock][0]:]
-                            length_dict[sock][0] = struct.unpack(">I", length_dict[sock][1][0:4])[0]
-            except socket.error:
-                logging.exception("Exception occurred")
-                return
+        decoder = frame.FrameDecoder(self.buffers)
+        read_size = frame.read_size(self.buffer_size, cipher)
+        writer = frame.FrameWriter(socket_src, self.flush_latency, high=self.high_watermark, low=self.low_watermark)  # 发送到客户端
+        output = frame.OutputQueue(socket_dst, self.high_watermark, self.low_watermark)  # 发送到目标地址
+        reading = {socket_src: True, socket_dst: True}  # 对端的发送队列超过高水位时暂停读取
+        closing = False  # 任意一端关闭后停止读取,发送完队列中的数据后结束
+        trace = tracing.current.get()
+        socket_src.setblocking(False)
+        socket_dst.setblocking(False)
+        try:
+            while True:
+                if closing and not writer.buffers and not output.buffers:
+                    return
+                rlist = [sock for sock in (socket_src, socket_dst) if reading[sock] and not closing]
+                wlist = [queue.sock for queue in (writer, output) if queue.blocked]
+                try:
+                    rlist, wlist, xlist = select.select(rlist, wlist, [], self.timeout if closing else writer.timeout())
+                except select.error:
+                    logging.exception("Exception occurred")
+                    return
+                if closing and not wlist:
+                    return
+                try:
+                    for sock in wlist:
+                        (writer if sock is socket_src else output).flush()
+                    for sock in rlist:
+                        if sock is socket_dst:
+                            data = sock.recv(read_size.size)
+                            if data == b'':
+                                closing = True
+                                writer.flush()
+                                break
+                            if trace:
+                                trace.mark('first_byte_downstream')
+                            read_size.update(len(data))
+                            metrics.DOWNSTREAM.bytes.inc(len(data))
+                            data = cipher.encrypt(data)
+                            metrics.DOWNSTREAM.frame(len(data))
+                            writer.write(data)
+                        else:
+                            if decoder.recv_into(sock) == 0:
+                                closing = True
+                                writer.flush()
+                                break
+                            for data in decoder.frames():
+                                if trace:
+                                    trace.mark('first_byte_upstream')
+                                metrics.UPSTREAM.frame(len(data))
+                                data = cipher.decrypt(data)
+                                metrics.UPSTREAM.bytes.inc(len(data))
+                                output.write(data)
+                    writer.poll()
+                except (socket.error, ValueError):  # ValueError: AEAD认证失败或帧长度超过上限
+                    metrics.RELAY_ERRORS.inc()
+                    logging.exception("Exception occurred")
+                    return
+                for queue, sock in ((writer, socket_dst), (output, socket_src)):
+                    if queue.full():
+                        reading[sock] = False
+                    elif queue.drained():
+                        reading[sock] = True
+        finally:
+            decoder.close()
 
     def handshake(self, conn):
         """
@@ -188,22 +380,78 @@ class Server:
         :param conn: socket
         :return:
         """
-        share_key = self.ECDH_negotiate(conn)
-        if share_key:
-            key = share_key[10:42].encode()
-            self.request(conn, key)
+        if self.counters:
+            self.counters.incr('accepted')
+        metrics.ACCEPTED.inc()
+        metrics.ACTIVE.inc()
+        try:
+            with self.tracer.connection() if self.tracer else tracing.null_span:
+                with metrics.HANDSHAKE.time(), tracing.span('ECDH_negotiate'):
+                    cipher = self.ECDH_negotiate(conn)
+                if cipher:
+                    self.request(conn, cipher)
+        finally:
+            metrics.ACTIVE.dec()
+            if self.counters:
+                self.counters.incr('closed')
+
+    def print_stats(self, signum=None, frame=None):
+        if self.workers:
+            self.workers.print_stats()
+        print("keys load_time={load_time:.6f}s reloads={reload_count}".format(**crypto.get_key_store().stats()), flush=True)
+        self.resolver.print_stats()
+        self.udp.print_stats()
+        if self.replays:
+            print("early_data replays={}".format(self.replays.replays), flush=True)
+        if self.sessions:
+            print("sessions size={size} hits={hits} misses={misses} hit_rate={hit_rate:.2%}".format(**self.sessions.stats()), flush=True)
+
+    def worker_pool(self, handler):
+        """
+        多线程模式的工作线程池,线程数量为threads,准入队列已满或等待超时的连接直接关闭,本地客户端按远程服务器握手失败处理
+        :param handler: 连接处理函数
+        :return: workers.WorkerPool
+        """
+        return workers.WorkerPool(handler, self.reject, self.config.getint('server', 'threads'),
+                                  self.config.getint('server', 'queue_size', fallback=128),
+                                  self.config.getfloat('server', 'queue_timeout', fallback=self.timeout))
+
+    def reject(self, conn):
+        """
+        拒绝连接。握手尚未开始,服务端没有可以回复的数据,这里不做任何处理,返回后由workers.WorkerPool关闭连接
+        :param conn: socket
+        """
+
+    def start_metrics(self):
+        """
+        [metrics]中server_port不为0时启动指标的HTTP服务,多进程模式下每个工作进程监听server_port加工作进程编号
+        """
+        port = self.config.getint('metrics', 'server_port', fallback=0)
+        if port:
+            metrics.start_server(self.config.get('metrics', 'address', fallback='127.0.0.1'), port + self.worker_index)
+
+    def profile(self, signum=None, frame=None):
+        """
+        收到SIGUSR2时在后台采样[trace]中profile_seconds秒的调用栈
+        """
+        tracing.profile_to_file(self.config.getint('trace', 'profile_seconds', fallback=10))
 
     def run(self):
+        signal.signal(signal.SIGUSR1, self.print_stats)
+        signal.signal(signal.SIGUSR2, self.profile)
+        crypto.get_key_store()  # 启动时加载RSA密钥,握手时不再读取文件
+        self.start_metrics()
         sock = self.socket_init()
         sock = self.bind_port(sock)  # socket链接到客户端
+        self.workers = self.worker_pool(self.handshake)
+        self.workers.start()
+        sock.settimeout(min(sock.gettimeout(), self.workers.queue_timeout))  # accept超时时清理等待超时的连接
         while True:
-            if threading.activeCount() > self.config.getint('server', 'threads'):  # 线程数量达到上限
-                time.sleep(1)
-                continue
             try:
                 conn, address = sock.accept()  # conn是一个新的套接字对象,用于在客户端与服务端之间交换数据
                 conn.setblocking(True)  # 设置套接字为阻塞模式
             except socket.timeout:
+                self.workers.expire()  # 没有新连接时也清理队列中等待超时的连接
                 continue
             except socket.error:
                 logging.exception("Exception occurred")
@@ -211,16 +459,327 @@ class Server:
             except TypeError:
                 logging.exception("Exception occurred")
                 exit(-1)
-            thread = threading.Thread(target=self.handshake, args=(conn,))
-            thread.start()
+            self.workers.submit(conn)
         sock.close()
 
 
+class AsyncServer(Server):
+    """
+    基于asyncio的服务端,所有连接的握手、请求和中继都在同一个事件循环中完成
+    """
+
+    async def ECDH_negotiate(self, reader, writer):
+        """
+        ECDH密钥协商阶段,客户端请求会话恢复时优先从会话缓存中派生密钥。
+        握手数据和早期数据帧都按长度读取,与客户端的数据如何分段到达无关
+        :param reader: StreamReader
+        :param writer: StreamWriter
+        :return: crypto.CipherSession | false
+        """
+        try:
+            data = await reader.readexactly(len(crypto.RESUME))
+            if data == crypto.RESUME:
+                data += await reader.readexactly(crypto.RESUME_LENGTH - len(data))
+                reply, session, key = self.sessions.parse_resume_data(data) if self.sessions else (crypto.RESUME_MISS, None, None)
+                writer.write(reply)
+                await writer.drain()
+                if key:
+                    return crypto.CipherSession(key, session.params, client=False)
+                data = b''  # 会话恢复失败,客户端在同一连接上进行完整握手
+            encrypt = crypto.ECDH(self.config.get('encrypt', 'curve'), self.config.get('encrypt', 'backend', fallback='tinyec'))
+            data += await reader.readexactly(encrypt.handshake_size - len(data))
+        except (socket.error, asyncio.IncompleteReadError):
+            logging.exception("Exception occurred")
+            return False
+        share_key = encrypt.parse_share_key_from_first_handshake_data(data)
+        if share_key:
+            params, extensions = crypto.server_negotiate(encrypt.extensions, self.suites, self.max_frame)
+            if not params:
+                return False
+            request = None
+            if crypto.EarlyData.parse(encrypt.extensions):  # 客户端发送了早期数据时握手数据之后紧跟一个早期数据帧,不接受也要读出
+                try:
+                    request = self.early_request(encrypt.extensions, await frame.read_frame(reader))
+                except (socket.error, ValueError, asyncio.IncompleteReadError):
+                    logging.exception("Exception occurred")
+                    return False
+                if request:
+                    extensions[crypto.EXTENSION_EARLY_DATA] = b'\x01'
+            data = encrypt.generate_first_handshake_data(extensions)
+            try:
+                writer.write(data)
+                await writer.drain()
+            except socket.error:
+                logging.exception("Exception occurred")
+                return False
+            key = share_key[10:42].encode()
+            if self.sessions:
+                self.sessions.put(crypto.Session(key, params))
+            cipher = crypto.CipherSession(key, params, client=False)
+            cipher.early_data = request
+            return cipher
+        else:
+            return False
+
+    async def parse_dst_from_request(self, reader, cipher):
+        """
+        从请求中提取目标地址和端口
+        :param reader: StreamReader
+        :param cipher: 加密会话
+        :return: (目标地址,端口)
+        """
+        try:
+            data = cipher.early_data or cipher.decrypt(await asyncio.wait_for(reader.read(self.buffer_size), self.request_timeout))  # 0-RTT握手时请求已随握手数据到达
+        except (ConnectionResetError, asyncio.TimeoutError, ValueError):
+            logging.exception("Exception occurred")
+            return False
+        tracing.annotate_target(data)
+        if data == mux.MUX_REQUEST:
+            return mux.MUX_REQUEST
+        return self.parse_dst(data)
+
+    async def resolve(self, addr):
+        """
+        域名通过resolver解析,IP地址直接返回
+        :param addr: 目标地址,域名为bytes
+        :return: [(family,ip)]
+        """
+        if not isinstance(addr, bytes):
+            return [(socket.AF_INET6 if ':' in addr else socket.AF_INET, addr)]
+        with metrics.DNS.time(), tracing.span('resolve'):
+            return await asyncio.wait_for(self.resolver.resolve_async(addr.decode(errors='replace')), self.timeout)
+
+    async def connect(self, dst):
+        """
+        对解析得到的所有地址交错并行连接
+        :param dst: (目标地址,端口)
+        :return: (StreamReader,StreamWriter)
+        """
+        addr, port = dst
+        addresses = await self.resolve(addr)
+        with metrics.CONNECT.time(), tracing.span('connect'):
+            return await dialer.open_connection(addresses, port, self.connect_delay, self.timeout)
+
+    async def request(self, reader, writer, cipher):
+        """
+        请求阶段,满足条件则进行中继
+        :param reader: StreamReader
+        :param writer: StreamWriter
+        :param cipher: 加密会话
+        """
+        with tracing.span('request'):
+            dst = await self.parse_dst_from_request(reader, cipher)
+        if dst == mux.MUX_REQUEST:
+            await self.mux(reader, writer, cipher)
+            return
+        dst_reader, dst_writer = None, None
+        if dst:
+            try:
+                dst_reader, dst_writer = await self.connect(dst)
+            except (socket.error, asyncio.TimeoutError):
+                logging.exception("Exception occurred")
+                return
+            if cipher.early_data:
+                dst_writer.write(self.early_payload(cipher.early_data))
+        if not dst:
+            rep = b'\x01'  # 无法初始化SOCKS服务
+            bnd = b'\x00\x00\x00\x00\x00\x00'
+        else:
+            rep = b'\x00'  # 初始化完成
+            bnd = self.bound_address(dst_writer.get_extra_info('sockname'))  # 绑定地址和端口
+        response = b'\x05' + rep + b'\x00' + b'\x01' + bnd
+        try:
+            writer.write(cipher.encrypt(response))
+            await writer.drain()
+        except socket.error:
+            logging.exception("Exception occurred")
+            if dst_writer:
+                dst_writer.close()
+            return
+        if rep == b'\x00':
+            with tracing.span('relay'):
+                await self.relay(reader, writer, dst_reader, dst_writer, cipher)
+        if dst_writer:
+            dst_writer.close()
+
+    async def mux(self, reader, writer, cipher):
+        """
+        多路复用模式,从隧道中解复用出各个逻辑流并分别连接目标地址
+        :param reader: StreamReader
+        :param writer: StreamWriter
+        :param cipher: 加密会话
+        """
+        try:
+            writer.write(cipher.encrypt(b'\x05\x00\x00\x01\x00\x00\x00\x00\x00\x00'))
+            await writer.drain()
+        except socket.error:
+            logging.exception("Exception occurred")
+            return
+        tunnel = mux.Tunnel(reader, writer, cipher)
+        while True:
+            frame = await tunnel.read_frame()
+            if frame is None:
+                break
+            frame_type, stream_id, data = frame
+            if frame_type == mux.OPEN:
+                if stream_id in tunnel.streams or len(tunnel.streams) >= mux.MAX_STREAMS:  # 重复的流编号或流数量超过上限
+                    logging.error("Rejected stream %d: duplicate id or too many streams (%d)", stream_id, len(tunnel.streams))
+                    asyncio.ensure_future(tunnel.reject(stream_id))
+                    continue
+                stream = mux.Stream(tunnel, stream_id)
+                tunnel.streams[stream_id] = stream
+                asyncio.ensure_future(self.mux_request(stream, data))
+            elif stream_id in tunnel.streams:
+                tunnel.streams[stream_id].on_frame(frame_type, data)
+        tunnel.close()
+
+    async def mux_request(self, stream, data):
+        """
+        多路复用模式的请求阶段,连接逻辑流的目标地址并进行中继
+        :param stream: mux.Stream
+        :param data: 解密后的请求
+        """
+        dst = self.parse_dst(data)
+        dst_reader, dst_writer = None, None
+        if dst:
+            try:
+                dst_reader, dst_writer = await self.connect(dst)
+            except (socket.error, asyncio.TimeoutError):
+                logging.exception("Exception occurred")
+                dst = False
+        if not dst:
+            rep = b'\x01'  # 无法初始化SOCKS服务
+            bnd = b'\x00\x00\x00\x00\x00\x00'
+        else:
+            rep = b'\x00'  # 初始化完成
+            bnd = self.bound_address(dst_writer.get_extra_info('sockname'))  # 绑定地址和端口
+        try:
+            await stream.tunnel.send(mux.REPLY, stream.stream_id, b'\x05' + rep + b'\x00' + b'\x01' + bnd)
+        except socket.error:
+            logging.exception("Exception occurred")
+        if rep == b'\x00' and not stream.closed:
+            await mux.relay(stream, dst_reader, dst_writer, self.buffer_size, metrics.DOWNSTREAM, metrics.UPSTREAM)
+        else:
+            await stream.close()
+        if dst_writer:
+            dst_writer.close()
+
+    async def relay_encrypt(self, reader, writer, cipher):
+        """
+        读取目标地址的数据,加密并添加长度前缀后发送到客户端
+        :param reader: 目标地址StreamReader
+        :param writer: 客户端StreamWriter
+        :param cipher: 加密会话
+        """
+        read_size = frame.read_size(self.buffer_size, cipher)
+        trace = tracing.current.get()
+        while True:
+            data = await reader.read(read_size.size)
+            if data == b'':
+                return
+            if trace:
+                trace.mark('first_byte_downstream')
+            read_size.update(len(data))
+            metrics.DOWNSTREAM.bytes.inc(len(data))
+            data = cipher.encrypt(data)
+            metrics.DOWNSTREAM.frame(len(data))
+            writer.writelines((struct.pack(">I", len(data)), data))
+            await writer.drain()
+
+    async def relay_decrypt(self, reader, writer, cipher):
+        """
+        按长度前缀读取客户端的完整数据帧,解密后发送到目标地址
+        :param reader: 客户端StreamReader
+        :param writer: 目标地址StreamWriter
+        :param cipher: 加密会话
+        """
+        trace = tracing.current.get()
+        while True:
+            try:
+                data = await frame.read_frame(reader)  # 帧长度超过上限时抛出ValueError,结束中继
+            except asyncio.IncompleteReadError:
+                return
+            if trace:
+                trace.mark('first_byte_upstream')
+            metrics.UPSTREAM.frame(len(data))
+            data = cipher.decrypt(data)
+            metrics.UPSTREAM.bytes.inc(len(data))
+            writer.write(data)
+            await writer.drain()
+
+    async def relay(self, src_reader, src_writer, dst_reader, dst_writer, cipher):
+        """
+        中继(relay)阶段,任意一个方向结束后关闭整个连接
+        :param src_reader: 客户端StreamReader
+        :param src_writer: 客户端StreamWriter
+        :param dst_reader: 目标地址StreamReader
+        :param dst_writer: 目标地址StreamWriter
+        :param cipher: 加密会话
+        """
+        for writer in (src_writer, dst_writer):
+            writer.transport.set_write_buffer_limits(self.high_watermark, self.low_watermark)  # drain()在超过高水位时等待
+        tasks = [
+            asyncio.ensure_future(self.relay_decrypt(src_reader, dst_writer, cipher)),
+            asyncio.ensure_future(self.relay_encrypt(dst_reader, src_writer, cipher)),
+        ]
+        done, pending = await asyncio.wait(tasks, return_when=asyncio.FIRST_COMPLETED)
+        for task in pending:
+            task.cancel()
+        for task in done:
+            if task.exception():
+                metrics.RELAY_ERRORS.inc()
+            if task.exception() and not isinstance(task.exception(), socket.error):
+                logging.error("Exception occurred", exc_info=task.exception())
+
+    async def handshake(self, reader, writer):
+        """
+        握手阶段,分为ECDH密钥协商阶段和请求中继阶段
+        :param reader: StreamReader
+        :param writer: StreamWriter
+        """
+        if self.counters:
+            self.counters.incr('accepted')
+        metrics.ACCEPTED.inc()
+        metrics.ACTIVE.inc()
+        try:
+            with self.tracer.connection() if self.tracer else tracing.null_span:
+                with metrics.HANDSHAKE.time(), tracing.span('ECDH_negotiate'):
+                    cipher = await self.ECDH_negotiate(reader, writer)
+                if cipher:
+                    await self.request(reader, writer, cipher)
+        finally:
+            metrics.ACTIVE.dec()
+            writer.close()
+            if self.counters:
+                self.counters.incr('closed')
+
+    async def serve(self):
+        signal.signal(signal.SIGUSR1, self.print_stats)
+        signal.signal(signal.SIGUSR2, self.profile)
+        crypto.get_key_store()  # 启动时加载RSA密钥,握手时不再读取文件
+        self.start_metrics()
+        sock = self.socket_init()
+        sock = self.bind_port(sock)
+        server = await asyncio.start_server(self.handshake, sock=sock)
+        async with server:
+            await server.serve_forever()
+
+    def run(self):
+        asyncio.run(self.serve())
+
+
 def main():
     config = ConfigParser()
     config.read('config.ini')
-    server = Server(config)
-    server.run()
+    if config.get('server', 'engine', fallback='thread') == 'asyncio':
+        server = AsyncServer(config)
+    else:
+        server = Server(config)
+    workers = config.getint('server', 'workers', fallback=1)
+    if workers > 1:
+        prefork.Supervisor(server, workers).run()
+    else:
+        server.run()
 
 
 if __name__ == '__main__':
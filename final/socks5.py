@@ -0,0 +1,35 @@
+import socket
+import struct
+
+
+def parse_address(data):
+    """
+    解析SOCKS5请求或UDP数据报头部中的 ATYP + 地址 + 端口
+    :param data: bytes
+    :return: (地址,端口,头部长度) | None(格式错误),域名为bytes
+    """
+    if data[0:1] == b'\x01':
+        if len(data) < 7:
+            return
+        return socket.inet_ntoa(data[1:5]), struct.unpack('>H', data[5:7])[0], 7
+    if data[0:1] == b'\x04':
+        if len(data) < 19:
+            return
+        return socket.inet_ntop(socket.AF_INET6, data[1:17]), struct.unpack('>H', data[17:19])[0], 19
+    if data[0:1] == b'\x03':
+        if len(data) < 2 or len(data) < 4 + data[1]:
+            return
+        return bytes(data[2:2 + data[1]]), struct.unpack('>H', data[2 + data[1]:4 + data[1]])[0], 4 + data[1]
+
+
+def pack_address(ip, port):
+    """
+    :param ip: ipv4或ipv6地址,ipv4映射的ipv6地址按ipv4编码
+    :param port: 端口
+    :return: ATYP + 地址 + 端口
+    """
+    if ip.startswith('::ffff:') and '.' in ip:
+        ip = ip[7:]
+    if ':' in ip:
+        return b'\x04' + socket.inet_pton(socket.AF_INET6, ip) + struct.pack('>H', port)
+    return b'\x01' + socket.inet_aton(ip) + struct.pack('>H', port)
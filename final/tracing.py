@@ -0,0 +1,177 @@
+import os
+import sys
+import json
+import time
+import random
+import itertools
+import threading
+import contextlib
+import contextvars
+import collections
+import socks5
+
+INTERVAL = 0.005  # 采样分析器的采样间隔(秒)
+MAX_SECONDS = 60  # 单次采样时间的上限(秒),采样期间占用分析锁和请求线程
+
+current = contextvars.ContextVar('trace', default=None)  # 当前连接的Trace,未采样时为None;asyncio的每个任务复制创建时的上下文
+null_span = contextlib.nullcontext()
+ids = itertools.count(1)
+
+
+class Trace:
+    """
+    一个连接的各阶段耗时,时间相对于连接开始的时间(毫秒)
+    """
+
+    def __init__(self, role):
+        """
+        :param role: server | local
+        """
+        self.id = next(ids)
+        self.role = role
+        self.started = time.time()
+        self.start = time.perf_counter()
+        self.attrs = {}
+        self.spans = []  # (阶段,开始,结束)
+        self.marks = {}  # 事件: 时间
+
+    def elapsed(self, moment):
+        return round((moment - self.start) * 1000, 3)
+
+    @contextlib.contextmanager
+    def span(self, name):
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.spans.append((name, start, time.perf_counter()))
+
+    def mark(self, name):
+        """
+        记录事件第一次发生的时间,之后的调用忽略
+        """
+        if name not in self.marks:
+            self.marks[name] = time.perf_counter()
+
+    def to_dict(self):
+        return {
+            'id': self.id,
+            'role': self.role,
+            'pid': os.getpid(),
+            'start': self.started,
+            'duration_ms': self.elapsed(time.perf_counter()),
+            **self.attrs,
+            'spans': [{'name': name, 'start_ms': self.elapsed(start), 'duration_ms': round((end - start) * 1000, 3)} for name, start, end in self.spans],
+            'marks': {name: self.elapsed(moment) for name, moment in self.marks.items()},
+        }
+
+
+class Tracer:
+    """
+    按比例采样连接,连接结束后把Trace作为一行JSON追加到文件
+    """
+
+    def __init__(self, role, filename, sample):
+        """
+        :param role: server | local
+        :param filename: 输出文件
+        :param sample: 采样比例(0~1)
+        """
+        self.role = role
+        self.filename = filename
+        self.sample = sample
+        self.lock = threading.Lock()
+
+    @contextlib.contextmanager
+    def connection(self):
+        """
+        在with语句块中处理一个连接,被采样时设置当前的Trace,结束后写入文件
+        """
+        if random.random() >= self.sample:
+            yield
+            return
+        trace = Trace(self.role)
+        token = current.set(trace)
+        try:
+            yield
+        finally:
+            current.reset(token)
+            line = json.dumps(trace.to_dict(), ensure_ascii=False)
+            with self.lock:
+                with open(self.filename, 'a') as file:
+                    file.write(line + '\n')
+
+
+def span(name):
+    """
+    当前连接被采样时记录with语句块的耗时,否则不做任何事
+    :param name: 阶段名称
+    """
+    trace = current.get()
+    return trace.span(name) if trace else null_span
+
+
+def annotate_target(request):
+    """
+    当前连接被采样时记录SOCKS请求的目标地址
+    :param request: 解密后的SOCKS请求
+    """
+    trace = current.get()
+    if trace:
+        address = socks5.parse_address(request[3:])
+        if address:
+            addr, port, size = address
+            trace.attrs['target'] = '{}:{}'.format(addr.decode(errors='replace') if isinstance(addr, bytes) else addr, port)
+
+
+profile_lock = threading.Lock()
+
+
+def profile(seconds, interval=INTERVAL):
+    """
+    采样分析器:每隔interval秒通过sys._current_frames()取得所有线程的调用栈,持续seconds秒。
+    同一时间只运行一次,已有分析正在进行时返回None
+    :param seconds: 采样时间(秒),超过MAX_SECONDS时按MAX_SECONDS采样
+    :param interval: 采样间隔(秒)
+    :return: flamegraph.pl可以读取的折叠调用栈(每行为 线程;文件:函数;... 次数) | None
+    """
+    if not profile_lock.acquire(blocking=False):
+        return
+    try:
+        me = threading.get_ident()
+        counts = collections.Counter()
+        deadline = time.monotonic() + min(seconds, MAX_SECONDS)
+        while time.monotonic() < deadline:
+            names = {thread.ident: thread.name for thread in threading.enumerate()}
+            for ident, frame in sys._current_frames().items():
+                if ident == me:
+                    continue
+                stack = []
+                while frame:
+                    stack.append('{}:{}'.format(os.path.basename(frame.f_code.co_filename), frame.f_code.co_name))
+                    frame = frame.f_back
+                stack.append(names.get(ident, str(ident)).replace(';', ','))
+                counts[';'.join(reversed(stack))] += 1
+            time.sleep(interval)
+        return ''.join('{} {}\n'.format(stack, count) for stack, count in counts.most_common())
+    finally:
+        profile_lock.release()
+
+
+def profile_to_file(seconds, interval=INTERVAL):
+    """
+    在后台线程中采样,结束后写入profile-进程号-时间.folded
+    :param seconds: 采样时间(秒)
+    :param interval: 采样间隔(秒)
+    """
+
+    def run():
+        folded = profile(seconds, interval)
+        if folded is None:
+            return
+        filename = 'profile-{}-{}.folded'.format(os.getpid(), int(time.time()))
+        with open(filename, 'w') as file:
+            file.write(folded)
+        print("profile written to {}".format(filename), flush=True)
+
+    threading.Thread(target=run, daemon=True).start()
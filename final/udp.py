@@ -0,0 +1,358 @@
+import time
+import errno
+import socket
+import select
+import logging
+import threading
+import frame
+import socks5
+
+ASSOCIATE = b'\x05\x03\x00'  # UDP ASSOCIATE请求,版本号为5,UDP ASSOCIATE为0x03,0x00为保留字
+BATCH = 64  # UDP socket每次可读时最多连续读取的数据报数量
+PENDING_LIMIT = 16  # 每个域名等待解析结果时最多缓存的数据报数量
+DATAGRAM_SIZE = 65535
+
+
+def recv_batch(sock, limit=BATCH):
+    """
+    从非阻塞的UDP socket连续读取数据报,直到没有数据或达到limit,一次select唤醒处理一批数据报
+    :param sock: socket(非阻塞)
+    :param limit: 最多读取的数据报数量
+    :return: [(数据,来源地址)]
+    """
+    datagrams = []
+    while len(datagrams) < limit:
+        try:
+            datagrams.append(sock.recvfrom(DATAGRAM_SIZE))
+        except (BlockingIOError, InterruptedError):
+            break
+        except ConnectionRefusedError:  # 之前发送的数据报收到ICMP端口不可达
+            continue
+    return datagrams
+
+
+class Association:
+    """
+    一个UDP ASSOCIATE关联,在UDP socket和加密隧道之间中继数据报。隧道中每个帧是一个数据报,
+    帧内容为 ATYP + 地址 + 端口 + 数据。UDP socket可读时连续读取最多BATCH个数据报,加密后的帧由FrameWriter
+    合并为一次sendmsg;隧道的一次读取也会解析出其中所有完整的帧。隧道的发送队列超过高水位时暂停读取UDP socket,
+    由内核丢弃多出的数据报
+    """
+
+    def __init__(self, tunnel, cipher, buffers, latency=0, high=frame.HIGH_WATERMARK, low=frame.LOW_WATERMARK, timeout=None):
+        """
+        :param tunnel: 加密隧道socket
+        :param cipher: 加密会话
+        :param buffers: frame.BufferPool
+        :param latency: 帧的合并等待时间(秒)
+        :param high: 隧道发送队列的高水位(字节)
+        :param low: 隧道发送队列的低水位(字节)
+        :param timeout: 两个方向都没有数据报超过该时间(秒)后结束,None表示不超时
+        """
+        self.tunnel = tunnel
+        self.tunnel.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)  # 帧的合并由FrameWriter完成,Nagle算法与延迟确认会让一批数据报之后的帧多等待一个ACK
+        self.cipher = cipher
+        self.buffers = buffers
+        self.writer = frame.FrameWriter(tunnel, latency, high=high, low=low)
+        self.timeout = timeout
+        self.reading = True  # 隧道的发送队列超过高水位时暂停读取UDP socket,低于低水位时恢复
+        self.last_active = time.monotonic()
+        self.sent = 0  # 从隧道转发到UDP socket的数据报
+        self.received = 0  # 从UDP socket转发到隧道的数据报
+        self.dropped = 0
+
+    def sockets(self):
+        """
+        :return: 需要读取的UDP socket
+        """
+        return []
+
+    def watch(self):
+        """
+        :return: 除隧道和UDP socket之外需要读取的socket,可读时调用on_readable
+        """
+        return []
+
+    def on_readable(self, sock):
+        """
+        :return: 是否继续中继
+        """
+        return True
+
+    def on_datagram(self, sock, data, address):
+        """
+        处理UDP socket收到的数据报
+        :return: 隧道中的帧内容 | None(丢弃)
+        """
+
+    def on_frame(self, data):
+        """
+        处理隧道中解密后的帧
+        :param data: 帧内容
+        """
+
+    def close(self):
+        for sock in self.sockets():
+            sock.close()
+
+    def send(self, sock, data, address):
+        """
+        发送数据报,发送缓冲区已满时丢弃
+        """
+        try:
+            sock.sendto(data, address)
+            self.sent += 1
+        except (BlockingIOError, InterruptedError):
+            self.dropped += 1
+        except OSError as err:
+            if err.errno not in (errno.ECONNREFUSED, errno.ENETUNREACH, errno.EHOSTUNREACH, errno.EACCES, errno.EINVAL):
+                raise
+            self.dropped += 1
+
+    def select_timeout(self):
+        timeouts = [timeout for timeout in (self.writer.timeout(), self.timeout and self.last_active + self.timeout - time.monotonic()) if timeout is not None]
+        return max(min(timeouts), 0) if timeouts else None
+
+    def run(self):
+        decoder = frame.FrameDecoder(self.buffers)
+        self.tunnel.setblocking(False)
+        try:
+            while True:
+                if self.timeout and time.monotonic() - self.last_active >= self.timeout:
+                    return
+                rlist = [self.tunnel] + self.watch() + (self.sockets() if self.reading else [])
+                wlist = [self.tunnel] if self.writer.blocked else []
+                try:
+                    rlist, wlist, xlist = select.select(rlist, wlist, [], self.select_timeout())
+                except select.error:
+                    logging.exception("Exception occurred")
+                    return
+                try:
+                    if wlist:
+                        self.writer.flush()
+                    for sock in rlist:
+                        if sock is self.tunnel:
+                            if decoder.recv_into(sock) == 0:
+                                return
+                            for data in decoder.frames():
+                                self.last_active = time.monotonic()
+                                self.on_frame(self.cipher.decrypt(data))
+                        elif sock in self.watch():
+                            if not self.on_readable(sock):
+                                return
+                        else:
+                            for data, address in recv_batch(sock):
+                                data = self.on_datagram(sock, data, address)
+                                if data is None:
+                                    self.dropped += 1
+                                    continue
+                                self.last_active = time.monotonic()
+                                self.received += 1
+                                self.writer.write(self.cipher.encrypt(data))
+                    self.writer.poll()
+                except (socket.error, ValueError):  # ValueError: AEAD认证失败或帧长度超过上限
+                    logging.exception("Exception occurred")
+                    return
+                if self.writer.full():
+                    self.reading = False
+                elif self.writer.drained():
+                    self.reading = True
+        finally:
+            decoder.close()
+            self.close()
+
+
+class LocalAssociation(Association):
+    """
+    本地客户端的关联,数据报来自浏览器,只接受与TCP控制连接相同IP的数据报,TCP控制连接关闭时结束
+    """
+
+    def __init__(self, conn, udp, *args, **kwargs):
+        """
+        :param conn: 与浏览器之间的TCP控制连接
+        :param udp: 与浏览器之间的UDP socket
+        """
+        super().__init__(*args, **kwargs)
+        self.conn = conn
+        self.udp = udp
+        self.client_ip = conn.getpeername()[0]
+        self.client = None  # 浏览器的UDP地址,收到第一个数据报后确定
+
+    def sockets(self):
+        return [self.udp]
+
+    def watch(self):
+        return [self.conn]
+
+    def on_readable(self, sock):
+        return sock.recv(1) != b''
+
+    def on_datagram(self, sock, data, address):
+        if address[0] != self.client_ip or data[2:3] != b'\x00':  # 不支持分片
+            return
+        self.client = address
+        return data[3:]
+
+    def on_frame(self, data):
+        if self.client:
+            self.send(self.udp, b'\x00\x00\x00' + data, self.client)
+
+
+class ServerAssociation(Association):
+    """
+    服务端的关联,按需为每个地址族创建UDP socket。NAT表记录发送过数据报的目标地址,
+    只把这些地址在timeout内返回的数据报转发到隧道,超过timeout没有数据报的表项被删除。
+    域名交给resolver的解析线程查询,缓存命中时直接发送;未命中时数据报按域名暂存,解析完成后通过socketpair唤醒select再发送,
+    一个慢的域名不会阻塞其他数据报
+    """
+
+    def __init__(self, resolver, *args, **kwargs):
+        """
+        :param resolver: resolver.Resolver
+        """
+        super().__init__(*args, **kwargs)
+        self.resolver = resolver
+        self.udp = {}  # 地址族: UDP socket
+        self.nat = {}  # (ip,端口): 最近一次发送的时间
+        self.pending = {}  # 域名: (concurrent.futures.Future,[(端口,数据)])
+        self.wakeup, self.notifier = socket.socketpair()  # 解析线程完成查询后向notifier写入一个字节
+        self.wakeup.setblocking(False)
+        self.notifier.setblocking(False)
+        self.last_sweep = time.monotonic()
+
+    def sockets(self):
+        return list(self.udp.values())
+
+    def watch(self):
+        return [self.wakeup]
+
+    def close(self):
+        super().close()
+        self.wakeup.close()
+        self.notifier.close()
+
+    def notify(self, future):
+        """
+        在解析线程中调用,唤醒关联的select
+        """
+        try:
+            self.notifier.send(b'\x00')
+        except socket.error:  # 关联已结束或唤醒字节已经足够多
+            pass
+
+    def on_readable(self, sock):
+        try:
+            sock.recv(4096)
+        except (BlockingIOError, InterruptedError):
+            pass
+        for host, (future, datagrams) in list(self.pending.items()):
+            if future.done():
+                del self.pending[host]
+                self.deliver(future, datagrams)
+        return True
+
+    def socket(self, family):
+        sock = self.udp.get(family)
+        if not sock:
+            sock = socket.socket(family, socket.SOCK_DGRAM)
+            sock.setblocking(False)
+            self.udp[family] = sock
+        return sock
+
+    def sweep(self):
+        """
+        删除超时的NAT表项,不超时的关联不删除
+        """
+        now = time.monotonic()
+        if not self.timeout or now - self.last_sweep < self.timeout / 2:
+            return
+        self.last_sweep = now
+        for address, last in list(self.nat.items()):
+            if now - last >= self.timeout:
+                del self.nat[address]
+
+    def send_to(self, family, ip, port, data):
+        """
+        发送数据报并记录NAT表项
+        """
+        self.sweep()
+        self.nat[(ip, port)] = time.monotonic()
+        self.send(self.socket(family), data, (ip, port))
+
+    def deliver(self, future, datagrams):
+        """
+        域名解析完成后发送暂存的数据报,解析失败时丢弃
+        :param future: resolver.Resolver.submit返回的Future(已完成)
+        :param datagrams: [(端口,数据)]
+        """
+        try:
+            family, ip = future.result()[0]
+        except socket.error:
+            self.dropped += len(datagrams)
+            return
+        for port, data in datagrams:
+            self.send_to(family, ip, port, data)
+
+    def on_frame(self, data):
+        address = socks5.parse_address(data)
+        if not address:
+            self.dropped += 1
+            return
+        addr, port, size = address
+        if not isinstance(addr, bytes):
+            self.send_to(socket.AF_INET6 if ':' in addr else socket.AF_INET, addr, port, data[size:])
+            return
+        host = addr.decode(errors='replace')
+        if host in self.pending:
+            datagrams = self.pending[host][1]
+            if len(datagrams) < PENDING_LIMIT:
+                datagrams.append((port, data[size:]))
+            else:
+                self.dropped += 1
+            return
+        future = self.resolver.submit(host)
+        if future.done():  # 缓存命中
+            self.deliver(future, [(port, data[size:])])
+            return
+        self.pending[host] = (future, [(port, data[size:])])
+        future.add_done_callback(self.notify)
+
+    def on_datagram(self, sock, data, address):
+        if address[:2] not in self.nat:
+            return
+        return socks5.pack_address(address[0], address[1]) + data
+
+
+class Stats:
+    """
+    服务端所有关联的统计
+    """
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.active = 0
+        self.total = 0
+        self.sent = 0
+        self.received = 0
+        self.dropped = 0
+
+    def run(self, association):
+        """
+        运行关联并在结束后累计统计
+        :param association: Association
+        """
+        with self.lock:
+            self.active += 1
+            self.total += 1
+        try:
+            association.run()
+        finally:
+            with self.lock:
+                self.active -= 1
+                self.sent += association.sent
+                self.received += association.received
+                self.dropped += association.dropped
+
+    def print_stats(self):
+        with self.lock:
+            print("udp associations active={} total={} sent={} received={} dropped={}".format(self.active, self.total, self.sent, self.received, self.dropped), flush=True)
@@ -0,0 +1,133 @@
+import time
+import socket
+import logging
+import threading
+import collections
+
+
+class WorkerPool:
+    """
+    固定数量的工作线程和有界的准入队列。accept线程只负责把连接放入队列,队列已满时立即拒绝;
+    连接在队列中等待超过queue_timeout秒后被拒绝,工作线程全部忙碌时由accept线程调用expire清理
+    """
+
+    def __init__(self, handler, reject, workers, queue_size, queue_timeout):
+        """
+        :param handler: 连接处理函数,参数为socket
+        :param reject: 拒绝连接的函数,参数为socket
+        :param workers: 工作线程数量
+        :param queue_size: 准入队列长度
+        :param queue_timeout: 连接在队列中的最长等待时间(秒)
+        """
+        self.handler = handler
+        self.reject = reject
+        self.workers = workers
+        self.queue_size = queue_size
+        self.queue_timeout = queue_timeout
+        self.queue = collections.deque()  # (socket,入队时间),队首等待时间最长
+        self.lock = threading.Lock()
+        self.condition = threading.Condition(self.lock)
+        self.busy = 0
+        self.admitted = 0
+        self.rejected = 0  # 队列已满被拒绝
+        self.expired = 0  # 等待超时被拒绝
+        self.max_depth = 0
+        self.wait_total = 0
+        self.wait_max = 0
+
+    def start(self):
+        for _ in range(self.workers):
+            thread = threading.Thread(target=self.worker, daemon=True)
+            thread.start()
+
+    def submit(self, conn):
+        """
+        将连接放入准入队列
+        :param conn: socket
+        :return: bool(是否进入队列)
+        """
+        self.expire()
+        with self.lock:
+            admitted = len(self.queue) < self.queue_size
+            if admitted:
+                self.queue.append((conn, time.monotonic()))
+                self.max_depth = max(self.max_depth, len(self.queue))
+                self.condition.notify()
+            else:
+                self.rejected += 1
+        if not admitted:
+            self.close(conn, self.reject)
+        return admitted
+
+    def expire(self):
+        """
+        拒绝队列中等待超时的连接
+        """
+        now = time.monotonic()
+        expired = []
+        with self.lock:
+            while self.queue and now - self.queue[0][1] > self.queue_timeout:
+                conn, enqueued = self.queue.popleft()
+                self.expired += 1
+                self.wait_total += now - enqueued
+                self.wait_max = max(self.wait_max, now - enqueued)
+                expired.append(conn)
+        for conn in expired:
+            self.close(conn, self.reject)
+
+    def worker(self):
+        while True:
+            with self.lock:
+                while not self.queue:
+                    self.condition.wait()
+                conn, enqueued = self.queue.popleft()
+                wait = time.monotonic() - enqueued
+                self.wait_total += wait
+                self.wait_max = max(self.wait_max, wait)
+                expired = wait > self.queue_timeout
+                if expired:
+                    self.expired += 1
+                else:
+                    self.admitted += 1
+                    self.busy += 1
+            if expired:
+                self.close(conn, self.reject)
+                continue
+            try:
+                self.close(conn, self.handler)
+            finally:
+                with self.lock:
+                    self.busy -= 1
+
+    def close(self, conn, handler):
+        """
+        调用handler处理连接,结束后关闭连接
+        """
+        try:
+            handler(conn)
+        except Exception:
+            logging.exception("Exception occurred")
+        finally:
+            try:
+                conn.close()
+            except socket.error:
+                pass
+
+    def stats(self):
+        with self.lock:
+            dequeued = self.admitted + self.expired
+            return {
+                'workers': self.workers,
+                'busy': self.busy,
+                'depth': len(self.queue),
+                'max_depth': self.max_depth,
+                'admitted': self.admitted,
+                'rejected': self.rejected,
+                'expired': self.expired,
+                'wait_avg': self.wait_total / dequeued if dequeued else 0.0,
+                'wait_max': self.wait_max,
+            }
+
+    def print_stats(self, signum=None, frame=None):
+        print("workers busy={busy}/{workers} queue depth={depth} max_depth={max_depth} admitted={admitted} rejected={rejected} expired={expired} "
+              "wait_avg={wait_avg:.6f}s wait_max={wait_max:.6f}s".format(**self.stats()), flush=True)